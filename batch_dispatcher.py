@@ -0,0 +1,575 @@
+"""
+Batch Dispatcher - Optimal assignment of pending jobs to masters
+Пакетное распределение заказов: вместо жадного выбора по одному заказу
+собираем заказы за короткое окно и решаем задачу о назначениях
+"""
+import heapq
+import json
+import math
+import time as timer
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+
+from schedule_manager import ScheduleManager, DEFAULT_JOB_MINUTES
+
+
+EARTH_RADIUS_KM = 6371.0
+BATCH_WINDOW_SECONDS = 30  # Сколько копим заказы перед распределением
+CANDIDATES_PER_JOB = 40  # Сколько самых дешёвых мастеров рассматривать на заказ
+TIME_BUDGET_SECONDS = 5.0  # Лимит времени на решение, дальше - жадно
+
+# Веса стоимости назначения
+DISTANCE_WEIGHT = 1.0  # за км
+RATING_WEIGHT = 4.0  # за каждый балл рейтинга ниже 5.0
+WORKLOAD_WEIGHT = 3.0  # за каждый заказ мастера на дату
+SPECIALIZATION_WEIGHT = 2.0  # категория заказа - не основная специализация
+UNKNOWN_DISTANCE_KM = 10.0  # Если у заказа или мастера нет координат
+UNASSIGNED_PENALTY = 1000.0  # Заказ без мастера - дороже любого назначения
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Расстояние по прямой между двумя точками в км"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+@dataclass
+class PendingJob:
+    """Заказ, ожидающий мастера"""
+    job_id: int
+    category: str
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+
+
+@dataclass
+class MasterOption:
+    """Мастер, доступный для распределения"""
+    master_id: int
+    specializations: List[str]
+    rating: float = 5.0
+    workload: int = 0
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+
+
+@dataclass
+class DispatchResult:
+    """Итог пакетного распределения"""
+    assignments: Dict[int, int]  # job_id -> master_id
+    unassigned: List[int]
+    total_cost: float
+    greedy_cost: float
+    greedy_assigned: int
+    elapsed_ms: float
+    optimal: bool = True  # False, если не уложились в лимит времени
+    costs: Dict[int, float] = field(default_factory=dict)  # job_id -> стоимость назначения
+    # job_id -> запасные мастера [(стоимость, master_id)] по возрастанию, если бронь не удастся
+    alternatives: Dict[int, List[Tuple[float, int]]] = field(default_factory=dict)
+    
+    def to_dict(self) -> Dict:
+        return {
+            "assignments": self.assignments,
+            "unassigned": self.unassigned,
+            "total_cost": round(self.total_cost, 2),
+            "greedy_cost": round(self.greedy_cost, 2),
+            "greedy_assigned": self.greedy_assigned,
+            "elapsed_ms": round(self.elapsed_ms, 1),
+            "optimal": self.optimal
+        }
+
+
+def assignment_cost(job: PendingJob, master: MasterOption) -> Optional[float]:
+    """Стоимость назначения мастера на заказ или None, если он не подходит"""
+    if job.category not in master.specializations:
+        return None
+    
+    if None in (job.lat, job.lon, master.lat, master.lon):
+        distance = UNKNOWN_DISTANCE_KM
+    else:
+        distance = haversine_km(job.lat, job.lon, master.lat, master.lon)
+    
+    cost = distance * DISTANCE_WEIGHT
+    cost += (5.0 - (master.rating or 5.0)) * RATING_WEIGHT
+    cost += master.workload * WORKLOAD_WEIGHT
+    if master.specializations[0] != job.category:
+        cost += SPECIALIZATION_WEIGHT
+    return cost
+
+
+def build_cost_matrix(
+    jobs: List[PendingJob],
+    masters: List[MasterOption],
+    candidates_per_job: int = CANDIDATES_PER_JOB
+) -> List[List[Tuple[float, int]]]:
+    """
+    Разреженная матрица стоимостей: для каждого заказа - самые дешёвые мастера
+    
+    Returns:
+        Для каждого заказа список (стоимость, индекс мастера) по возрастанию
+    """
+    by_category: Dict[str, List[int]] = {}
+    for index, master in enumerate(masters):
+        for specialization in master.specializations:
+            by_category.setdefault(specialization, []).append(index)
+    
+    matrix = []
+    for job in jobs:
+        options = []
+        for index in by_category.get(job.category, []):
+            cost = assignment_cost(job, masters[index])
+            if cost is not None:
+                options.append((cost, index))
+        matrix.append(heapq.nsmallest(candidates_per_job, options))
+    return matrix
+
+
+def greedy_assignment(matrix: List[List[Tuple[float, int]]]) -> List[Optional[int]]:
+    """Как сейчас: каждый заказ по очереди забирает самого дешёвого свободного мастера"""
+    taken = set()
+    result = []
+    for options in matrix:
+        choice = next((index for _, index in options if index not in taken), None)
+        if choice is not None:
+            taken.add(choice)
+        result.append(choice)
+    return result
+
+
+def solve_assignment(
+    matrix: List[List[Tuple[float, int]]],
+    deadline: Optional[float] = None
+) -> Tuple[List[Optional[int]], bool]:
+    """
+    Задача о назначениях минимальной стоимости (венгерский алгоритм)
+    
+    Кратчайшие увеличивающие пути Дейкстрой с потенциалами по разреженному
+    графу кандидатов. Каждый мастер получает не больше одного заказа.
+    У каждого заказа есть фиктивный вариант "без мастера" со штрафом
+    UNASSIGNED_PENALTY, поэтому сначала максимизируется число назначений.
+    Если deadline (perf_counter) наступил, оставшиеся заказы
+    распределяются жадно.
+    
+    Returns:
+        (индекс мастера для каждого заказа или None, решено ли полностью)
+    """
+    matrix = [options + [(UNASSIGNED_PENALTY, -1 - job)] for job, options in enumerate(matrix)]
+    job_potential = [min(options)[0] for options in matrix]
+    master_potential: Dict[int, float] = {}
+    master_job: Dict[int, int] = {}
+    job_master: List[Optional[int]] = [None] * len(matrix)
+    completed = True
+    
+    for source, source_options in enumerate(matrix):
+        if deadline is not None and timer.perf_counter() > deadline:
+            completed = False
+            break
+        
+        # Дейкстра по мастерам; от занятого мастера переходим к его заказу
+        dist: Dict[int, float] = {}
+        prev_job: Dict[int, int] = {}
+        heap = []
+        for cost, master in source_options:
+            reduced = cost - job_potential[source] - master_potential.get(master, 0.0)
+            heapq.heappush(heap, (reduced, master, source))
+        
+        finished: List[Tuple[int, float]] = []
+        target = None
+        target_dist = 0.0
+        while heap:
+            d, master, job = heapq.heappop(heap)
+            if master in dist:
+                continue
+            dist[master] = d
+            prev_job[master] = job
+            
+            if master not in master_job:
+                target = master
+                target_dist = d
+                break
+            
+            finished.append((master, d))
+            next_job = master_job[master]
+            for cost, next_master in matrix[next_job]:
+                if next_master not in dist:
+                    reduced = cost - job_potential[next_job] - master_potential.get(next_master, 0.0)
+                    heapq.heappush(heap, (d + reduced, next_master, next_job))
+        
+        # Обновляем потенциалы, чтобы приведённые стоимости остались >= 0
+        job_potential[source] += target_dist
+        for master, d in finished:
+            shift = target_dist - d
+            master_potential[master] = master_potential.get(master, 0.0) - shift
+            job_potential[master_job[master]] += shift
+        
+        # Перекладываем заказы вдоль пути
+        master = target
+        while True:
+            job = prev_job[master]
+            previous = job_master[job]
+            job_master[job] = master
+            master_job[master] = job
+            if job == source:
+                break
+            master = previous
+    
+    # Фиктивный мастер = заказ без мастера
+    job_master = [master if master is not None and master >= 0 else None for master in job_master]
+    
+    if not completed:
+        taken = set(master_job)
+        for job, options in enumerate(matrix):
+            if job_master[job] is None:
+                choice = next((index for _, index in options[:-1] if index not in taken), None)
+                if choice is not None:
+                    taken.add(choice)
+                    job_master[job] = choice
+    
+    return job_master, completed
+
+
+def _total_cost(matrix: List[List[Tuple[float, int]]], choice: List[Optional[int]]) -> float:
+    total = 0.0
+    for options, master in zip(matrix, choice):
+        if master is not None:
+            total += next(cost for cost, index in options if index == master)
+    return total
+
+
+def dispatch_batch(
+    jobs: List[PendingJob],
+    masters: List[MasterOption],
+    candidates_per_job: int = CANDIDATES_PER_JOB,
+    time_budget: float = TIME_BUDGET_SECONDS
+) -> DispatchResult:
+    """Распределить пакет заказов и сравнить с жадным назначением"""
+    started = timer.perf_counter()
+    matrix = build_cost_matrix(jobs, masters, candidates_per_job)
+    choice, completed = solve_assignment(matrix, deadline=started + time_budget)
+    elapsed_ms = (timer.perf_counter() - started) * 1000
+    
+    greedy = greedy_assignment(matrix)
+    
+    return DispatchResult(
+        assignments={
+            job.job_id: masters[master].master_id
+            for job, master in zip(jobs, choice) if master is not None
+        },
+        unassigned=[job.job_id for job, master in zip(jobs, choice) if master is None],
+        total_cost=_total_cost(matrix, choice),
+        greedy_cost=_total_cost(matrix, greedy),
+        greedy_assigned=sum(1 for master in greedy if master is not None),
+        elapsed_ms=elapsed_ms,
+        optimal=completed,
+        costs={
+            job.job_id: next(cost for cost, index in options if index == master)
+            for job, options, master in zip(jobs, matrix, choice) if master is not None
+        },
+        alternatives={
+            job.job_id: [(cost, masters[index].master_id) for cost, index in options if index != master]
+            for job, options, master in zip(jobs, matrix, choice) if master is not None
+        }
+    )
+
+
+class BatchWindow:
+    """
+    Окна пакетов по городам: первый заказ без мастера открывает окно,
+    по истечении window_seconds город отдаётся на распределение
+    """
+    
+    def __init__(self, window_seconds: int = BATCH_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self._opened: Dict[str, float] = {}  # город -> когда пришёл первый заказ пакета
+    
+    def job_received(self, city: str):
+        """Отметить новый заказ: первый заказ открывает окно пакета"""
+        self._opened.setdefault(city, timer.monotonic())
+    
+    def due_cities(self) -> List[str]:
+        """Города, чьё окно истекло (окна закрываются)"""
+        now = timer.monotonic()
+        due = [city for city, opened in self._opened.items() if now - opened >= self.window_seconds]
+        for city in due:
+            del self._opened[city]
+        return due
+
+
+class BatchDispatcher:
+    """Распределяет накопленные заказы города пакетом и бронирует слоты мастеров"""
+    
+    def __init__(self, db_connection):
+        self.db = db_connection
+        self.schedule = ScheduleManager(db_connection)
+    
+    def load_pending_jobs(self, city: str) -> List[PendingJob]:
+        """Заказы города без мастера в порядке поступления"""
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT id, category, address_lat, address_lon FROM jobs
+            WHERE status = 'pending' AND master_id IS NULL AND city = ?
+            ORDER BY created_at, id
+        """, (city,))
+        return [PendingJob(*row) for row in cursor.fetchall()]
+    
+    def load_masters(self, city: str, date: datetime) -> List[MasterOption]:
+        """Активные мастера города с рабочим днём на дату и их загрузкой"""
+        cursor = self.db.cursor()
+        date_key = date.strftime("%Y-%m-%d")
+        cursor.execute("""
+            WITH workload AS (
+                SELECT master_id, COUNT(DISTINCT job_id) AS jobs
+                FROM master_slots
+                WHERE date = ? AND job_id IS NOT NULL
+                GROUP BY master_id
+            )
+            SELECT m.id, m.specializations, m.rating, COALESCE(w.jobs, 0), m.base_lat, m.base_lon
+            FROM masters m
+            LEFT JOIN workload w ON w.master_id = m.id
+            WHERE m.is_active = 1 AND m.city = ?
+            AND EXISTS (
+                SELECT 1 FROM master_slots s
+                WHERE s.master_id = m.id AND s.date = ? AND s.job_id IS NULL
+            )
+        """, (date_key, city, date_key))
+        
+        masters = []
+        for master_id, specializations, rating, workload, lat, lon in cursor.fetchall():
+            try:
+                specializations = json.loads(specializations)
+            except (TypeError, ValueError):
+                specializations = [item.strip() for item in (specializations or "").split(",") if item.strip()]
+            if specializations:
+                masters.append(MasterOption(master_id, specializations, rating or 5.0, workload, lat, lon))
+        return masters
+    
+    def _book_assignment(self, job_id: int, master_id: int, day: datetime, not_before) -> bool:
+        """Забронировать слоты и назначить заказ; без коммита, откат только этого заказа"""
+        cursor = self.db.cursor()
+        cursor.execute("SAVEPOINT dispatch_job")
+        
+        start_minute = self.schedule.find_earliest_start(master_id, day, DEFAULT_JOB_MINUTES, not_before)
+        booked = start_minute is not None and self.schedule.book_master_for_job(
+            master_id, job_id, day + timedelta(minutes=start_minute), commit=False
+        )
+        if booked:
+            cursor.execute("""
+                UPDATE jobs SET master_id = ?, status = 'accepted'
+                WHERE id = ? AND status = 'pending' AND master_id IS NULL
+            """, (master_id, job_id))
+            booked = cursor.rowcount == 1
+        
+        if not booked:
+            cursor.execute("ROLLBACK TO dispatch_job")
+        cursor.execute("RELEASE dispatch_job")
+        return booked
+    
+    def dispatch(self, city: str, date: Optional[datetime] = None) -> DispatchResult:
+        """
+        Распределить все ожидающие заказы города и записать назначения
+        
+        Назначение и бронь слотов мастера записываются одной транзакцией,
+        поэтому следующий пакет и ранжирование видят мастера занятым. Если бронь
+        не удалась (окно заняли), заказ предлагается следующим по стоимости
+        свободным мастерам пакета; total_cost считается только по записанным
+        назначениям.
+        """
+        now = datetime.now()
+        date = date or now
+        day = datetime.combine(date.date(), datetime.min.time())
+        not_before = now.time() if date.date() == now.date() else None
+        
+        jobs = self.load_pending_jobs(city)
+        masters = self.load_masters(city, day)
+        result = dispatch_batch(jobs, masters)
+        
+        cursor = self.db.cursor()
+        if not self.db.in_transaction:
+            cursor.execute("BEGIN")
+        try:
+            failed = []
+            for job_id, master_id in list(result.assignments.items()):
+                if not self._book_assignment(job_id, master_id, day, not_before):
+                    del result.assignments[job_id]
+                    del result.costs[job_id]
+                    failed.append(job_id)
+            
+            # Повторное предложение: мастер по-прежнему берёт не больше одного заказа пакета
+            for job_id in failed:
+                taken = set(result.assignments.values())
+                for cost, master_id in result.alternatives.get(job_id, []):
+                    if master_id not in taken and self._book_assignment(job_id, master_id, day, not_before):
+                        result.assignments[job_id] = master_id
+                        result.costs[job_id] = cost
+                        break
+                else:
+                    result.unassigned.append(job_id)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        
+        result.total_cost = sum(result.costs.values())
+        print(f"✅ Пакет {city}: {len(result.assignments)} назначено, {len(result.unassigned)} без мастера, "
+              f"стоимость {result.total_cost:.1f} (жадно {result.greedy_cost:.1f})")
+        return result
+
+
+def _random_problem(jobs_count: int, masters_count: int, seed: int = 3) -> Tuple[List[PendingJob], List[MasterOption]]:
+    """Случайные заказы и мастера в пределах Калининграда"""
+    import random
+    
+    rng = random.Random(seed)
+    categories = ["electrical", "plumbing", "appliance", "general"]
+    
+    def point():
+        return 54.65 + rng.random() * 0.12, 20.40 + rng.random() * 0.22
+    
+    jobs = [PendingJob(job_id, rng.choice(categories), *point()) for job_id in range(1, jobs_count + 1)]
+    masters = [
+        MasterOption(
+            master_id,
+            rng.sample(categories, rng.randint(1, 2)),
+            round(3.5 + rng.random() * 1.5, 1),
+            rng.randint(0, 4),
+            *point()
+        )
+        for master_id in range(1, masters_count + 1)
+    ]
+    return jobs, masters
+
+
+def _check_against_brute_force(rounds: int = 200):
+    """Сверка с перебором всех назначений на маленьких задачах"""
+    import itertools
+    
+    for seed in range(rounds):
+        jobs, masters = _random_problem(4, 6, seed)
+        matrix = build_cost_matrix(jobs, masters, candidates_per_job=len(masters))
+        choice, _ = solve_assignment(matrix)
+        
+        best_count, best_cost = 0, 0.0
+        for perm in itertools.permutations(list(range(len(masters))) + [None] * len(jobs), len(jobs)):
+            costs = dict()
+            if len({m for m in perm if m is not None}) != sum(1 for m in perm if m is not None):
+                continue
+            ok = True
+            for job, master in enumerate(perm):
+                if master is None:
+                    continue
+                costs[job] = next((cost for cost, index in matrix[job] if index == master), None)
+                if costs[job] is None:
+                    ok = False
+                    break
+            if not ok:
+                continue
+            count, cost = len(costs), sum(costs.values())
+            if count > best_count or (count == best_count and cost < best_cost - 1e-9):
+                best_count, best_cost = count, cost
+        
+        assert sum(1 for m in choice if m is not None) == best_count
+        assert abs(_total_cost(matrix, choice) - best_cost) < 1e-6, (seed, choice)
+    
+    print(f"✅ Назначения совпали с перебором на {rounds} задачах")
+
+
+def _check_dispatch_db():
+    """Пакет берёт заказы только своего города и бронирует слоты мастеров"""
+    import sqlite3
+    from schedule_manager import DaySchedule, TimeSlot, _create_test_masters
+    from datetime import time
+    
+    conn = sqlite3.connect(":memory:")
+    _create_test_masters(conn, 2, city="Калининград")
+    conn.execute(
+        "INSERT INTO masters (full_name, phone, specializations, city) VALUES ('Москвич', '+79990000000', '[\"electrical\"]', 'Москва')"
+    )
+    # Колонки координат и города в рабочей БД добавляет init_database в main.py
+    conn.execute("ALTER TABLE masters ADD COLUMN base_lat REAL")
+    conn.execute("ALTER TABLE masters ADD COLUMN base_lon REAL")
+    conn.execute("""
+        CREATE TABLE jobs (
+            id INTEGER PRIMARY KEY, category TEXT, status TEXT DEFAULT 'pending',
+            master_id INTEGER, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            city TEXT, address_lat REAL, address_lon REAL
+        )
+    """)
+    dispatcher = BatchDispatcher(conn)
+    
+    tomorrow = datetime.combine(datetime.now().date() + timedelta(days=1), time.min)
+    date_key = tomorrow.strftime("%Y-%m-%d")
+    for master_id in (1, 2, 3):
+        # Рабочее окно 9:00-11:00: при буфере на дорогу помещается один часовой заказ
+        dispatcher.schedule.set_master_schedule(master_id, {
+            date_key: DaySchedule(tomorrow, True, TimeSlot(time(9, 0), time(11, 0)), [])
+        })
+    conn.executemany(
+        "INSERT INTO jobs (id, category, city) VALUES (?, 'electrical', ?)",
+        [(1, "Калининград"), (2, "Калининград"), (3, "Калининград"), (4, "Москва")]
+    )
+    conn.commit()
+    
+    result = dispatcher.dispatch("Калининград", tomorrow)
+    assert set(result.assignments) | set(result.unassigned) == {1, 2, 3}, result
+    assert sorted(result.assignments.values()) == [1, 2], result
+    booked = conn.execute(
+        "SELECT DISTINCT job_id FROM master_slots WHERE job_id IS NOT NULL ORDER BY job_id"
+    ).fetchall()
+    assert [row[0] for row in booked] == sorted(result.assignments), booked
+    assert conn.execute("SELECT status FROM jobs WHERE id = 4").fetchone()[0] == "pending"
+    
+    # Следующий пакет видит мастеров занятыми
+    again = dispatcher.dispatch("Калининград", tomorrow)
+    assert not again.assignments and again.unassigned == result.unassigned, again
+    
+    # Ближний мастер выбран решателем, но часовой заказ в его окно 9:00-9:30 не помещается
+    day_after = tomorrow + timedelta(days=1)
+    day_key = day_after.strftime("%Y-%m-%d")
+    for master_id, end, lat, lon in ((1, time(9, 30), 54.71, 20.51), (2, time(11, 0), 54.75, 20.51)):
+        dispatcher.schedule.set_master_schedule(master_id, {
+            day_key: DaySchedule(day_after, True, TimeSlot(time(9, 0), end), [])
+        })
+        conn.execute("UPDATE masters SET base_lat = ?, base_lon = ? WHERE id = ?", (lat, lon, master_id))
+    conn.execute("UPDATE jobs SET status = 'cancelled' WHERE status = 'pending' AND city = 'Калининград'")
+    conn.execute("INSERT INTO jobs (id, category, city, address_lat, address_lon) VALUES (5, 'electrical', 'Калининград', 54.71, 20.51)")
+    conn.commit()
+    
+    near, far = dispatcher.load_masters("Калининград", day_after)
+    job = PendingJob(5, "electrical", 54.71, 20.51)
+    assert assignment_cost(job, near) < assignment_cost(job, far)
+    reoffered = dispatcher.dispatch("Калининград", day_after)
+    assert reoffered.assignments == {5: 2} and not reoffered.unassigned, reoffered
+    assert abs(reoffered.total_cost - assignment_cost(job, far)) < 1e-6, reoffered
+    
+    # Бронь не удалась ни у кого - стоимость пакета нулевая
+    conn.execute("UPDATE jobs SET status = 'pending', master_id = NULL WHERE id = 5")
+    conn.execute("UPDATE master_slots SET job_id = NULL WHERE date = ?", (day_key,))
+    conn.execute("DELETE FROM master_slots WHERE master_id = 2 AND date = ?", (day_key,))
+    conn.commit()
+    failed = dispatcher.dispatch("Калининград", day_after)
+    assert not failed.assignments and failed.unassigned == [5] and failed.total_cost == 0, failed
+    
+    window = BatchWindow(window_seconds=0)
+    window.job_received("Москва")
+    assert window.due_cities() == ["Москва"] and window.due_cities() == []
+    print("✅ Пакет: только заказы города, слоты забронированы, повторный пакет не назначает занятых")
+    print("✅ Неудавшаяся бронь: заказ ушёл следующему мастеру, стоимость - только по записанным назначениям")
+
+
+if __name__ == "__main__":
+    # Самопроверка и бенчмарк: python batch_dispatcher.py
+    _check_against_brute_force()
+    _check_dispatch_db()
+    
+    jobs, masters = _random_problem(500, 2000)
+    result = dispatch_batch(jobs, masters)
+    saving = (result.greedy_cost - result.total_cost) / result.greedy_cost * 100
+    print(f"✅ 500 заказов x 2000 мастеров за {result.elapsed_ms:.0f} мс "
+          f"(лимит {TIME_BUDGET_SECONDS:.0f} с, решено полностью: {result.optimal})")
+    print(f"✅ Стоимость: оптимально {result.total_cost:.1f}, жадно {result.greedy_cost:.1f} "
+          f"(-{saving:.1f}%), назначено {len(result.assignments)} / жадно {result.greedy_assigned}")
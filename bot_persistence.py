@@ -0,0 +1,369 @@
+"""
+Bot Persistence - SQLite storage for python-telegram-bot state
+Состояние диалогов и user_data/chat_data в SQLite: переживает перезапуск бота,
+пишутся только изменившиеся записи, пачкой в одной транзакции
+"""
+import os
+import time
+import json
+import pickle
+import asyncio
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, Optional, Set, Tuple
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+BOT_STATE_DB = os.getenv("BOT_STATE_DB", "bot_state.db")
+PERSISTENCE_UPDATE_INTERVAL = 5.0  # Как часто Application отдаёт изменения (сек); у PTB по умолчанию 60
+
+# Виды записей; для диалогов - "conversation:{имя ConversationHandler}"
+USER_DATA = "user_data"
+CHAT_DATA = "chat_data"
+BOT_DATA = "bot_data"
+CALLBACK_DATA = "callback_data"
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Persistence для Application на SQLite (WAL)
+    
+    - запись = (бот, вид, ключ) -> pickle; несколько ботов делят один файл
+    - update_* только складывают изменения в буфер: одинаковые с последней
+      записью данные отбрасываются, остальное пишется одной транзакцией в потоке
+    - lazy=True: user_data/chat_data читаются не при старте, а при первом
+      обновлении от пользователя/чата (refresh_*). Application.user_data тогда
+      содержит только тех, кто писал боту после запуска
+    """
+    
+    def __init__(
+        self,
+        db_path: str = BOT_STATE_DB,
+        namespace: str = "bot",
+        lazy: bool = True,
+        update_interval: float = PERSISTENCE_UPDATE_INTERVAL,
+        store_data: Optional[PersistenceInput] = None
+    ):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.db_path = db_path
+        self.namespace = namespace
+        self.lazy = lazy
+        
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._written: Dict[Tuple[str, str], int] = {}  # (вид, ключ) -> хэш последней записи
+        self._dirty: Dict[Tuple[str, str], Optional[bytes]] = {}  # None - удалить
+        self._loaded: Dict[str, Set[int]] = {USER_DATA: set(), CHAT_DATA: set()}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        
+        self.stats: Dict[str, int] = {"updates": 0, "unchanged": 0, "written": 0, "deleted": 0, "flushes": 0}
+    
+    # ==================== SQLITE ====================
+    
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")  # Сбой питания - потеря последней пачки, не порча
+            self._db.execute("PRAGMA busy_timeout=5000")  # Файл общий для ботов
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    namespace TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (namespace, kind, key)
+                ) WITHOUT ROWID
+            """)
+            self._db.commit()
+        return self._db
+    
+    def _load(self, kind: str, key: Optional[str] = None) -> Dict[str, Any]:
+        """Прочитать записи вида (или одну) и запомнить их хэши"""
+        query = "SELECT key, value FROM bot_state WHERE namespace = ? AND kind = ?"
+        params: Tuple = (self.namespace, kind)
+        if key is not None:
+            query += " AND key = ?"
+            params += (key,)
+        with self._db_lock:
+            rows = self._connection().execute(query, params).fetchall()
+        
+        result = {}
+        for row_key, blob in rows:
+            self._written.setdefault((kind, row_key), hash(blob))
+            result[row_key] = pickle.loads(blob)
+        return result
+    
+    def _write(self, batch: Dict[Tuple[str, str], Optional[bytes]]):
+        upserts = [(self.namespace, kind, key, blob) for (kind, key), blob in batch.items() if blob is not None]
+        deletes = [(self.namespace, kind, key) for (kind, key), blob in batch.items() if blob is None]
+        with self._db_lock:
+            db = self._connection()
+            with db:
+                db.executemany("""
+                    INSERT INTO bot_state (namespace, kind, key, value) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (namespace, kind, key) DO UPDATE
+                    SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+                """, upserts)
+                db.executemany("DELETE FROM bot_state WHERE namespace = ? AND kind = ? AND key = ?", deletes)
+        self.stats["written"] += len(upserts)
+        self.stats["deleted"] += len(deletes)
+        self.stats["flushes"] += 1
+    
+    # ==================== БУФЕР ИЗМЕНЕНИЙ ====================
+    
+    def _mark(self, kind: str, key: str, value: Any):
+        """Поставить запись в буфер, если она отличается от последней записанной"""
+        self.stats["updates"] += 1
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hash(blob)
+        if self._written.get((kind, key)) == digest:
+            self.stats["unchanged"] += 1
+            return
+        self._written[(kind, key)] = digest
+        self._dirty[(kind, key)] = blob
+        self._schedule_flush()
+    
+    def _drop(self, kind: str, key: str):
+        self._written.pop((kind, key), None)
+        self._dirty[(kind, key)] = None
+        self._schedule_flush()
+    
+    def _schedule_flush(self):
+        # Application вызывает update_* пачкой через gather - все они успеют
+        # попасть в буфер до того, как задача сброса получит управление
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_dirty())
+    
+    async def _flush_dirty(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            # Пока пачка пишется, задача не завершена и _schedule_flush новую не создаёт:
+            # накопившееся за это время пишем следующей пачкой
+            while self._dirty:
+                batch, self._dirty = self._dirty, {}
+                await asyncio.to_thread(self._write, batch)
+    
+    async def flush(self):
+        """Записать всё накопленное (Application вызывает при остановке)"""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush_dirty()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+        logger.info(f"📊 Persistence '{self.namespace}': {self.stats}")
+    
+    # ==================== ЧТЕНИЕ ====================
+    
+    async def _get_by_id(self, kind: str) -> Dict[int, Any]:
+        if self.lazy:
+            return {}
+        data = await asyncio.to_thread(self._load, kind)
+        self._loaded[kind].update(int(key) for key in data)
+        return {int(key): value for key, value in data.items()}
+    
+    async def get_user_data(self) -> Dict[int, Any]:
+        return await self._get_by_id(USER_DATA)
+    
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return await self._get_by_id(CHAT_DATA)
+    
+    async def get_bot_data(self) -> Any:
+        data = await asyncio.to_thread(self._load, BOT_DATA, "")
+        return data.get("", {})
+    
+    async def get_callback_data(self) -> Optional[Any]:
+        data = await asyncio.to_thread(self._load, CALLBACK_DATA, "")
+        return data.get("")
+    
+    async def get_conversations(self, name: str) -> Dict[Tuple, object]:
+        data = await asyncio.to_thread(self._load, f"conversation:{name}")
+        return {tuple(json.loads(key)): state for key, state in data.items()}
+    
+    async def _refresh_by_id(self, kind: str, item_id: int, data: Dict):
+        """Ленивая загрузка: при первом обновлении от пользователя/чата дописываем сохранённое"""
+        if not self.lazy or item_id in self._loaded[kind]:
+            return
+        self._loaded[kind].add(item_id)
+        stored = (await asyncio.to_thread(self._load, kind, str(item_id))).get(str(item_id))
+        if stored:
+            for field, value in stored.items():
+                data.setdefault(field, value)
+    
+    async def refresh_user_data(self, user_id: int, user_data: Dict):
+        await self._refresh_by_id(USER_DATA, user_id, user_data)
+    
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict):
+        await self._refresh_by_id(CHAT_DATA, chat_id, chat_data)
+    
+    async def refresh_bot_data(self, bot_data: Any):
+        pass
+    
+    # ==================== ЗАПИСЬ ====================
+    
+    async def _update_by_id(self, kind: str, item_id: int, data: Dict):
+        if self.lazy and item_id not in self._loaded[kind]:
+            # Данные тронули без обновления от этого пользователя - не затираем сохранённое
+            await self._refresh_by_id(kind, item_id, data)
+        self._mark(kind, str(item_id), data)
+    
+    async def update_user_data(self, user_id: int, data: Dict):
+        await self._update_by_id(USER_DATA, user_id, data)
+    
+    async def update_chat_data(self, chat_id: int, data: Dict):
+        await self._update_by_id(CHAT_DATA, chat_id, data)
+    
+    async def update_bot_data(self, data: Any):
+        self._mark(BOT_DATA, "", data)
+    
+    async def update_callback_data(self, data: Any):
+        self._mark(CALLBACK_DATA, "", data)
+    
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]):
+        row_key = json.dumps(list(key))
+        if new_state is None:
+            self._drop(f"conversation:{name}", row_key)
+        else:
+            self._mark(f"conversation:{name}", row_key, new_state)
+    
+    async def drop_user_data(self, user_id: int):
+        self._loaded[USER_DATA].discard(user_id)
+        self._drop(USER_DATA, str(user_id))
+    
+    async def drop_chat_data(self, chat_id: int):
+        self._loaded[CHAT_DATA].discard(chat_id)
+        self._drop(CHAT_DATA, str(chat_id))
+
+
+async def _check_flush_during_write():
+    """Изменение, пришедшее во время записи пачки, записывается без flush()"""
+    import tempfile
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        persistence = SQLitePersistence(f"{tmp}/state.db")
+        persistence._mark(USER_DATA, "1", {"step": 1})
+        await asyncio.sleep(0)  # Задача сброса ушла в поток с первой пачкой
+        persistence._mark(USER_DATA, "2", {"step": 1})
+        await persistence._flush_task
+        
+        stored = persistence._load(USER_DATA)
+        assert stored == {"1": {"step": 1}, "2": {"step": 1}}, stored
+        assert persistence.stats["flushes"] == 2 and not persistence._dirty
+        await persistence.flush()
+    print("✅ Изменение во время записи пачки записано следующей пачкой")
+
+
+async def _bench_persistence(users: int = 10000, active: int = 200, updates: int = 1000, interval_updates: int = 50):
+    """
+    Накладные расходы persistence на одно обновление: без persistence, PicklePersistence, SQLitePersistence
+    
+    В хранилище заранее лежат users пользователей; обновления приходят от active из них,
+    update_persistence - каждые interval_updates обновлений (как по таймеру update_interval).
+    """
+    import tempfile
+    from telegram import Update
+    from telegram.ext import Application, ConversationHandler, MessageHandler, PicklePersistence, filters
+    from bot_webhooks import FakeBotAPI
+    
+    api = FakeBotAPI()
+    api.start()
+    
+    async def step(update, context):
+        context.user_data["step"] = context.user_data.get("step", 0) + 1
+        context.user_data["text"] = update.message.text
+        return 1
+    
+    def stored_user(user_id: int) -> Dict[str, Any]:
+        return {"name": f"Клиент {user_id}", "phone": f"+7900{user_id:07d}", "problem": "Не работает розетка " * 5, "step": 0}
+    
+    def raw_update(i: int, user_id: int) -> Dict[str, Any]:
+        return {
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1, "date": 0, "text": f"ответ {i}",
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            },
+        }
+    
+    async def run(label: str, make_persistence) -> Dict[str, float]:
+        persistence = make_persistence()
+        builder = Application.builder().token("1:bench").base_url(f"{api.base}/bot").updater(None)
+        if persistence is not None:
+            builder = builder.persistence(persistence)
+        application = builder.build()
+        application.add_handler(ConversationHandler(
+            entry_points=[MessageHandler(filters.TEXT, step)],
+            states={1: [MessageHandler(filters.TEXT, step)]},
+            fallbacks=[],
+            name="bench",
+            persistent=persistence is not None
+        ))
+        
+        started = time.perf_counter()
+        await application.initialize()
+        startup = time.perf_counter() - started
+        
+        batch = [Update.de_json(raw_update(i, i % active), application.bot) for i in range(updates)]
+        started = time.perf_counter()
+        for i, update in enumerate(batch):
+            await application.process_update(update)
+            if persistence is not None and (i + 1) % interval_updates == 0:
+                await application.update_persistence()
+        await application.shutdown()  # Последний update_persistence и flush
+        elapsed = time.perf_counter() - started
+        return {"label": label, "startup_ms": startup * 1000, "per_update_us": elapsed / updates * 1e6}
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        pickle_path = f"{tmp}/state.pickle"
+        with open(pickle_path, "wb") as f:
+            pickle.dump({
+                "conversations": {}, "user_data": {u: stored_user(u) for u in range(users)},
+                "chat_data": {}, "bot_data": {}, "callback_data": None,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        
+        sqlite_path = f"{tmp}/state.db"
+        seed = SQLitePersistence(sqlite_path)
+        seed._write({
+            (USER_DATA, str(u)): pickle.dumps(stored_user(u), protocol=pickle.HIGHEST_PROTOCOL) for u in range(users)
+        })
+        
+        results = [
+            await run("без persistence", lambda: None),
+            await run("PicklePersistence", lambda: PicklePersistence(pickle_path, update_interval=3600)),
+        ]
+        sqlite = SQLitePersistence(sqlite_path, update_interval=3600)
+        results.append(await run("SQLitePersistence", lambda: sqlite))
+        
+        # Перезапуск: состояние диалога и user_data на месте
+        restarted = SQLitePersistence(sqlite_path)
+        conversations = await restarted.get_conversations("bench")
+        user_data: Dict[str, Any] = {"fresh": True}
+        await restarted.refresh_user_data(7, user_data)
+        await restarted.flush()
+        assert conversations[(7, 7)] == 1 and user_data["step"] == updates // active and user_data["fresh"]
+        assert user_data["name"] == "Клиент 7"
+    
+    api.stop()
+    
+    base = results[0]["per_update_us"]
+    print(f"📊 {updates} обновлений от {active} из {users} сохранённых пользователей, "
+          f"update_persistence каждые {interval_updates}")
+    for r in results:
+        print(f"✅ {r['label']:18}: старт {r['startup_ms']:7.1f} мс, {r['per_update_us']:8.0f} мкс/обновление "
+              f"(накладные {r['per_update_us'] - base:7.0f} мкс)")
+    print(f"✅ SQLite: {sqlite.stats}")
+
+
+if __name__ == "__main__":
+    # Проверка и бенчмарк: python bot_persistence.py
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(_check_flush_during_write())
+    asyncio.run(_bench_persistence())
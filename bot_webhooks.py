@@ -0,0 +1,520 @@
+"""
+Bot Webhooks - единый ASGI-приёмник обновлений для всех Telegram-ботов
+Один процесс и общий пул соединений вместо отдельного run_polling на каждого бота
+"""
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import secrets
+import importlib
+import threading
+import http.client
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+from dotenv import load_dotenv
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")  # Публичный адрес сервиса, например https://example.com
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+WEBHOOK_PATH_PREFIX = "/telegram"  # Обновления приходят на {TELEGRAM_WEBHOOK_URL}/telegram/{bot}
+WEBHOOK_MAX_CONNECTIONS = 40  # Параллельных доставок от Telegram на бота
+MAX_UPDATE_SIZE = 1024 * 1024  # Больше Telegram не присылает
+BOT_API_POOL_SIZE = 64  # Общий пул соединений к Bot API на всех ботов
+BOT_API_TIMEOUT = 10.0
+
+# Боты на python-telegram-bot 20 (build_application в модуле бота) и переменная с токеном.
+# Лид-бот (telegram_lead_bot.py) ещё на Updater из v13, промо-бот - отдельный проект:
+# они остаются на polling, пока не переедут на Application.
+WEBHOOK_BOTS: Dict[str, Tuple[str, str]] = {
+    "client": ("telegram_client_bot", "TELEGRAM_CLIENT_BOT_TOKEN"),
+    "master": ("telegram_master_bot", "TELEGRAM_MASTER_BOT_TOKEN"),
+}
+
+
+class BotWebhookApp:
+    """
+    ASGI-приложение: принимает POST {prefix}/{bot} и кладёт обновление
+    в update_queue нужного Application
+    
+    Работает самостоятельно (uvicorn bot_webhooks:...) или смонтированным
+    в FastAPI из main.py - тогда startup/shutdown вызывает родитель.
+    """
+    
+    def __init__(self, applications: Dict[str, Application], webhook_url: str = "", secret: str = ""):
+        self.applications = applications
+        self.webhook_url = webhook_url.rstrip("/")
+        # Без секрета принимается любой POST. Если адрес регистрируем сами, а секрет
+        # не задан - придумываем на время процесса; без адреса startup откажется стартовать
+        self.secret_configured = bool(secret)
+        self.secret = secret or secrets.token_urlsafe(32)
+        self.received: Dict[str, int] = defaultdict(int)
+        self.rejected = 0
+        self._started = False
+    
+    def webhook_for(self, name: str) -> str:
+        return f"{self.webhook_url}{WEBHOOK_PATH_PREFIX}/{name}"
+    
+    async def startup(self):
+        """Запустить все Application и зарегистрировать webhook'и"""
+        if self._started:
+            return
+        if not self.webhook_url and not self.secret_configured:
+            raise RuntimeError(
+                "TELEGRAM_WEBHOOK_SECRET не задан: webhook'и без TELEGRAM_WEBHOOK_URL регистрируются "
+                "вручную, и без общего секрета приложение принимало бы чужие обновления"
+            )
+        for name, application in self.applications.items():
+            await application.initialize()
+            if application.post_init:
+                await application.post_init(application)
+            await application.start()
+            logger.info(f"✅ Бот '{name}' запущен в режиме webhook")
+        
+        # Рассылка мастерам из клиентского бота идёт через того же мастер-бота и его HTTP-клиент
+        if "master" in self.applications:
+            import master_notification
+            import telegram_master_bot
+            master_notification.use_shared_clients(
+                self.applications["master"].bot, telegram_master_bot.get_api_client()
+            )
+        
+        if self.webhook_url:
+            for name, application in self.applications.items():
+                await application.bot.set_webhook(
+                    url=self.webhook_for(name),
+                    secret_token=self.secret,
+                    allowed_updates=Update.ALL_TYPES,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS
+                )
+                logger.info(f"✅ Webhook бота '{name}': {self.webhook_for(name)}")
+        else:
+            logger.warning("⚠️ TELEGRAM_WEBHOOK_URL не задан - webhook'и нужно зарегистрировать вручную с TELEGRAM_WEBHOOK_SECRET")
+        self._started = True
+    
+    async def shutdown(self):
+        """Остановить все Application (webhook'и не снимаем - Telegram подержит обновления)"""
+        if not self._started:
+            return
+        for application in self.applications.values():
+            await application.stop()
+        for application in self.applications.values():
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+        self._started = False
+        logger.info(f"📊 Webhook: получено {dict(self.received)}, отклонено {self.rejected}")
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        
+        if scope["method"] != "POST":
+            await self._respond(send, 405, b'{"ok":false}')
+            return
+        
+        # Имя бота - последний сегмент пути (работает и при монтировании в FastAPI)
+        name = scope["path"].rstrip("/").rsplit("/", 1)[-1]
+        application = self.applications.get(name)
+        if application is None:
+            await self._respond(send, 404, b'{"ok":false}')
+            return
+        
+        headers = dict(scope["headers"])
+        token = headers.get(b"x-telegram-bot-api-secret-token", b"").decode("latin-1")
+        if not secrets.compare_digest(token, self.secret):
+            self.rejected += 1
+            await self._respond(send, 403, b'{"ok":false}')
+            return
+        
+        body = await self._read_body(receive)
+        if body is None:
+            self.rejected += 1
+            await self._respond(send, 413, b'{"ok":false}')
+            return
+        
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            self.rejected += 1
+            logger.warning(f"⚠️ Некорректное обновление для '{name}': {e}")
+            await self._respond(send, 400, b'{"ok":false}')
+            return
+        
+        # Обработка идёт в цикле Application; Telegram сразу получает 200
+        await application.update_queue.put(update)
+        self.received[name] += 1
+        await self._respond(send, 200, b'{"ok":true}')
+    
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    logger.error(f"❌ Не удалось запустить ботов: {e}")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    
+    @staticmethod
+    async def _read_body(receive) -> Optional[bytes]:
+        chunks: List[bytes] = []
+        size = 0
+        while True:
+            message = await receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > MAX_UPDATE_SIZE:
+                return None
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+    
+    @staticmethod
+    async def _respond(send, status: int, body: bytes):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def create_webhook_app(
+    base_url: Optional[str] = None,
+    webhook_url: Optional[str] = None,
+    secret: Optional[str] = None
+) -> BotWebhookApp:
+    """
+    Собрать Application всех ботов с токенами в окружении
+    
+    Все боты ходят в Bot API через один HTTPXRequest (общий пул соединений),
+    а кэш профилей мастеров и HTTP-клиент к API общие, потому что живут в одном процессе.
+    """
+    shared_request = HTTPXRequest(
+        connection_pool_size=BOT_API_POOL_SIZE,
+        read_timeout=BOT_API_TIMEOUT,
+        write_timeout=BOT_API_TIMEOUT,
+        connect_timeout=BOT_API_TIMEOUT,
+        pool_timeout=BOT_API_TIMEOUT
+    )
+    
+    applications: Dict[str, Application] = {}
+    for name, (module_name, token_env) in WEBHOOK_BOTS.items():
+        token = os.getenv(token_env, "")
+        if not token:
+            logger.warning(f"⚠️ {token_env} не установлен - бот '{name}' пропущен")
+            continue
+        
+        builder = Application.builder().token(token).request(shared_request).updater(None)
+        if base_url:
+            builder = builder.base_url(base_url)
+        module = importlib.import_module(module_name)
+        applications[name] = module.build_application(builder)
+    
+    return BotWebhookApp(
+        applications,
+        webhook_url=TELEGRAM_WEBHOOK_URL if webhook_url is None else webhook_url,
+        secret=TELEGRAM_WEBHOOK_SECRET if secret is None else secret
+    )
+
+
+# ==================== БЕНЧМАРК: WEBHOOK vs POLLING ====================
+
+class FakeBotAPI:
+    """
+    Локальная заглушка Telegram Bot API для бенчмарков
+    
+    Понимает getMe, getUpdates (long polling), setWebhook/deleteWebhook и любые send*;
+    при зарегистрированном webhook сама доставляет обновления POST-запросами, как Telegram.
+    Заодно отвечает 404 на /api/v1/masters/by-telegram/{id} вместо API платформы.
+    """
+    
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        api = self
+        self.updates: Dict[str, List[dict]] = defaultdict(list)  # token -> ожидающие getUpdates
+        self.webhooks: Dict[str, Tuple[str, str]] = {}  # token -> (url, secret)
+        self.calls: Dict[str, int] = defaultdict(int)  # метод -> число вызовов
+        self.injected_at: Dict[int, float] = {}  # chat_id -> когда пришло обновление
+        self.replied_at: Dict[int, float] = {}  # chat_id -> когда бот ответил
+        self._changed = threading.Condition()
+        self._next_update_id = 1
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+            
+            def log_message(self, *args):
+                pass
+            
+            def _reply(self, status: int, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def do_GET(self):
+                self._dispatch({})
+            
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(raw or b"{}")
+                else:
+                    params = {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+                self._dispatch(params)
+            
+            def _dispatch(self, params: dict):
+                if self.path.startswith("/api/v1/masters/by-telegram/"):
+                    self._reply(404, {"detail": "Master not found"})
+                    return
+                _, token, method = self.path.split("/", 2)
+                self._reply(200, {"ok": True, "result": api.call(token[len("bot"):], method, params)})
+        
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._server.handle_error = lambda request, address: None  # Обрывы long polling при остановке ботов
+        self.base = f"http://{host}:{self._server.server_address[1]}"
+        self._deliveries: Dict[str, queue.Queue] = {}
+    
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    
+    def stop(self):
+        self._server.shutdown()
+    
+    def call(self, token: str, method: str, params: dict):
+        self.calls[method] += 1
+        if method == "getMe":
+            return {"id": abs(hash(token)) % 10**9, "is_bot": True, "first_name": token, "username": f"{token.split(':')[-1]}_bot"}
+        if method == "setWebhook":
+            with self._changed:
+                self.webhooks[token] = (params["url"], params.get("secret_token", ""))
+            return True
+        if method == "deleteWebhook":
+            with self._changed:
+                self.webhooks.pop(token, None)
+            return True
+        if method == "getUpdates":
+            offset = int(params.get("offset", 0))
+            with self._changed:
+                pending = [u for u in self.updates[token] if u["update_id"] >= offset]
+                self.updates[token] = pending
+                if not pending:
+                    self._changed.wait(float(params.get("timeout", 0)))
+                    pending = [u for u in self.updates[token] if u["update_id"] >= offset]
+                return pending
+        if method.startswith("send"):
+            chat_id = int(params["chat_id"])
+            self.replied_at[chat_id] = time.perf_counter()
+            return {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        return True
+    
+    def inject(self, token: str, chat_id: int, text: str = "/start"):
+        """Пользователь пишет боту: через webhook, если он есть, иначе в очередь getUpdates"""
+        with self._changed:
+            update = {
+                "update_id": self._next_update_id,
+                "message": {
+                    "message_id": self._next_update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+                    "text": text,
+                    "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else [],
+                },
+            }
+            self._next_update_id += 1
+            self.injected_at[chat_id] = time.perf_counter()
+            webhook = self.webhooks.get(token)
+            if webhook is None:
+                self.updates[token].append(update)
+                self._changed.notify_all()
+                return
+        self._delivery_queue(token, webhook).put(update)
+    
+    def _delivery_queue(self, token: str, webhook: Tuple[str, str]) -> queue.Queue:
+        if token not in self._deliveries:
+            self._deliveries[token] = queue.Queue()
+            threading.Thread(target=self._deliver, args=(self._deliveries[token], webhook), daemon=True).start()
+        return self._deliveries[token]
+    
+    @staticmethod
+    def _deliver(updates: queue.Queue, webhook: Tuple[str, str]):
+        """Доставка одному боту по keep-alive соединению, как делает Telegram"""
+        url, secret = webhook
+        parts = urlsplit(url)
+        connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=10)
+        while True:
+            body = json.dumps(updates.get()).encode()
+            connection.request("POST", parts.path, body, {
+                "Content-Type": "application/json",
+                "X-Telegram-Bot-Api-Secret-Token": secret,
+            })
+            connection.getresponse().read()
+
+
+def _process_memory(pid: int) -> Tuple[float, float]:
+    """RSS и пиковый RSS процесса в МБ (Linux, /proc)"""
+    values = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                key, value = line.split(":")
+                values[key] = int(value.split()[0]) / 1024
+    return values["VmRSS"], values["VmHWM"]
+
+
+def _bench_child(mode: str, base: str, arg: str):
+    """Процесс бота для бенчмарка: polling одного бота или webhook-раннер всех"""
+    logging.basicConfig(level=logging.WARNING)
+    if mode == "polling":
+        module_name, token_env = WEBHOOK_BOTS[arg]
+        module = importlib.import_module(module_name)
+        logging.getLogger().setLevel(logging.WARNING)
+        builder = Application.builder().token(os.environ[token_env]).base_url(f"{base}/bot")
+        module.build_application(builder).run_polling(allowed_updates=Update.ALL_TYPES)
+    else:
+        import uvicorn
+        
+        app = create_webhook_app(base_url=f"{base}/bot", webhook_url=f"http://127.0.0.1:{arg}")
+        logging.getLogger().setLevel(logging.WARNING)
+        uvicorn.run(app, host="127.0.0.1", port=int(arg), log_level="warning")
+
+
+def _bench_webhook_vs_polling(updates: int = 400, rate: float = 100.0, idle: float = 2.0):
+    """
+    Память и задержка update -> ответ бота: polling (процесс на бота) против одного webhook-процесса
+    
+    Боты настоящие (build_application из модулей), Bot API и API платформы - FakeBotAPI.
+    Нагрузка - /start по очереди в клиентский и мастер-бот с новых chat_id.
+    """
+    import signal
+    import subprocess
+    import tempfile
+    
+    api = FakeBotAPI()
+    api.start()
+    state_dir = tempfile.TemporaryDirectory()
+    tokens = {"client": "1001:client", "master": "1002:master"}
+    env = {
+        **os.environ,
+        "TELEGRAM_CLIENT_BOT_TOKEN": tokens["client"],
+        "TELEGRAM_MASTER_BOT_TOKEN": tokens["master"],
+        "API_URL": api.base,
+        # Состояние ботов и очередь заявок - во временный каталог, не в рабочие файлы
+        "BOT_STATE_DB": os.path.join(state_dir.name, "bot_state.db"),
+        "ORDER_QUEUE_DB": os.path.join(state_dir.name, "order_queue.db"),
+    }
+    
+    def spawn(*args) -> subprocess.Popen:
+        return subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--bench-child", *args],
+            env=env, stdout=subprocess.DEVNULL
+        )
+    
+    def wait_for(condition, timeout: float = 30.0):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                raise TimeoutError("Боты не ответили вовремя")
+            time.sleep(0.05)
+    
+    def run(mode: str, processes: List[subprocess.Popen], ready) -> dict:
+        try:
+            wait_for(ready)
+            time.sleep(idle)
+            rss_idle = sum(_process_memory(p.pid)[0] for p in processes)
+            polls = api.calls["getUpdates"]
+            
+            chat_base = 10**6 * (len(api.injected_at) // 10**6 + 1)
+            started = time.perf_counter()
+            for i in range(updates):
+                bot = "client" if i % 2 == 0 else "master"
+                api.inject(tokens[bot], chat_base + i)
+                time.sleep(max(0.0, started + (i + 1) / rate - time.perf_counter()))
+            chats = range(chat_base, chat_base + updates)
+            wait_for(lambda: all(c in api.replied_at for c in chats))
+            
+            polls = api.calls["getUpdates"] - polls
+            latencies = sorted((api.replied_at[c] - api.injected_at[c]) * 1000 for c in chats)
+            memory = [_process_memory(p.pid) for p in processes]
+        finally:
+            for p in processes:
+                p.send_signal(signal.SIGINT)
+            for p in processes:
+                try:
+                    p.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    p.kill()
+        
+        def percentile(q: float) -> float:
+            return latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+        
+        return {
+            "mode": mode,
+            "processes": len(processes),
+            "rss_idle": rss_idle,
+            "rss": sum(m[0] for m in memory),
+            "rss_peak": sum(m[1] for m in memory),
+            "polls": polls,
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+        }
+    
+    results = []
+    
+    polling = [spawn("polling", api.base, name) for name in tokens]
+    results.append(run("polling", polling, lambda: api.calls["getUpdates"] >= len(tokens)))
+    
+    port = 18000 + os.getpid() % 1000
+    webhook = [spawn("webhook", api.base, str(port))]
+    results.append(run("webhook", webhook, lambda: len(api.webhooks) == len(tokens)))
+    
+    api.stop()
+    state_dir.cleanup()
+    
+    print(f"📊 {updates} обновлений /start ({rate:.0f}/с), боты: {', '.join(tokens)}")
+    for r in results:
+        print(f"✅ {r['mode']:8} процессов {r['processes']}: RSS {r['rss_idle']:.0f} МБ в простое, "
+              f"{r['rss']:.0f} МБ после нагрузки (пик {r['rss_peak']:.0f}); "
+              f"запросов getUpdates {r['polls']}; "
+              f"задержка p50 {r['p50']:.1f} мс, p95 {r['p95']:.1f} мс, p99 {r['p99']:.1f} мс")
+    per_process = results[0]["rss"] / results[0]["processes"]
+    print(f"✅ На каждого бота на polling - отдельный процесс ~{per_process:.0f} МБ; "
+          f"webhook экономит {results[0]['rss'] - results[1]['rss']:.0f} МБ на {len(tokens)} ботах")
+
+
+if __name__ == "__main__":
+    if "--bench-child" in sys.argv:
+        _bench_child(*sys.argv[sys.argv.index("--bench-child") + 1:][:3])
+    elif "--bench" in sys.argv:
+        # Бенчмарк: python bot_webhooks.py --bench
+        _bench_webhook_vs_polling()
+    else:
+        import uvicorn
+        
+        logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+        uvicorn.run(create_webhook_app(), host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
@@ -3,12 +3,45 @@ Conversation Manager - AI-powered conversation system
 Управление AI-диалогами с клиентами и мастерами
 """
 import json
+import re
 import uuid
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 from enum import Enum
 
 
+# Телефон в любом написании: +7 900 123-45-67, 8 (900) 1234567 ...
+PHONE_PATTERN = re.compile(r'\+?\d(?:[\s\-()]*\d){6,}')
+SEARCH_MAX_LIMIT = 100
+# bm25 считается только по последним N совпадениям: частые слова
+# встречаются в сотнях тысяч сообщений, а сотрудникам важны свежие диалоги.
+# Если совпадений больше, поиск сообщает truncated - запрос стоит уточнить
+SEARCH_RANK_WINDOW = 2000
+
+
+def normalize_phones(text: str) -> List[str]:
+    """Телефоны из текста в едином виде (последние 10 цифр)"""
+    phones = []
+    for match in PHONE_PATTERN.findall(text or ""):
+        digits = re.sub(r'\D', '', match)
+        phones.append(digits[-10:])
+    return phones
+
+
+def build_search_query(query: str) -> Optional[str]:
+    """Собрать безопасное FTS5-выражение из пользовательского запроса"""
+    phones = normalize_phones(query)
+    words = re.findall(r'\w+', PHONE_PATTERN.sub(' ', query).lower())
+    
+    # Каждый терм в кавычках - синтаксис FTS5 из запроса не исполняется
+    terms = [f'content : "{word}"' for word in words]
+    terms += [f'phones : "{phone}"' for phone in phones]
+    
+    if not terms:
+        return None
+    return " AND ".join(terms)
+
+
 class ConversationType(str, Enum):
     """Типы разговоров"""
     CLIENT_REQUEST = "client_request"
@@ -164,6 +197,68 @@ class ConversationManager:
             )
         """)
         self.db.commit()
+        self._init_messages_search()
+    
+    def _init_messages_search(self):
+        """Хранилище сообщений + FTS5-индекс, синхронизируемый триггерами"""
+        cursor = self.db.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                phones TEXT,
+                created_at TIMESTAMP,
+                UNIQUE (conversation_id, seq),
+                FOREIGN KEY (conversation_id) REFERENCES conversations(id)
+            )
+        """)
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS conversation_messages_fts USING fts5(
+                content,
+                phones,
+                content='conversation_messages',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        
+        # Триггеры держат индекс в актуальном состоянии
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS conversation_messages_ai
+            AFTER INSERT ON conversation_messages BEGIN
+                INSERT INTO conversation_messages_fts (rowid, content, phones)
+                VALUES (new.id, new.content, new.phones);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS conversation_messages_ad
+            AFTER DELETE ON conversation_messages BEGIN
+                INSERT INTO conversation_messages_fts (conversation_messages_fts, rowid, content, phones)
+                VALUES ('delete', old.id, old.content, old.phones);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS conversation_messages_au
+            AFTER UPDATE ON conversation_messages BEGIN
+                INSERT INTO conversation_messages_fts (conversation_messages_fts, rowid, content, phones)
+                VALUES ('delete', old.id, old.content, old.phones);
+                INSERT INTO conversation_messages_fts (rowid, content, phones)
+                VALUES (new.id, new.content, new.phones);
+            END
+        """)
+        self.db.commit()
+        
+        # Миграция: перенести сообщения из messages_json, если хранилище пустое
+        cursor.execute("SELECT 1 FROM conversation_messages LIMIT 1")
+        if cursor.fetchone() is None:
+            cursor.execute("SELECT id, messages_json FROM conversations WHERE messages_json IS NOT NULL")
+            for conversation_id, messages_json in cursor.fetchall():
+                messages = [Message.from_dict(msg) for msg in json.loads(messages_json)]
+                self._save_messages(conversation_id, messages)
+            self.db.commit()
     
     def create_conversation(
         self,
@@ -246,9 +341,96 @@ class ConversationManager:
             conversation.created_at.isoformat(),
             conversation.completed_at.isoformat() if conversation.completed_at else None
         ))
+        self._save_messages(conversation.id, conversation.messages)
         
         self.db.commit()
     
+    def _save_messages(self, conversation_id: str, messages: List[Message]):
+        """Записать новые сообщения в хранилище (уже сохранённые пропускаются)"""
+        cursor = self.db.cursor()
+        cursor.executemany("""
+            INSERT OR IGNORE INTO conversation_messages (
+                conversation_id, seq, role, content, phones, created_at
+            ) VALUES (?, ?, ?, ?, ?, ?)
+        """, [
+            (
+                conversation_id,
+                seq,
+                msg.role,
+                msg.content,
+                " ".join(normalize_phones(msg.content)),
+                msg.timestamp.isoformat()
+            )
+            for seq, msg in enumerate(messages)
+        ])
+    
+    def search_messages(self, query: str, limit: int = 20, offset: int = 0) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        Полнотекстовый поиск по сообщениям разговоров
+        
+        Результаты отсортированы по релевантности (bm25) среди последних
+        SEARCH_RANK_WINDOW совпадений, совпадения в snippet выделены тегами <b></b>.
+        
+        Returns:
+            (результаты, truncated): truncated - совпадений больше SEARCH_RANK_WINDOW,
+            более старые не ранжировались и страницы за окном пусты
+        """
+        match = build_search_query(query)
+        if not match:
+            return [], False
+        
+        limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+        offset = max(0, offset)
+        
+        cursor = self.db.cursor()
+        # Первое совпадение за окном: есть - ранжируем только более свежие
+        cursor.execute("""
+            SELECT rowid FROM conversation_messages_fts
+            WHERE conversation_messages_fts MATCH ?
+            ORDER BY rowid DESC
+            LIMIT 1 OFFSET ?
+        """, (match, SEARCH_RANK_WINDOW))
+        outside = cursor.fetchone()
+        window_start = outside[0] if outside else 0
+        
+        cursor.execute("""
+            SELECT
+                m.conversation_id, m.seq, m.role, m.created_at,
+                s.snippet, s.rank,
+                c.type, c.channel, c.participant_name, c.participant_phone
+            FROM (
+                SELECT
+                    rowid,
+                    snippet(conversation_messages_fts, 0, '<b>', '</b>', '…', 16) AS snippet,
+                    rank
+                FROM conversation_messages_fts
+                WHERE conversation_messages_fts MATCH ?
+                AND rowid > ?
+                ORDER BY rank
+                LIMIT ? OFFSET ?
+            ) s
+            JOIN conversation_messages m ON m.id = s.rowid
+            LEFT JOIN conversations c ON c.id = m.conversation_id
+            ORDER BY s.rank
+        """, (match, window_start, limit, offset))
+        
+        results = [
+            {
+                "conversation_id": row[0],
+                "message_index": row[1],
+                "role": row[2],
+                "timestamp": row[3],
+                "snippet": row[4],
+                "rank": row[5],
+                "conversation_type": row[6],
+                "channel": row[7],
+                "participant_name": row[8],
+                "participant_phone": row[9]
+            }
+            for row in cursor.fetchall()
+        ]
+        return results, outside is not None
+    
     def _row_to_conversation(self, row) -> Conversation:
         """Преобразовать строку БД в объект Conversation"""
         return Conversation.from_dict({
@@ -361,3 +543,74 @@ class MasterOnboardingConversation:
     def is_complete(self) -> bool:
         """Проверка, собрана ли вся необходимая информация"""
         return all(field in self.extracted for field in self.required_fields)
+
+
+if __name__ == "__main__":
+    # Бенчмарк полнотекстового поиска: python conversation_manager.py [кол-во сообщений]
+    import os
+    import random
+    import sqlite3
+    import sys
+    import tempfile
+    import time
+    
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    # Словарь с распределением Ципфа, как в живой переписке:
+    # предметные слова разбросаны по рангам частотности среди 20 000 прочих
+    domain_words = (
+        "не работает розетка искрит выключатель автомат выбивает щиток люстра "
+        "проводка замена установка кухня гостиная спальня ванная бойлер смеситель "
+        "течёт кран унитаз стиральная машина холодильник срочно завтра вечером "
+        "адрес улица ленина невского проспект мира дом квартира подъезд этаж"
+    ).split()
+    vocabulary = [f"слово{i}" for i in range(20_000)]
+    for rank, word in enumerate(domain_words):
+        vocabulary.insert(5 + rank * 7, word)
+    cum_weights = []
+    acc = 0.0
+    for rank in range(len(vocabulary)):
+        acc += 1.0 / (rank + 1)
+        cum_weights.append(acc)
+    
+    db_path = os.path.join(tempfile.mkdtemp(), "fts_bench.db")
+    conn = sqlite3.connect(db_path)
+    manager = ConversationManager(conn)
+    
+    print(f"⏳ Генерация {total:,} сообщений...")
+    started = time.perf_counter()
+    rng = random.Random(42)
+    batch = []
+    for i in range(total):
+        content = " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(5, 25)))
+        if i % 50 == 0:
+            content += f" тел +7 9{rng.randint(0, 10**9 - 1):09d}"
+        batch.append((f"conv-{i // 20}", i % 20, "user", content, " ".join(normalize_phones(content)), None))
+        if len(batch) == 50_000:
+            conn.executemany("""
+                INSERT INTO conversation_messages (conversation_id, seq, role, content, phones, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, batch)
+            batch.clear()
+    if batch:
+        conn.executemany("""
+            INSERT INTO conversation_messages (conversation_id, seq, role, content, phones, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, batch)
+    conn.commit()
+    conn.execute("INSERT INTO conversation_messages_fts (conversation_messages_fts) VALUES ('optimize')")
+    conn.commit()
+    print(f"✅ Индекс построен за {time.perf_counter() - started:.1f} с")
+    
+    queries = ["искрит розетка", "бойлер течёт", "невского квартира", "+7 (900) 123-45-67", "срочно люстра вечером"]
+    for query in queries:
+        timings = []
+        for page in range(5):
+            started = time.perf_counter()
+            results, truncated = manager.search_messages(query, limit=20, offset=page * 20)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        status = "✅" if timings[-1] < 50 else "⚠️"
+        print(f"{status} '{query}': медиана {timings[2]:.1f} мс, максимум {timings[-1]:.1f} мс"
+              f"{', ранжировано только окно свежих' if truncated else ''}")
+    
+    conn.close()
@@ -0,0 +1,135 @@
+"""
+Geocoder - Address to coordinates for dispatch and routes
+Координаты адресов заказов и баз мастеров: Яндекс Геокодер, если задан ключ,
+иначе OpenStreetMap Nominatim
+"""
+import os
+import logging
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+YANDEX_API_KEY = os.getenv("YANDEX_API_KEY", "")
+YANDEX_GEOCODER_URL = "https://geocode-maps.yandex.ru/1.x/"
+NOMINATIM_URL = os.getenv("NOMINATIM_URL", "https://nominatim.openstreetmap.org/search")
+GEOCODER_USER_AGENT = "BaltSetServicePlatform/1.0"  # Nominatim требует представиться
+GEOCODER_TIMEOUT = 5.0  # Заявка не должна долго ждать геокодера
+GEOCODER_CACHE_SIZE = 5000
+
+_http_client: Optional[httpx.AsyncClient] = None
+_cache: "OrderedDict[str, Optional[Tuple[float, float]]]" = OrderedDict()
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Общий HTTP-клиент геокодера"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=GEOCODER_TIMEOUT, headers={"User-Agent": GEOCODER_USER_AGENT})
+    return _http_client
+
+
+async def close_client():
+    """Закрыть HTTP-клиент при остановке приложения"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def _geocode_yandex(query: str) -> Optional[Tuple[float, float]]:
+    response = await get_http_client().get(YANDEX_GEOCODER_URL, params={
+        "apikey": YANDEX_API_KEY,
+        "geocode": query,
+        "format": "json",
+        "results": 1
+    })
+    response.raise_for_status()
+    members = response.json().get("response", {}).get("GeoObjectCollection", {}).get("featureMember", [])
+    if not members:
+        return None
+    pos = members[0].get("GeoObject", {}).get("Point", {}).get("pos", "").split()
+    if len(pos) != 2:
+        return None
+    lon, lat = float(pos[0]), float(pos[1])  # Яндекс отдаёт "долгота широта"
+    return lat, lon
+
+
+async def _geocode_nominatim(query: str) -> Optional[Tuple[float, float]]:
+    response = await get_http_client().get(NOMINATIM_URL, params={"q": query, "format": "json", "limit": 1})
+    response.raise_for_status()
+    data = response.json()
+    if not data:
+        return None
+    return float(data[0]["lat"]), float(data[0]["lon"])
+
+
+async def geocode_address(address: str, city: Optional[str] = None) -> Optional[Tuple[float, float]]:
+    """
+    (широта, долгота) адреса или None
+    
+    Ошибки сервиса не пробрасываются: заказ создаётся и без координат,
+    просто попадает в маршруте в "без координат".
+    """
+    query = f"{city}, {address}" if city and city.lower() not in address.lower() else address
+    key = " ".join(query.lower().split())
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+    
+    try:
+        coords = await (_geocode_yandex(query) if YANDEX_API_KEY else _geocode_nominatim(query))
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        logger.warning(f"⚠️ Геокодер не ответил для '{query}': {e}")
+        return None  # Сбой не кэшируем - следующая заявка попробует снова
+    
+    if coords is None:
+        logger.warning(f"⚠️ Координаты не найдены для '{query}'")
+    _cache[key] = coords
+    if len(_cache) > GEOCODER_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return coords
+
+
+async def _check_geocoder():
+    """Разбор ответов Яндекса и Nominatim, кэш и сбои (HTTP - httpx.MockTransport)"""
+    global _http_client, YANDEX_API_KEY
+    
+    requests = []
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        query = request.url.params.get("geocode") or request.url.params.get("q")
+        if "сбой" in query:
+            return httpx.Response(503)
+        if "нигде" in query:
+            return httpx.Response(200, json=[] if request.url.host.startswith("nominatim") else {
+                "response": {"GeoObjectCollection": {"featureMember": []}}
+            })
+        if request.url.host.startswith("nominatim"):
+            return httpx.Response(200, json=[{"lat": "54.7104", "lon": "20.5101"}])
+        return httpx.Response(200, json={"response": {"GeoObjectCollection": {"featureMember": [
+            {"GeoObject": {"Point": {"pos": "20.5101 54.7104"}}}
+        ]}}})
+    
+    _http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    for key in ("", "test-key"):
+        YANDEX_API_KEY = key
+        _cache.clear()
+        requests.clear()
+        assert await geocode_address("ул. Ленина, 1", "Калининград") == (54.7104, 20.5101)
+        assert await geocode_address("ул.  Ленина, 1", "Калининград") == (54.7104, 20.5101)
+        assert len(requests) == 1 and requests[0].url.params.get("q" if not key else "geocode") == "Калининград, ул. Ленина, 1"
+        assert await geocode_address("нигде", "Калининград") is None
+        assert await geocode_address("сбой", "Калининград") is None and "калининград, сбой" not in _cache
+    await close_client()
+    YANDEX_API_KEY = ""
+    print("✅ Геокодер: Яндекс и Nominatim разобраны, повтор из кэша, сбой -> None без кэширования")
+
+
+if __name__ == "__main__":
+    # Проверка: python geocoder.py
+    import asyncio
+    asyncio.run(_check_geocoder())
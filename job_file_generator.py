@@ -2,13 +2,80 @@
 Job File Generator - AI-powered work instructions generator
 Генератор файлов заказов с полными инструкциями для мастеров
 """
+import asyncio
+import hashlib
 import json
 import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Awaitable, Callable, Dict, List, Optional, Any, Tuple
 from dataclasses import dataclass, asdict
 from pathlib import Path
 
+try:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import simpleSplit
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfgen import canvas
+    REPORTLAB_AVAILABLE = True
+except ImportError:
+    REPORTLAB_AVAILABLE = False
+
+
+# Кэш диагнозов: похожие описания ("не работает розетка") не гоняем через AI повторно
+DIAGNOSIS_CACHE_TTL = 7 * 24 * 3600  # секунд
+DIAGNOSIS_CACHE_SIZE = 10000
+DIAGNOSIS_CACHE_VERSION = 1  # Поднять при смене промпта или модели
+DIAGNOSIS_SIMILARITY = 0.75  # Минимальное сходство Жаккара по шинглам
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16  # LSH: 16 полос по 4 значения
+SHINGLE_SIZE = 3
+AI_COST_PER_1K_TOKENS = 0.3  # ₽, оценка для отчёта об экономии
+
+# Конвейер генерации: этапы всех заказов делят общий лимит параллельности
+PIPELINE_CONCURRENCY = 64
+DB_THREADS = 4
+TIMINGS_HISTORY = 1000
+JOBS_QUERY_CHUNK = 500  # ID в одном IN (...) при пакетной генерации
+
+# Библиотека инструкций: сначала ищем готовые, AI - только если не нашли
+LIBRARY_CANDIDATES = 20
+LIBRARY_MIN_OVERLAP = 0.5  # Доля ключевых слов проблемы, найденных в инструкции
+LIBRARY_COMPOSE = 3  # Из скольких лучших инструкций собирать инструменты и материалы
+
+KEYWORD_STOPWORDS = frozenset({
+    "работает", "работают", "перестал", "перестала", "перестало", "сломался", "сломалась",
+    "нужно", "надо", "очень", "срочно", "помогите", "пожалуйста", "здравствуйте",
+    "квартире", "квартира", "доме", "после", "когда", "иногда", "сегодня", "вчера", "проблема"
+})
+
+# Префикс слова -> тег оборудования
+EQUIPMENT_TAGS = {
+    "розет": "розетка", "выключат": "выключатель", "автомат": "автомат", "щит": "щиток",
+    "светильн": "светильник", "люстр": "светильник", "лампа": "светильник", "провод": "проводка",
+    "кран": "кран", "смесит": "смеситель", "унитаз": "унитаз", "раковин": "раковина",
+    "труб": "труба", "бойлер": "водонагреватель", "водонагрев": "водонагреватель",
+    "стиральн": "стиральная машина", "посудомо": "посудомоечная машина",
+    "духов": "духовка", "плит": "плита", "холодильн": "холодильник"
+}
+
+# PDF: рендер в пуле процессов, кэш по хэшу содержимого
+PDF_FONT_PATH = os.getenv("PDF_FONT_PATH", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", "generated_pdfs")
+PDF_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+PDF_MAX_PENDING = 64  # Сколько рендеров может ждать пул, остальные ждут в event loop
+PDF_CHUNK_SIZE = 64 * 1024
+PDF_RENDER_VERSION = "1"  # Поднять при смене вёрстки - кэш перестроится
+
 
 @dataclass
 class WorkInstructions:
@@ -59,6 +126,7 @@ class JobFile:
     
     def to_text(self) -> str:
         """Текстовое представление для отправки мастеру"""
+        special_notes = f"📌 **ДОПОЛНИТЕЛЬНО:**\n{self.special_notes}" if self.special_notes else ""
         text = f"""
 🔧 **ЗАКАЗ #{self.job_id}**
 
@@ -100,7 +168,7 @@ class JobFile:
 
 📊 **СЛОЖНОСТЬ:** {self.work_instructions.difficulty_level.upper()}
 
-{f'📌 **ДОПОЛНИТЕЛЬНО:**\\n{self.special_notes}' if self.special_notes else ''}
+{special_notes}
 
 ---
 ✅ После выполнения работы примите оплату через терминал.
@@ -119,13 +187,462 @@ class JobFile:
         return "\n".join(f"{i+1}. {step}" for i, step in enumerate(steps))
 
 
+def normalize_description(text: str) -> str:
+    """Нормализация описания: регистр, ё, пунктуация, пробелы"""
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def _shingles(text: str) -> frozenset:
+    """Символьные шинглы нормализованного текста"""
+    if len(text) <= SHINGLE_SIZE:
+        return frozenset([text])
+    return frozenset(text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1))
+
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MINHASH_PARAMS = [
+    (zlib.crc32(f"a{i}".encode()) | 1, zlib.crc32(f"b{i}".encode()))
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+
+def minhash_signature(shingles: frozenset) -> Tuple[int, ...]:
+    """MinHash-подпись множества шинглов"""
+    hashes = [zlib.crc32(shingle.encode()) for shingle in shingles]
+    return tuple(
+        min((a * h + b) % _MERSENNE_PRIME for h in hashes)
+        for a, b in _MINHASH_PARAMS
+    )
+
+
+@dataclass
+class _CachedDiagnosis:
+    """Запись кэша диагнозов"""
+    key: Tuple[str, str]
+    diagnosis: str
+    shingles: frozenset
+    bands: Tuple[Tuple, ...]
+    created_at: float
+    version: int
+    latency: float  # Сколько шёл исходный вызов AI, секунд
+    cost: float  # Оценка стоимости исходного вызова, ₽
+
+
+class DiagnosisCache:
+    """
+    Кэш AI-диагнозов по (категория, нормализованное описание)
+    
+    Точное совпадение ищется по ключу, похожее - через LSH по MinHash-подписям
+    с проверкой точного сходства шинглов. Записи живут ttl секунд; смена
+    version (invalidate) делает все старые записи недействительными.
+    """
+    
+    def __init__(
+        self,
+        ttl: float = DIAGNOSIS_CACHE_TTL,
+        max_size: int = DIAGNOSIS_CACHE_SIZE,
+        similarity: Optional[float] = DIAGNOSIS_SIMILARITY,
+        version: int = DIAGNOSIS_CACHE_VERSION
+    ):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.similarity = similarity  # None - только точные совпадения
+        self.version = version
+        self._entries: "OrderedDict[Tuple[str, str], _CachedDiagnosis]" = OrderedDict()
+        self._buckets: Dict[Tuple, set] = {}
+        self.stats: Dict[str, float] = {
+            "exact_hits": 0, "similar_hits": 0, "misses": 0,
+            "latency_saved": 0.0, "cost_saved": 0.0
+        }
+    
+    @staticmethod
+    def _bands(signature: Tuple[int, ...]) -> Tuple[Tuple, ...]:
+        rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+        return tuple(
+            (band, signature[band * rows:(band + 1) * rows])
+            for band in range(MINHASH_BANDS)
+        )
+    
+    def _is_valid(self, entry: _CachedDiagnosis) -> bool:
+        return entry.version == self.version and time.time() - entry.created_at < self.ttl
+    
+    def get(self, category: str, description: str) -> Optional[str]:
+        """Найти диагноз для такого же или похожего описания"""
+        normalized = normalize_description(description)
+        key = (category, normalized)
+        
+        entry = self._entries.get(key)
+        if entry and self._is_valid(entry):
+            self._entries.move_to_end(key)
+            return self._hit("exact_hits", entry)
+        if entry:
+            self._discard(key)
+        
+        if self.similarity is not None:
+            shingles = _shingles(normalized)
+            best, best_score = None, self.similarity
+            candidates = set()
+            for band in self._bands(minhash_signature(shingles)):
+                candidates |= self._buckets.get(band, set())
+            for candidate_key in candidates:
+                candidate = self._entries.get(candidate_key)
+                if candidate_key[0] != category or not candidate or not self._is_valid(candidate):
+                    continue
+                score = len(shingles & candidate.shingles) / len(shingles | candidate.shingles)
+                if score >= best_score:
+                    best, best_score = candidate, score
+            if best:
+                self._entries.move_to_end(best.key)
+                return self._hit("similar_hits", best)
+        
+        self.stats["misses"] += 1
+        return None
+    
+    def _hit(self, kind: str, entry: _CachedDiagnosis) -> str:
+        self.stats[kind] += 1
+        self.stats["latency_saved"] += entry.latency
+        self.stats["cost_saved"] += entry.cost
+        return entry.diagnosis
+    
+    def put(self, category: str, description: str, diagnosis: str, latency: float = 0.0, cost: float = 0.0):
+        """Запомнить диагноз"""
+        normalized = normalize_description(description)
+        key = (category, normalized)
+        self._discard(key)
+        
+        shingles = _shingles(normalized)
+        bands = self._bands(minhash_signature(shingles))
+        self._entries[key] = _CachedDiagnosis(
+            key=key,
+            diagnosis=diagnosis,
+            shingles=shingles,
+            bands=bands,
+            created_at=time.time(),
+            version=self.version,
+            latency=latency,
+            cost=cost
+        )
+        for band in bands:
+            self._buckets.setdefault(band, set()).add(key)
+        
+        while len(self._entries) > self.max_size:
+            self._discard(next(iter(self._entries)))
+    
+    def _discard(self, key: Tuple[str, str]):
+        entry = self._entries.pop(key, None)
+        if not entry:
+            return
+        for band in entry.bands:
+            bucket = self._buckets.get(band)
+            if bucket:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band]
+    
+    def invalidate(self, version: Optional[int] = None):
+        """Сбросить кэш: новая версия промпта/модели"""
+        self.version = version if version is not None else self.version + 1
+        self._entries.clear()
+        self._buckets.clear()
+    
+    @property
+    def hit_rate(self) -> float:
+        hits = self.stats["exact_hits"] + self.stats["similar_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+    
+    def report(self) -> Dict[str, Any]:
+        """Статистика: доля попаданий, сэкономленные время и деньги"""
+        return {
+            **self.stats,
+            "latency_saved": round(self.stats["latency_saved"], 3),
+            "cost_saved": round(self.stats["cost_saved"], 2),
+            "hit_rate": round(self.hit_rate, 4),
+            "size": len(self._entries),
+            "version": self.version
+        }
+
+
+DIAGNOSIS_CACHE = DiagnosisCache()
+
+
+_stage_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+
+def _stage_semaphore() -> asyncio.Semaphore:
+    """Общий на процесс (в пределах event loop) лимит одновременных этапов"""
+    loop = asyncio.get_running_loop()
+    semaphore = _stage_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _stage_semaphores[loop] = asyncio.Semaphore(PIPELINE_CONCURRENCY)
+    return semaphore
+
+
+async def run_stages(
+    stages: Dict[str, Tuple[Tuple[str, ...], Callable[..., Awaitable[Any]]]],
+    timings: Dict[str, float]
+) -> Dict[str, Any]:
+    """
+    Выполнить DAG этапов: этап стартует, как только готовы его зависимости
+    
+    stages: имя -> (зависимости, async-функция от результатов зависимостей).
+    В timings пишется длительность каждого этапа в мс (без ожидания лимита).
+    """
+    tasks: Dict[str, asyncio.Task] = {}
+    
+    async def run(name: str):
+        deps, func = stages[name]
+        args = [await tasks[dep] for dep in deps]
+        async with _stage_semaphore():
+            started = time.perf_counter()
+            result = await func(*args)
+            timings[name] = round((time.perf_counter() - started) * 1000, 2)
+        return result
+    
+    # Зависимости объявлены раньше зависимых этапов
+    for name in stages:
+        tasks[name] = asyncio.create_task(run(name))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for task in tasks.values():
+            task.cancel()
+    return {name: task.result() for name, task in tasks.items()}
+
+
+def extract_keywords(text: str) -> List[str]:
+    """Основы значимых слов для полнотекстового поиска (грубый стемминг обрезкой окончания)"""
+    stems = []
+    for word in normalize_description(text).split():
+        if len(word) < 4 or word in KEYWORD_STOPWORDS or word.isdigit():
+            continue
+        stem = word[:max(4, len(word) - 2)]
+        if stem not in stems:
+            stems.append(stem)
+    return stems
+
+
+def extract_equipment(text: str) -> List[str]:
+    """Теги оборудования, упомянутого в тексте"""
+    tags = []
+    for word in normalize_description(text).split():
+        for prefix, tag in EQUIPMENT_TAGS.items():
+            if word.startswith(prefix) and tag not in tags:
+                tags.append(tag)
+    return tags
+
+
+# ==================== PDF ====================
+
+_pdf_fonts: Dict[str, Tuple[str, str, frozenset]] = {}
+
+
+def _register_pdf_fonts(font_path: str) -> Tuple[str, str, frozenset]:
+    """Зарегистрировать шрифт с кириллицей (один раз на процесс)"""
+    if font_path not in _pdf_fonts:
+        regular = TTFont("JobFile", font_path)
+        pdfmetrics.registerFont(regular)
+        bold_name = "JobFile"
+        bold_path = font_path.replace(".ttf", "-Bold.ttf")
+        if os.path.exists(bold_path):
+            pdfmetrics.registerFont(TTFont("JobFile-Bold", bold_path))
+            bold_name = "JobFile-Bold"
+        # Эмодзи в шрифте нет - такие символы выбрасываем, а не рисуем квадратами
+        _pdf_fonts[font_path] = ("JobFile", bold_name, frozenset(regular.face.charToGlyph))
+    return _pdf_fonts[font_path]
+
+
+def render_pdf(text: str, output_path: str, font_path: str = PDF_FONT_PATH) -> str:
+    """Сверстать текст файла заказа в PDF (выполняется в пуле процессов)"""
+    if not REPORTLAB_AVAILABLE:
+        raise RuntimeError("reportlab не установлен: pip install reportlab")
+    
+    regular, bold, glyphs = _register_pdf_fonts(font_path)
+    font_size, leading, margin = 10, 14, 50
+    width, height = A4
+    
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    pdf = canvas.Canvas(tmp_path, pagesize=A4)
+    pdf.setTitle(text.split("\n", 1)[0].replace("*", "").strip())
+    y = height - margin
+    for raw_line in text.splitlines():
+        font = bold if "**" in raw_line else regular
+        line = "".join(ch for ch in raw_line.replace("**", "") if ord(ch) in glyphs).strip()
+        for part in simpleSplit(line, font, font_size, width - 2 * margin) or [""]:
+            if y < margin:
+                pdf.showPage()
+                y = height - margin
+            pdf.setFont(font, font_size)
+            pdf.drawString(margin, y, part)
+            y -= leading
+    pdf.save()
+    
+    # Атомарная замена: читатели кэша не увидят недописанный файл
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+class PdfRenderer:
+    """
+    PDF-рендер в ограниченном пуле процессов с кэшем по хэшу содержимого
+    
+    Вёрстка идёт вне event loop API; одинаковые файлы заказов рендерятся
+    один раз, в том числе при одновременных запросах.
+    """
+    
+    def __init__(
+        self,
+        cache_dir: str = PDF_CACHE_DIR,
+        workers: int = PDF_WORKERS,
+        max_pending: int = PDF_MAX_PENDING,
+        font_path: str = PDF_FONT_PATH
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.font_path = font_path
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.stats: Dict[str, int] = {"rendered": 0, "cache_hits": 0, "deduplicated": 0}
+    
+    @staticmethod
+    def content_hash(text: str) -> str:
+        return hashlib.sha256(f"{PDF_RENDER_VERSION}\n{text}".encode()).hexdigest()
+    
+    def path_for(self, text: str) -> Path:
+        return self.cache_dir / f"{self.content_hash(text)}.pdf"
+    
+    def render_sync(self, text: str) -> Path:
+        """Рендер в текущем процессе (скрипты, не API)"""
+        path = self.path_for(text)
+        if path.exists():
+            self.stats["cache_hits"] += 1
+            return path
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        render_pdf(text, str(path), self.font_path)
+        self.stats["rendered"] += 1
+        return path
+    
+    async def render(self, text: str) -> Path:
+        """Рендер в пуле процессов; возвращает путь к PDF в кэше"""
+        path = self.path_for(text)
+        if path.exists():
+            self.stats["cache_hits"] += 1
+            return path
+        
+        key = path.stem
+        task = self._inflight.get(key)
+        if task:
+            self.stats["deduplicated"] += 1
+        else:
+            # Рендер - отдельная задача: отмена любого вызывающего (в том числе
+            # первого) не прерывает его для остальных
+            task = asyncio.get_running_loop().create_task(self._render_to_cache(text, path))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._render_done(key, done))
+        return await asyncio.shield(task)
+    
+    async def _render_to_cache(self, text: str, path: Path) -> Path:
+        if self._pool is None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._pool = ProcessPoolExecutor(self.workers)
+            self._slots = asyncio.Semaphore(self.max_pending)
+        async with self._slots:
+            await asyncio.get_running_loop().run_in_executor(
+                self._pool, render_pdf, text, str(path), self.font_path
+            )
+        self.stats["rendered"] += 1
+        return path
+    
+    def _render_done(self, key: str, task: asyncio.Task):
+        del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # Все вызывающие могли уйти - не логировать ошибку как потерянную
+    
+    @staticmethod
+    def iter_chunks(path: Path, chunk_size: int = PDF_CHUNK_SIZE):
+        """Отдавать PDF частями (например, в StreamingResponse), не читая целиком"""
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    
+    def close(self):
+        """Остановить пул процессов"""
+        if self._pool:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+            self._slots = None
+
+
+PDF_RENDERER = PdfRenderer()
+
+
 class JobFileGenerator:
     """Генератор файлов заказов с AI-инструкциями"""
     
-    def __init__(self, db_connection, ai_client=None):
+    def __init__(
+        self,
+        db_connection,
+        ai_client=None,
+        diagnosis_cache: Optional[DiagnosisCache] = None,
+        db_path: Optional[str] = None,
+        use_library: bool = True
+    ):
         self.db = db_connection
         self.ai_client = ai_client  # OpenAI/Anthropic/etc клиент
+        self.diagnosis_cache = diagnosis_cache or DIAGNOSIS_CACHE
+        self.use_library = use_library
+        self.library_stats: Dict[str, int] = {"hits": 0, "misses": 0, "added": 0}
+        
+        # С db_path запросы идут в пуле потоков со своими соединениями
+        # и не блокируют event loop; без него - через db_connection как раньше
+        self.db_path = db_path
+        self._db_executor = ThreadPoolExecutor(DB_THREADS, "job-file-db") if db_path else None
+        self._thread_db = threading.local()
+        
+        # Длительности этапов последних заказов, мс
+        self.stage_timings: deque = deque(maxlen=TIMINGS_HISTORY)
         self._init_work_instructions_table()
+        self._init_instruction_library()
+    
+    def _connection(self):
+        """Соединение для текущего потока"""
+        if not self.db_path:
+            return self.db
+        conn = getattr(self._thread_db, "conn", None)
+        if conn is None:
+            conn = self._thread_db.conn = sqlite3.connect(self.db_path, timeout=30)
+        return conn
+    
+    async def _run_db(self, func: Callable, *args):
+        """Выполнить синхронный запрос к БД, по возможности вне event loop"""
+        if self._db_executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, func, *args)
+    
+    def timing_summary(self) -> Dict[str, Dict[str, float]]:
+        """p50/p95 длительности этапов по последним заказам, мс"""
+        summary = {}
+        for stage in {name for timings in self.stage_timings for name in timings}:
+            values = sorted(timings[stage] for timings in self.stage_timings if stage in timings)
+            summary[stage] = {
+                "p50": values[len(values) // 2],
+                "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+                "count": len(values)
+            }
+        return summary
+    
+    def close(self):
+        """Остановить пул потоков БД"""
+        if self._db_executor:
+            self._db_executor.shutdown(wait=True)
+            self._db_executor = None
     
     def _init_work_instructions_table(self):
         """Инициализация таблицы инструкций"""
@@ -148,6 +665,41 @@ class JobFileGenerator:
         """)
         self.db.commit()
     
+    def _init_instruction_library(self):
+        """Библиотека инструкций: FTS по ключевым словам и индекс тегов"""
+        cursor = self.db.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS instruction_library (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                category TEXT NOT NULL,
+                problem TEXT NOT NULL,
+                keywords TEXT NOT NULL,
+                tools_required TEXT,
+                consumables_required TEXT,
+                parts_required TEXT,
+                step_by_step TEXT,
+                safety_notes TEXT,
+                estimated_time INTEGER,
+                difficulty_level TEXT,
+                source_job_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS instruction_library_fts
+            USING fts5(category, keywords, content='instruction_library', content_rowid='id')
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS instruction_tags (
+                instruction_id INTEGER NOT NULL,
+                tag TEXT NOT NULL,
+                PRIMARY KEY (tag, instruction_id),
+                FOREIGN KEY (instruction_id) REFERENCES instruction_library(id)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_instruction_library_category ON instruction_library(category)")
+        self.db.commit()
+    
     async def generate_job_file(
         self,
         job_id: int,
@@ -156,22 +708,53 @@ class JobFileGenerator:
         category: str,
         client_info: Dict[str, Any]
     ) -> JobFile:
-        """Генерация полного файла заказа"""
+        """
+        Генерация полного файла заказа
+        
+        Этапы: диагноз -> инструкции -> сохранение; данные заказа из БД
+        читаются параллельно с вызовами AI.
+        """
+        async def diagnose():
+            return await self._diagnose_problem(problem_description, conversation_transcript, category)
         
-        # 1. AI диагностирует проблему
-        ai_diagnosis = await self._diagnose_problem(problem_description, conversation_transcript, category)
+        async def instruct(diagnosis: str):
+            return await self._generate_instructions(diagnosis, category, problem_description)
         
-        # 2. AI генерирует инструкции
-        instructions = await self._generate_instructions(ai_diagnosis, category, problem_description)
+        async def save(instructions: WorkInstructions):
+            await self._run_db(self._save_instructions, job_id, instructions)
         
-        # 3. Сохранить инструкции в БД
-        self._save_instructions(job_id, instructions)
+        async def load():
+            return await self._run_db(self._get_job_data, job_id)
         
-        # 4. Получить информацию о заказе из БД
-        job_data = self._get_job_data(job_id)
+        timings: Dict[str, float] = {}
+        started = time.perf_counter()
+        results = await run_stages({
+            "job_data": ((), load),
+            "diagnosis": ((), diagnose),
+            "instructions": (("diagnosis",), instruct),
+            "save": (("instructions",), save),
+        }, timings)
+        timings["total"] = round((time.perf_counter() - started) * 1000, 2)
+        self.stage_timings.append(timings)
         
-        # 5. Создать файл заказа
-        job_file = JobFile(
+        return self._build_job_file(
+            job_id, conversation_transcript, problem_description, category,
+            client_info, results["diagnosis"], results["instructions"], results["job_data"]
+        )
+    
+    def _build_job_file(
+        self,
+        job_id: int,
+        conversation_transcript: str,
+        problem_description: str,
+        category: str,
+        client_info: Dict[str, Any],
+        ai_diagnosis: str,
+        instructions: WorkInstructions,
+        job_data: Dict
+    ) -> JobFile:
+        """Собрать файл заказа из результатов этапов"""
+        return JobFile(
             job_id=job_id,
             client_name=client_info.get("name", "Клиент"),
             client_phone=client_info.get("phone", ""),
@@ -189,13 +772,102 @@ class JobFileGenerator:
             special_notes=job_data.get("special_notes"),
             created_at=datetime.now()
         )
+    
+    async def generate_job_files_batch(
+        self,
+        job_ids: List[int],
+        progress: Optional[Callable[[int, int], None]] = None
+    ) -> Tuple[Dict[int, JobFile], Dict[int, Exception]]:
+        """
+        Перегенерировать файлы для списка заказов (после сбоя, смены цен)
+        
+        Заказы читаются одним запросом вместе с транскриптами разговоров,
+        одинаковые проблемы (категория + нормализованное описание + транскрипт)
+        диагностируются один раз, группы идут параллельно, инструкции пишутся
+        одной транзакцией. Ошибка AI в одной группе не останавливает остальные:
+        её заказы попадают в неудавшиеся, успешные всё равно сохраняются.
+        
+        Args:
+            progress: progress(готово_заказов, всего) после каждой группы, включая неудавшиеся
+        
+        Returns:
+            (job_id -> JobFile, job_id -> ошибка); отсутствующие в БД заказы пропускаются
+        """
+        jobs = await self._run_db(self._load_jobs, list(dict.fromkeys(job_ids)))
+        total = len(jobs)
+        
+        groups: Dict[Tuple[str, str, str], List[Dict]] = {}
+        for job in jobs.values():
+            key = (job["category"], normalize_description(job["problem_description"]), job["conversation_transcript"])
+            groups.setdefault(key, []).append(job)
+        
+        async def generate(group: List[Dict]):
+            category, description = group[0]["category"], group[0]["problem_description"]
+            try:
+                async with _stage_semaphore():
+                    diagnosis = await self._diagnose_problem(description, group[0]["conversation_transcript"], category)
+                async with _stage_semaphore():
+                    instructions = await self._generate_instructions(diagnosis, category, description)
+            except Exception as e:
+                return group, None, None, e
+            return group, diagnosis, instructions, None
         
-        return job_file
+        job_files: Dict[int, JobFile] = {}
+        failed: Dict[int, Exception] = {}
+        done = 0
+        for next_group in asyncio.as_completed([generate(group) for group in groups.values()]):
+            group, diagnosis, instructions, error = await next_group
+            for job in group:
+                if error is not None:
+                    failed[job["id"]] = error
+                    continue
+                job_files[job["id"]] = self._build_job_file(
+                    job["id"], job["conversation_transcript"], job["problem_description"], job["category"],
+                    self._client_info_from_row(job),
+                    diagnosis, instructions, self._job_data_from_row(job)
+                )
+            done += len(group)
+            if progress:
+                progress(done, total)
+        
+        await self._run_db(self._save_instructions_many, [
+            (job_id, job_file.work_instructions) for job_id, job_file in job_files.items()
+        ])
+        return job_files, failed
+    
+    async def load_job_file(self, job_id: int) -> Optional[JobFile]:
+        """
+        Файл заказа по последним сохранённым инструкциям
+        
+        Если инструкций ещё нет - генерирует их, как generate_job_files_batch.
+        
+        Returns:
+            JobFile или None, если заказа нет в БД
+        """
+        job = (await self._run_db(self._load_jobs, [job_id])).get(job_id)
+        if job is None:
+            return None
+        instructions = await self._run_db(self._load_latest_instructions, job_id)
+        if instructions is None:
+            job_files, failed = await self.generate_job_files_batch([job_id])
+            if job_id in failed:
+                raise failed[job_id]
+            return job_files.get(job_id)
+        return self._build_job_file(
+            job_id, job["conversation_transcript"], job["problem_description"], job["category"],
+            self._client_info_from_row(job),
+            instructions.problem_diagnosis, instructions, self._job_data_from_row(job)
+        )
     
     async def _diagnose_problem(self, description: str, transcript: str, category: str) -> str:
         """AI диагностирует проблему"""
         
         if self.ai_client:
+            # Похожую проблему в этой категории уже диагностировали
+            cached = self.diagnosis_cache.get(category, description)
+            if cached is not None:
+                return cached
+            
             # Используем AI для диагностики
             prompt = f"""
 Ты - опытный мастер-диагност в категории '{category}'.
@@ -208,7 +880,13 @@ class JobFileGenerator:
 
 Дай точный технический диагноз проблемы на русском языке (2-3 предложения).
 """
+            started = time.perf_counter()
             diagnosis = await self._call_ai(prompt)
+            latency = time.perf_counter() - started
+            
+            # Оценка ~4 символа на токен
+            cost = (len(prompt) + len(diagnosis)) / 4 / 1000 * AI_COST_PER_1K_TOKENS
+            self.diagnosis_cache.put(category, description, diagnosis, latency, cost)
             return diagnosis
         else:
             # Без AI - возвращаем описание как есть
@@ -220,7 +898,14 @@ class JobFileGenerator:
         category: str,
         problem: str
     ) -> WorkInstructions:
-        """AI генерирует пошаговые инструкции"""
+        """Инструкции из библиотеки, иначе AI генерирует пошаговые инструкции"""
+        
+        if self.use_library:
+            found = await self._run_db(self._find_library_instructions, category, problem, diagnosis)
+            if found:
+                self.library_stats["hits"] += 1
+                return found
+            self.library_stats["misses"] += 1
         
         if self.ai_client:
             # Используем AI для генерации инструкций
@@ -245,7 +930,7 @@ class JobFileGenerator:
             response = await self._call_ai(prompt, json_mode=True)
             data = json.loads(response) if isinstance(response, str) else response
             
-            return WorkInstructions(
+            instructions = WorkInstructions(
                 problem_diagnosis=diagnosis,
                 tools_required=data.get("tools_required", []),
                 consumables_required=data.get("consumables_required", []),
@@ -255,6 +940,11 @@ class JobFileGenerator:
                 estimated_time=data.get("estimated_time", 60),
                 difficulty_level=data.get("difficulty_level", "medium")
             )
+            
+            # Следующая похожая проблема возьмёт инструкции из библиотеки
+            if self.use_library:
+                await self._run_db(self.add_library_instructions, [(category, problem, diagnosis, instructions, None)])
+            return instructions
         else:
             # Без AI - базовые инструкции
             return self._generate_basic_instructions(category, diagnosis)
@@ -322,6 +1012,178 @@ class JobFileGenerator:
             difficulty_level=cat_data["difficulty"]
         )
     
+    # ==================== БИБЛИОТЕКА ИНСТРУКЦИЙ ====================
+    
+    def _find_library_instructions(self, category: str, problem: str, diagnosis: str) -> Optional[WorkInstructions]:
+        """
+        Подобрать инструкции из библиотеки
+        
+        Кандидаты - по FTS (ключевые слова проблемы) в той же категории и,
+        если в описании названо оборудование, с тем же тегом. Берётся лучшая
+        по покрытию ключевых слов и bm25; инструменты, материалы и меры
+        безопасности дополняются из следующих подходящих.
+        """
+        keywords = extract_keywords(problem)
+        if not keywords:
+            return None
+        equipment = extract_equipment(problem)
+        
+        # Категория - тоже столбец FTS, чтобы не ранжировать чужие категории.
+        # Сначала все ключевые слова сразу (мало кандидатов), потом любое из них
+        terms = [f'"{keyword}"*' for keyword in keywords]
+        category_term = '"' + category.replace('"', '""') + '"'
+        rows = []
+        for joiner in (" AND ", " OR "):
+            query = f'category:{category_term} AND keywords:({joiner.join(terms)})'
+            sql = """
+                SELECT l.*, bm25(instruction_library_fts) AS rank
+                FROM instruction_library_fts
+                JOIN instruction_library l ON l.id = instruction_library_fts.rowid
+                WHERE instruction_library_fts MATCH ?
+            """
+            params: List[Any] = [query]
+            if equipment:
+                sql += f"""
+                    AND EXISTS (
+                        SELECT 1 FROM instruction_tags t
+                        WHERE t.instruction_id = l.id AND t.tag IN ({','.join('?' * len(equipment))})
+                    )
+                """
+                params.extend(equipment)
+            sql += " ORDER BY rank LIMIT ?"
+            params.append(LIBRARY_CANDIDATES)
+            
+            cursor = self._connection().cursor()
+            cursor.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+            if rows or len(terms) == 1:
+                break
+        
+        matches = []
+        for row in rows:
+            entry = dict(zip(columns, row))
+            stored = entry["keywords"].split()
+            covered = sum(1 for keyword in keywords if any(word.startswith(keyword) for word in stored))
+            overlap = covered / len(keywords)
+            if overlap >= LIBRARY_MIN_OVERLAP:
+                matches.append((-overlap, entry["rank"], entry))
+        if not matches:
+            return None
+        
+        matches.sort(key=lambda match: match[:2])
+        best = [entry for _, _, entry in matches[:LIBRARY_COMPOSE]]
+        
+        def merged(field: str) -> List[str]:
+            items = []
+            for entry in best:
+                for item in json.loads(entry[field] or "[]"):
+                    if item not in items:
+                        items.append(item)
+            return items
+        
+        return WorkInstructions(
+            problem_diagnosis=diagnosis,
+            tools_required=merged("tools_required"),
+            consumables_required=merged("consumables_required"),
+            parts_required=json.loads(best[0]["parts_required"] or "[]"),
+            step_by_step=json.loads(best[0]["step_by_step"] or "[]"),
+            safety_notes=merged("safety_notes"),
+            estimated_time=best[0]["estimated_time"] or 60,
+            difficulty_level=best[0]["difficulty_level"] or "medium"
+        )
+    
+    def add_library_instructions(self, items: List[Tuple[str, str, str, WorkInstructions, Optional[int]]]) -> int:
+        """
+        Добавить инструкции в библиотеку одной транзакцией
+        
+        Args:
+            items: (категория, описание проблемы, диагноз, инструкции, ID заказа-источника)
+        """
+        conn = self._connection()
+        cursor = conn.cursor()
+        added = 0
+        for category, problem, diagnosis, instructions, source_job_id in items:
+            keywords = " ".join(extract_keywords(f"{problem} {diagnosis}"))
+            if not keywords:
+                continue
+            cursor.execute("""
+                INSERT INTO instruction_library (
+                    category, problem, keywords, tools_required, consumables_required,
+                    parts_required, step_by_step, safety_notes, estimated_time,
+                    difficulty_level, source_job_id
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                category,
+                problem,
+                keywords,
+                json.dumps(instructions.tools_required, ensure_ascii=False),
+                json.dumps(instructions.consumables_required, ensure_ascii=False),
+                json.dumps(instructions.parts_required, ensure_ascii=False),
+                json.dumps(instructions.step_by_step, ensure_ascii=False),
+                json.dumps(instructions.safety_notes, ensure_ascii=False),
+                instructions.estimated_time,
+                instructions.difficulty_level,
+                source_job_id
+            ))
+            instruction_id = cursor.lastrowid
+            cursor.execute(
+                "INSERT INTO instruction_library_fts (rowid, category, keywords) VALUES (?, ?, ?)",
+                (instruction_id, category, keywords)
+            )
+            cursor.executemany(
+                "INSERT OR IGNORE INTO instruction_tags (instruction_id, tag) VALUES (?, ?)",
+                [(instruction_id, tag) for tag in extract_equipment(f"{problem} {diagnosis}")]
+            )
+            added += 1
+        conn.commit()
+        self.library_stats["added"] += added
+        return added
+    
+    def import_work_instructions(self) -> int:
+        """Перенести в библиотеку уже сгенерированные work_instructions, которых там ещё нет"""
+        cursor = self._connection().cursor()
+        cursor.execute("""
+            SELECT w.job_id, j.category, j.problem_description, w.problem_diagnosis,
+                   w.tools_required, w.consumables_required, w.parts_required,
+                   w.step_by_step, w.safety_notes, w.estimated_time, w.difficulty_level
+            FROM work_instructions w
+            JOIN jobs j ON j.id = w.job_id
+            WHERE w.id IN (SELECT MAX(id) FROM work_instructions GROUP BY job_id)
+              AND NOT EXISTS (SELECT 1 FROM instruction_library l WHERE l.source_job_id = w.job_id)
+        """)
+        items = [
+            (row[1], row[2], row[3], self._instructions_from_row(row[3:]), row[0])
+            for row in cursor.fetchall()
+        ]
+        return self.add_library_instructions(items)
+    
+    @staticmethod
+    def _instructions_from_row(row) -> WorkInstructions:
+        """WorkInstructions из колонок work_instructions (problem_diagnosis ... difficulty_level)"""
+        diagnosis, tools, consumables, parts, steps, safety, estimated_time, difficulty = row
+        return WorkInstructions(
+            problem_diagnosis=diagnosis,
+            tools_required=json.loads(tools or "[]"),
+            consumables_required=json.loads(consumables or "[]"),
+            parts_required=json.loads(parts or "[]"),
+            step_by_step=json.loads(steps or "[]"),
+            safety_notes=json.loads(safety or "[]"),
+            estimated_time=estimated_time or 60,
+            difficulty_level=difficulty or "medium"
+        )
+    
+    def _load_latest_instructions(self, job_id: int) -> Optional[WorkInstructions]:
+        """Последние сохранённые инструкции заказа"""
+        row = self._connection().execute("""
+            SELECT problem_diagnosis, tools_required, consumables_required, parts_required,
+                   step_by_step, safety_notes, estimated_time, difficulty_level
+            FROM work_instructions
+            WHERE job_id = ?
+            ORDER BY id DESC LIMIT 1
+        """, (job_id,)).fetchone()
+        return self._instructions_from_row(row) if row else None
+    
     async def _call_ai(self, prompt: str, json_mode: bool = False) -> str:
         """Вызов AI API"""
         # Здесь будет интеграция с OpenAI/Anthropic/etc
@@ -330,57 +1192,516 @@ class JobFileGenerator:
     
     def _save_instructions(self, job_id: int, instructions: WorkInstructions):
         """Сохранить инструкции в БД"""
-        cursor = self.db.cursor()
-        cursor.execute("""
+        self._save_instructions_many([(job_id, instructions)])
+    
+    def _save_instructions_many(self, items: List[Tuple[int, WorkInstructions]]):
+        """Сохранить инструкции нескольких заказов одной транзакцией"""
+        conn = self._connection()
+        cursor = conn.cursor()
+        cursor.executemany("""
             INSERT INTO work_instructions (
                 job_id, problem_diagnosis, tools_required, consumables_required,
                 parts_required, step_by_step, safety_notes,
                 estimated_time, difficulty_level
             ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            job_id,
-            instructions.problem_diagnosis,
-            json.dumps(instructions.tools_required, ensure_ascii=False),
-            json.dumps(instructions.consumables_required, ensure_ascii=False),
-            json.dumps(instructions.parts_required, ensure_ascii=False),
-            json.dumps(instructions.step_by_step, ensure_ascii=False),
-            json.dumps(instructions.safety_notes, ensure_ascii=False),
-            instructions.estimated_time,
-            instructions.difficulty_level
-        ))
-        self.db.commit()
+        """, [
+            (
+                job_id,
+                instructions.problem_diagnosis,
+                json.dumps(instructions.tools_required, ensure_ascii=False),
+                json.dumps(instructions.consumables_required, ensure_ascii=False),
+                json.dumps(instructions.parts_required, ensure_ascii=False),
+                json.dumps(instructions.step_by_step, ensure_ascii=False),
+                json.dumps(instructions.safety_notes, ensure_ascii=False),
+                instructions.estimated_time,
+                instructions.difficulty_level
+            )
+            for job_id, instructions in items
+        ])
+        conn.commit()
     
     def _get_job_data(self, job_id: int) -> Dict:
         """Получить данные заказа из БД"""
-        cursor = self.db.cursor()
-        cursor.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
-        row = cursor.fetchone()
-        
-        if not row:
-            return {}
+        row = self._load_jobs([job_id]).get(job_id)
+        return self._job_data_from_row(row) if row else {}
+    
+    def _load_jobs(self, job_ids: List[int]) -> Dict[int, Dict]:
+        """
+        Строки заказов по ID одним запросом (пачками по JOBS_QUERY_CHUNK)
         
+        В conversation_transcript - транскрипт разговора заказа ("" без разговора).
+        """
+        cursor = self._connection().cursor()
+        jobs = {}
+        for i in range(0, len(job_ids), JOBS_QUERY_CHUNK):
+            chunk = job_ids[i:i + JOBS_QUERY_CHUNK]
+            cursor.execute(f"""
+                SELECT jobs.*, COALESCE(c.transcript, '') AS conversation_transcript
+                FROM jobs
+                LEFT JOIN conversations c ON c.id = jobs.conversation_id
+                WHERE jobs.id IN ({','.join('?' * len(chunk))})
+            """, chunk)
+            columns = [column[0] for column in cursor.description]
+            for row in cursor.fetchall():
+                job = dict(zip(columns, row))
+                jobs[job["id"]] = job
+        return jobs
+    
+    @staticmethod
+    def _client_info_from_row(job: Dict) -> Dict:
+        """Контакты клиента из строки jobs (без пустых полей)"""
+        client_info = {
+            "name": job.get("client_name"),
+            "phone": job.get("client_phone"),
+            "address": job.get("address")
+        }
+        return {k: v for k, v in client_info.items() if v is not None}
+    
+    @staticmethod
+    def _job_data_from_row(job: Dict) -> Dict:
+        """Финансы и детали файла заказа из строки jobs"""
         # Рассчитать заработок мастера (75% после вычета 2% шлюза)
-        estimated_price = row[6] if len(row) > 6 else 0
+        estimated_price = job.get("estimated_price") or 0
         gateway_fee = estimated_price * 0.02
         net = estimated_price - gateway_fee
         master_earnings = net * 0.75
         
+        media_urls = job.get("media_urls") or []
+        if isinstance(media_urls, str):
+            media_urls = json.loads(media_urls)
+        
         return {
             "estimated_price": estimated_price,
             "master_earnings": round(master_earnings, 2),
             "scheduled_time": None,  # TODO: Из conversations
-            "urgency_level": "standard",
-            "media_urls": [],
+            "urgency_level": job.get("urgency_level") or "standard",
+            "media_urls": media_urls,
             "special_notes": None
         }
     
-    def export_to_pdf(self, job_file: JobFile, output_path: str):
-        """Экспорт файла заказа в PDF"""
-        # TODO: Реализовать генерацию PDF
-        # Можно использовать reportlab или fpdf
-        pass
+    def export_to_pdf(self, job_file: JobFile, output_path: str) -> str:
+        """Экспорт файла заказа в PDF (синхронно, для скриптов)"""
+        shutil.copyfile(PDF_RENDERER.render_sync(job_file.to_text()), output_path)
+        return output_path
+    
+    async def export_to_pdf_async(self, job_file: JobFile) -> Path:
+        """Экспорт в PDF через пул процессов; путь к файлу в кэше"""
+        return await PDF_RENDERER.render(job_file.to_text())
     
     def send_to_master(self, job_file: JobFile, master_id: int, channel: str = "telegram"):
         """Отправить файл заказа мастеру"""
         # TODO: Интеграция с notification_service
         pass
+
+
+class _FakeAIGenerator(JobFileGenerator):
+    """Генератор с локальной имитацией AI: задержка и детерминированный ответ"""
+    
+    ai_latency = 0.005
+    db_latency = 0.0  # Имитация медленного диска/блокировок SQLite
+    calls = 0
+    fail_on: Optional[str] = None  # Описание, на котором AI отвечает ошибкой
+    
+    def _save_instructions_many(self, items: List[Tuple[int, WorkInstructions]]):
+        time.sleep(self.db_latency)
+        super()._save_instructions_many(items)
+    
+    def _load_jobs(self, job_ids: List[int]) -> Dict[int, Dict]:
+        time.sleep(self.db_latency)
+        return super()._load_jobs(job_ids)
+    
+    async def _call_ai(self, prompt: str, json_mode: bool = False) -> str:
+        _FakeAIGenerator.calls += 1
+        await asyncio.sleep(self.ai_latency)
+        if self.fail_on and self.fail_on in prompt:
+            raise RuntimeError("AI API 500")
+        if json_mode:
+            return json.dumps({"step_by_step": ["Проверить", "Починить"], "estimated_time": 45}, ensure_ascii=False)
+        return "Диагноз: " + prompt.split("Описание клиента: ", 1)[-1].split("\n", 1)[0]
+
+
+async def _bench_diagnosis_cache(jobs: int = 2000, ai_latency: float = 0.005):
+    """Поток типовых заявок через генератор с кэшем диагнозов и без"""
+    import random
+    
+    problems = {
+        "electrical": ["не работает розетка", "выбивает автомат", "мигает свет в коридоре", "искрит выключатель"],
+        "plumbing": ["течет кран на кухне", "засор в раковине", "протекает унитаз", "нет горячей воды"],
+        "appliance": ["не сливает стиральная машина", "не греет духовка", "холодильник не морозит"]
+    }
+    # Так клиенты пишут одно и то же по-разному
+    variants = [
+        lambda p: p,
+        lambda p: p.capitalize() + "!",
+        lambda p: p.replace("е", "ё", 1),
+        lambda p: "Здравствуйте, " + p,
+        lambda p: p + " срочно",
+        lambda p: p + ", помогите",
+    ]
+    
+    rng = random.Random(7)
+    workload = []
+    for _ in range(jobs):
+        category = rng.choice(list(problems))
+        description = rng.choice(variants)(rng.choice(problems[category]))
+        if rng.random() < 0.3:
+            description += f" в квартире {rng.randint(1, 500)}"  # Уникальная часть
+        workload.append((category, description))
+    
+    db = sqlite3.connect(":memory:")
+    results = {}
+    for name, cache in (
+        ("без кэша", DiagnosisCache(similarity=None, max_size=0)),
+        ("точный ключ", DiagnosisCache(similarity=None)),
+        ("точный + похожие", DiagnosisCache())
+    ):
+        _FakeAIGenerator.calls = 0
+        generator = _FakeAIGenerator(db, ai_client=object(), diagnosis_cache=cache, use_library=False)
+        generator.ai_latency = ai_latency
+        started = time.perf_counter()
+        for category, description in workload:
+            await generator._diagnose_problem(description, "", category)
+        elapsed = time.perf_counter() - started
+        report = cache.report()
+        results[name] = _FakeAIGenerator.calls
+        print(f"✅ {name}: {_FakeAIGenerator.calls} вызовов AI, {elapsed:.2f} с, "
+              f"hit rate {report['hit_rate']:.1%} (точных {report['exact_hits']}, похожих {report['similar_hits']}), "
+              f"сэкономлено {report['latency_saved']:.1f} с и {report['cost_saved']:.2f}₽")
+    
+    assert results["точный + похожие"] < results["точный ключ"] < results["без кэша"] == jobs
+    
+    # Похожие описания - из той же категории; версия и TTL сбрасывают записи
+    cache = DiagnosisCache()
+    cache.put("electrical", "не работает розетка на кухне", "D1")
+    assert cache.get("electrical", "Не работает розетка на кухне!!") == "D1"
+    assert cache.get("electrical", "не работает розетка на кухне срочно") == "D1"
+    assert cache.get("plumbing", "не работает розетка на кухне") is None
+    assert cache.get("electrical", "течет кран") is None
+    cache.invalidate()
+    assert cache.get("electrical", "не работает розетка") is None
+    cache.put("electrical", "не работает розетка", "D2")
+    cache.ttl = 0
+    assert cache.get("electrical", "не работает розетка") is None
+    print("✅ Версия и TTL инвалидируют кэш")
+
+
+async def _bench_pipeline(jobs: int = 200, ai_latency: float = 0.05, db_latency: float = 0.01):
+    """Сквозная задержка генерации: последовательные этапы против DAG"""
+    import tempfile
+    
+    db_path = os.path.join(tempfile.mkdtemp(), "jobs.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("""
+        CREATE TABLE jobs (
+            id INTEGER PRIMARY KEY, client_id INTEGER, category TEXT, problem_description TEXT,
+            address TEXT, status TEXT, estimated_price REAL, conversation_id TEXT
+        )
+    """)
+    conn.execute("CREATE TABLE conversations (id TEXT PRIMARY KEY, transcript TEXT)")
+    conn.executemany(
+        "INSERT INTO jobs VALUES (?, 1, 'electrical', 'не работает розетка', 'ул. Ленина', 'assigned', ?, NULL)",
+        [(i, 1000 + i) for i in range(jobs)]
+    )
+    conn.commit()
+    
+    async def legacy(generator: JobFileGenerator, job_id: int) -> float:
+        # Порядок до изменения: всё по очереди, БД прямо в event loop
+        started = time.perf_counter()
+        diagnosis = await generator._diagnose_problem(f"розетка {job_id}", "", "electrical")
+        instructions = await generator._generate_instructions(diagnosis, "electrical", f"розетка {job_id}")
+        generator._save_instructions(job_id, instructions)
+        generator._get_job_data(job_id)
+        return (time.perf_counter() - started) * 1000
+    
+    async def pipeline(generator: JobFileGenerator, job_id: int) -> float:
+        started = time.perf_counter()
+        await generator.generate_job_file(job_id, "", f"розетка {job_id}", "electrical", {})
+        return (time.perf_counter() - started) * 1000
+    
+    def percentiles(latencies: List[float]) -> str:
+        latencies = sorted(latencies)
+        return f"p50 {latencies[len(latencies) // 2]:.0f} мс, p95 {latencies[int(len(latencies) * 0.95)]:.0f} мс"
+    
+    # Кэш отключён: меряем сам конвейер, а не попадания
+    no_cache = DiagnosisCache(similarity=None, max_size=0)
+    generators = {
+        "последовательно": (legacy, _FakeAIGenerator(conn, ai_client=object(), diagnosis_cache=no_cache, use_library=False)),
+        "DAG": (pipeline, _FakeAIGenerator(
+            conn, ai_client=object(), diagnosis_cache=no_cache, db_path=db_path, use_library=False
+        )),
+    }
+    results = {}
+    for name, (run, generator) in generators.items():
+        generator.ai_latency = ai_latency
+        generator.db_latency = db_latency
+        
+        single = [await run(generator, i) for i in range(20)]
+        started = time.perf_counter()
+        loaded = await asyncio.gather(*(run(generator, i) for i in range(jobs)))
+        elapsed = time.perf_counter() - started
+        results[name] = elapsed
+        print(f"✅ {name}: по одному {percentiles(single)}; "
+              f"{jobs} одновременно за {elapsed:.2f} с, {percentiles(loaded)}")
+    
+    generator = generators["DAG"][1]
+    generator.close()
+    for stage, stats in sorted(generator.timing_summary().items()):
+        print(f"   {stage}: p50 {stats['p50']:.1f} мс, p95 {stats['p95']:.1f} мс")
+    
+    saved = conn.execute("SELECT COUNT(*) FROM work_instructions").fetchone()[0]
+    assert saved == 2 * (jobs + 20), saved
+    assert results["DAG"] < results["последовательно"]
+
+
+def _sample_job_file(job_id: int, steps: int = 8) -> JobFile:
+    """Файл заказа для проверок PDF"""
+    return JobFile(
+        job_id=job_id,
+        client_name="Иван Петров",
+        client_phone="+79001234567",
+        client_address=f"ул. Ленина, д. {job_id % 200 + 1}, кв. {job_id % 90 + 1}",
+        service_category="electrical",
+        problem_description="Не работает розетка на кухне, искрит при включении чайника",
+        ai_diagnosis="Вероятно, ослаб контакт в розетке или подгорела клемма.",
+        estimated_price=1500 + job_id % 10 * 100,
+        master_earnings=1102.5,
+        scheduled_time="2025-12-15 10:00",
+        urgency_level="standard",
+        work_instructions=WorkInstructions(
+            problem_diagnosis="Ослаб контакт",
+            tools_required=["Отвертка", "Мультиметр", "Индикатор напряжения"],
+            consumables_required=["Клеммы WAGO", "Изолента"],
+            parts_required=["Розетка с заземлением"],
+            step_by_step=[f"Шаг {i + 1}: выполнить операцию и проверить результат" for i in range(steps)],
+            safety_notes=["Отключить электропитание!", "Проверить отсутствие напряжения"],
+            estimated_time=60,
+            difficulty_level="medium"
+        ),
+        conversation_transcript="",
+        media_urls=[],
+        special_notes="Домофон не работает, позвонить за 10 минут" if job_id % 3 == 0 else None,
+        created_at=datetime(2025, 12, 14, 9, 0)
+    )
+
+
+async def _check_pdf_cancel():
+    """Отмена первого запроса PDF не отменяет рендер для остальных"""
+    import tempfile
+    
+    class SlowRenderer(PdfRenderer):
+        async def _render_to_cache(self, text: str, path: Path) -> Path:
+            await asyncio.sleep(0.05)
+            path.write_bytes(b"%PDF-")
+            self.stats["rendered"] += 1
+            return path
+    
+    renderer = SlowRenderer(cache_dir=tempfile.mkdtemp())
+    first = asyncio.create_task(renderer.render("заказ"))
+    await asyncio.sleep(0)
+    waiters = [asyncio.create_task(renderer.render("заказ")) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    first.cancel()
+    paths = await asyncio.gather(*waiters)
+    
+    assert first.cancelled() and len(set(paths)) == 1 and paths[0].exists()
+    assert renderer.stats == {"rendered": 1, "cache_hits": 0, "deduplicated": 3}
+    assert not renderer._inflight
+    print("✅ Отмена первого запроса PDF не прерывает рендер для остальных")
+
+
+async def _bench_pdf(files: int = 1000):
+    """Рендер 1000 файлов заказов: в пуле процессов против event loop"""
+    import tempfile
+    
+    if not REPORTLAB_AVAILABLE:
+        print("⚠️ reportlab не установлен - бенчмарк PDF пропущен")
+        return
+    
+    job_files = [_sample_job_file(i) for i in range(files)]
+    # Каждый десятый запрос - повтор уже запрошенного файла
+    texts = [job_files[i if i % 10 else max(0, i - 5)].to_text() for i in range(files)]
+    
+    async def lag_probe(stop: asyncio.Event) -> float:
+        # Насколько event loop не успевает к сроку - так его видят остальные запросы
+        worst = 0.0
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            worst = max(worst, time.perf_counter() - started - 0.01)
+        return worst * 1000
+    
+    # До: рендер прямо в event loop
+    inline = PdfRenderer(cache_dir=tempfile.mkdtemp())
+    sample = 100
+    stop = asyncio.Event()
+    probe = asyncio.create_task(lag_probe(stop))
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    for text in texts[:sample]:
+        inline.render_sync(text)
+        await asyncio.sleep(0)
+    inline_elapsed = (time.perf_counter() - started) / sample * files
+    stop.set()
+    inline_lag = await probe
+    
+    # После: пул процессов
+    renderer = PdfRenderer(cache_dir=tempfile.mkdtemp())
+    stop = asyncio.Event()
+    probe = asyncio.create_task(lag_probe(stop))
+    started = time.perf_counter()
+    paths = await asyncio.gather(*(renderer.render(text) for text in texts))
+    pool_elapsed = time.perf_counter() - started
+    stop.set()
+    pool_lag = await probe
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(renderer.render(text) for text in texts))
+    cached_elapsed = time.perf_counter() - started
+    renderer.close()
+    
+    print(f"✅ PDF в event loop: ~{inline_elapsed:.1f} с на {files} (оценка по {sample}), "
+          f"задержка event loop до {inline_lag:.0f} мс")
+    print(f"✅ PDF в пуле ({renderer.workers} процессов): {files} за {pool_elapsed:.1f} с, "
+          f"задержка event loop до {pool_lag:.0f} мс, {renderer.stats}")
+    print(f"✅ Повторный запрос {files} файлов из кэша: {cached_elapsed * 1000:.0f} мс")
+    
+    assert len(set(paths)) == renderer.stats["rendered"] == len(set(texts))
+    assert all(path.read_bytes()[:5] == b"%PDF-" for path in set(paths))
+    
+    # Большой файл отдаётся частями
+    big = renderer.render_sync(_sample_job_file(0, steps=3000).to_text())
+    chunks = list(PdfRenderer.iter_chunks(big))
+    assert len(chunks) > 1 and b"".join(chunks) == big.read_bytes()
+    print(f"✅ Большой файл {big.stat().st_size // 1024} КБ отдан {len(chunks)} частями")
+
+
+async def _bench_batch(jobs: int = 500, problems: int = 40, ai_latency: float = 0.05, db_latency: float = 0.01):
+    """Перегенерация бэклога: по одному заказу против пакета"""
+    conn = sqlite3.connect(":memory:")
+    conn.execute("""
+        CREATE TABLE jobs (
+            id INTEGER PRIMARY KEY, client_name TEXT, client_phone TEXT, category TEXT,
+            problem_description TEXT, address TEXT, estimated_price REAL, urgency_level TEXT,
+            conversation_id TEXT
+        )
+    """)
+    conn.executemany("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, 'standard', NULL)", [
+        (i, f"Клиент {i}", f"+7900{i:07d}", "electrical", f"Не работает розетка №{i % problems}!",
+         f"ул. Ленина, {i}", 1000 + i % 7 * 100)
+        for i in range(jobs)
+    ])
+    # У заказа 0 есть разговор: его диагноз не делится с заказами без транскрипта
+    conn.execute("CREATE TABLE conversations (id TEXT PRIMARY KEY, transcript TEXT)")
+    conn.execute("INSERT INTO conversations VALUES ('conv-0', 'Клиент: розетка искрит и пахнет гарью')")
+    conn.execute("UPDATE jobs SET conversation_id = 'conv-0' WHERE id = 0")
+    conn.commit()
+    
+    # Кэш диагнозов отключён: меряем именно пакетную обработку
+    generator = _FakeAIGenerator(
+        conn, ai_client=object(), diagnosis_cache=DiagnosisCache(similarity=None, max_size=0), use_library=False
+    )
+    generator.ai_latency = ai_latency
+    generator.db_latency = db_latency
+    
+    _FakeAIGenerator.calls = 0
+    started = time.perf_counter()
+    for job_id in range(jobs):
+        job = generator._load_jobs([job_id])[job_id]
+        await generator.generate_job_file(
+            job_id, job["conversation_transcript"], job["problem_description"], job["category"],
+            {"name": job["client_name"], "phone": job["client_phone"], "address": job["address"]}
+        )
+    sequential, sequential_calls = time.perf_counter() - started, _FakeAIGenerator.calls
+    
+    reports = []
+    
+    def progress(done: int, total: int):
+        reports.append(done)
+        if done == total or len(reports) % 10 == 0:
+            print(f"   ⏳ {done}/{total}")
+    
+    # Диагноз одной проблемы падает: её заказы - в неудавшихся, остальные сохраняются
+    generator.fail_on = "розетка №3!"
+    broken = {i for i in range(jobs) if i % problems == 3}
+    
+    _FakeAIGenerator.calls = 0
+    started = time.perf_counter()
+    job_files, failed = await generator.generate_job_files_batch(list(range(jobs)) + [jobs + 1], progress)
+    batch, batch_calls = time.perf_counter() - started, _FakeAIGenerator.calls
+    
+    print(f"✅ По одному: {jobs} заказов за {sequential:.1f} с, {sequential_calls} вызовов AI")
+    print(f"✅ Пакетом: {jobs} заказов за {batch:.2f} с, {batch_calls} вызовов AI, {len(reports)} отчётов о прогрессе, "
+          f"не удалось: {len(failed)}")
+    
+    assert set(failed) == broken and all(isinstance(error, RuntimeError) for error in failed.values())
+    assert len(job_files) == jobs - len(broken) and batch_calls == 2 * (problems + 1) - 1
+    assert job_files[0].conversation_transcript == "Клиент: розетка искрит и пахнет гарью"
+    assert job_files[problems].conversation_transcript == ""
+    assert reports[-1] == jobs and reports == sorted(reports)
+    assert job_files[7].client_name == "Клиент 7" and job_files[7].estimated_price == 1000
+    saved = conn.execute("SELECT COUNT(*) FROM work_instructions").fetchone()[0]
+    assert saved == 2 * jobs - len(broken), saved
+
+
+async def _bench_library(instructions: int = 50000, queries: int = 1000):
+    """Поиск в библиотеке из 50k инструкций: задержка и доля попаданий"""
+    import random
+    
+    rng = random.Random(11)
+    catalog = {
+        "electrical": (["розетка", "выключатель", "автомат", "щиток", "люстра", "проводка"],
+                       ["искрит", "греется", "выбивает", "не работает", "трещит", "плавится", "мигает"]),
+        "plumbing": (["кран", "смеситель", "унитаз", "раковина", "труба", "бойлер"],
+                     ["течет", "капает", "засор", "шумит", "протекает", "не греет"]),
+        "appliance": (["стиральная машина", "посудомойка", "духовка", "плита", "холодильник"],
+                      ["не сливает", "не греет", "шумит", "не включается", "течет", "не морозит"])
+    }
+    places = ["на кухне", "в ванной", "в коридоре", "в спальне", "в подъезде", ""]
+    
+    def problem(category: str) -> str:
+        equipment, symptoms = catalog[category]
+        return f"{rng.choice(symptoms)} {rng.choice(equipment)} {rng.choice(places)}".strip()
+    
+    generator = JobFileGenerator(sqlite3.connect(":memory:"))
+    steps = WorkInstructions("", ["Отвертка"], ["Изолента"], [], ["Шаг 1", "Шаг 2"], ["Отключить питание"], 45, "easy")
+    started = time.perf_counter()
+    for _ in range(0, instructions, 5000):
+        items = []
+        for _ in range(5000):
+            category = rng.choice(list(catalog))
+            items.append((category, problem(category), "", steps, None))
+        generator.add_library_instructions(items)
+    print(f"✅ Библиотека: {instructions} инструкций загружено за {time.perf_counter() - started:.1f} с")
+    
+    latencies = []
+    for _ in range(queries):
+        category = rng.choice(list(catalog))
+        started = time.perf_counter()
+        found = await generator._generate_instructions("Диагноз", category, problem(category))
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    p50, p95, p99 = (latencies[int(len(latencies) * p)] for p in (0.5, 0.95, 0.99))
+    stats = generator.library_stats
+    print(f"✅ Поиск: p50 {p50:.2f} мс, p95 {p95:.2f} мс, p99 {p99:.2f} мс; "
+          f"найдено {stats['hits']}/{queries}")
+    assert p95 < 10, p95
+    
+    # Найденная инструкция - по тому же оборудованию и категории
+    generator.add_library_instructions([("electrical", "Искрит розетка в детской", "Подгорел контакт", WorkInstructions(
+        "", ["Индикатор"], ["Клемма"], ["Розетка Legrand"], ["Заменить розетку"], ["Обесточить"], 30, "easy"
+    ), None)])
+    found = generator._find_library_instructions("electrical", "розетки искрят в детской", "Диагноз")
+    assert found and found.problem_diagnosis == "Диагноз" and "Индикатор" in found.tools_required
+    assert generator._find_library_instructions("plumbing", "искрит розетка в детской", "") is None
+    assert generator._find_library_instructions("electrical", "потекла крыша", "") is None
+    # Кавычки в категории не ломают запрос FTS
+    assert generator._find_library_instructions('electrical" OR category:"plumbing', "искрит розетка", "") is None
+
+
+if __name__ == "__main__":
+    asyncio.run(_bench_diagnosis_cache())
+    asyncio.run(_bench_pipeline())
+    asyncio.run(_bench_batch())
+    asyncio.run(_bench_library())
+    asyncio.run(_check_pdf_cancel())
+    asyncio.run(_bench_pdf())
@@ -5,13 +5,15 @@ AI Service Platform - FastAPI Backend
 from fastapi import FastAPI, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 from datetime import datetime, timedelta
 import os
 import json
 import sqlite3
+import base64
+import asyncio
 from pathlib import Path
 
 # Google интеграция
@@ -33,9 +35,12 @@ except ImportError:
 # MVP Modules
 try:
     from conversation_manager import ConversationManager, ConversationType, ConversationChannel
-    from job_file_generator import JobFileGenerator
+    from job_file_generator import JobFileGenerator, PdfRenderer, PDF_RENDERER, REPORTLAB_AVAILABLE
     from schedule_manager import ScheduleManager
     from notification_service import NotificationService, NotificationType
+    from batch_dispatcher import BatchDispatcher, BatchWindow
+    from route_planner import RoutePlanner
+    import geocoder
     MVP_MODULES_AVAILABLE = True
 except ImportError as e:
     MVP_MODULES_AVAILABLE = False
@@ -48,6 +53,10 @@ DEBUG = os.getenv("DEBUG", "false").lower() == "true"
 ENVIRONMENT = os.getenv("ENVIRONMENT", "production")
 DATABASE_PATH = os.getenv("DATABASE_PATH", "./data/ai_service.db")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+# Город заказа, если клиент его не указал, и город ручного пакетного распределения
+DEFAULT_CITY = os.getenv("DEFAULT_CITY", "Калининград")
+# Назначать мастера жадно при создании заказа, а не пакетом по окну города
+INSTANT_ASSIGNMENT = os.getenv("INSTANT_ASSIGNMENT", "false").lower() == "true"
 
 # ==================== ИНИЦИАЛИЗАЦИЯ БД ====================
 
@@ -79,7 +88,11 @@ def init_database():
             terminal_type TEXT DEFAULT 'smartphone',
             terminal_id TEXT,
             onboarding_conversation_id TEXT,
-            last_schedule_confirmation TIMESTAMP
+            last_schedule_confirmation TIMESTAMP,
+            
+            -- Координаты базы мастера (пакетное распределение)
+            base_lat REAL,
+            base_lon REAL
         )
     """)
     
@@ -116,9 +129,23 @@ def init_database():
             estimated_duration INTEGER,
             urgency_level TEXT DEFAULT 'standard',
             
+            -- Город и координаты адреса (пакетное распределение)
+            city TEXT,
+            address_lat REAL,
+            address_lon REAL,
+            
             FOREIGN KEY (master_id) REFERENCES masters(id)
         )
     """)
+    # Постраничные списки заказов (keyset по created_at, id)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_status_created
+        ON jobs (status, created_at, id)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_master_created
+        ON jobs (master_id, created_at, id)
+    """)
     
     # Таблица транзакций
     cursor.execute("""
@@ -191,10 +218,48 @@ def init_database():
             status TEXT DEFAULT 'pending',
             sent_at TIMESTAMP,
             error TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            
+            -- Повторные попытки доставки
+            channels TEXT,
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TIMESTAMP
         )
     """)
     
+    # Миграция: колонки повторной доставки в старой таблице уведомлений
+    cursor.execute("PRAGMA table_info(notifications)")
+    columns = [col[1] for col in cursor.fetchall()]
+    if 'channels' not in columns:
+        cursor.execute("ALTER TABLE notifications ADD COLUMN channels TEXT")
+    if 'attempts' not in columns:
+        cursor.execute("ALTER TABLE notifications ADD COLUMN attempts INTEGER DEFAULT 0")
+    if 'next_attempt_at' not in columns:
+        cursor.execute("ALTER TABLE notifications ADD COLUMN next_attempt_at TIMESTAMP")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_notifications_retry
+        ON notifications (next_attempt_at)
+        WHERE status = 'retry'
+    """)
+    
+    conn.commit()
+    
+    # Миграция: город и координаты заказов, база мастера (пакетное распределение, маршруты)
+    cursor.execute("PRAGMA table_info(jobs)")
+    columns = [col[1] for col in cursor.fetchall()]
+    if 'city' not in columns:
+        cursor.execute("ALTER TABLE jobs ADD COLUMN city TEXT")
+    if 'address_lat' not in columns:
+        cursor.execute("ALTER TABLE jobs ADD COLUMN address_lat REAL")
+    if 'address_lon' not in columns:
+        cursor.execute("ALTER TABLE jobs ADD COLUMN address_lon REAL")
+    
+    cursor.execute("PRAGMA table_info(masters)")
+    columns = [col[1] for col in cursor.fetchall()]
+    if 'base_lat' not in columns:
+        cursor.execute("ALTER TABLE masters ADD COLUMN base_lat REAL")
+    if 'base_lon' not in columns:
+        cursor.execute("ALTER TABLE masters ADD COLUMN base_lon REAL")
     conn.commit()
     
     # Миграция: добавить telegram_id если его нет
@@ -202,10 +267,17 @@ def init_database():
     columns = [col[1] for col in cursor.fetchall()]
     if 'telegram_id' not in columns:
         print("🔄 Добавляю колонку telegram_id в таблицу masters...")
-        cursor.execute("ALTER TABLE masters ADD COLUMN telegram_id INTEGER UNIQUE")
+        # SQLite не добавляет UNIQUE-колонку через ALTER: уникальность и быстрый
+        # поиск по Telegram ID (в новых БД это делает UNIQUE в CREATE TABLE) - индексом
+        cursor.execute("ALTER TABLE masters ADD COLUMN telegram_id INTEGER")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_masters_telegram_id ON masters(telegram_id)")
         conn.commit()
         print("✅ Миграция завершена!")
     
+    # Слоты расписания и шаблоны недели: схема и перенос schedule_json - в ScheduleManager
+    if MVP_MODULES_AVAILABLE:
+        ScheduleManager(conn)
+    
     conn.close()
 
 # ==================== FASTAPI APP ====================
@@ -350,6 +422,27 @@ if Path("electric-service-automation-main/dist").exists():
 else:
     print("⚠️ React build НЕ найден (соберите: npm run build)")
 
+# Telegram webhook - все боты в процессе API вместо отдельных run_polling
+if os.getenv("TELEGRAM_WEBHOOK_URL"):
+    try:
+        from bot_webhooks import create_webhook_app, WEBHOOK_PATH_PREFIX
+        bot_webhook_app = create_webhook_app()
+        app.mount(WEBHOOK_PATH_PREFIX, bot_webhook_app)
+        app.add_event_handler("startup", bot_webhook_app.startup)
+        app.add_event_handler("shutdown", bot_webhook_app.shutdown)
+        print(f"✅ Telegram webhook монтирован через {WEBHOOK_PATH_PREFIX}: {', '.join(bot_webhook_app.applications)}")
+    except ImportError as e:
+        print(f"⚠️ Telegram webhook не подключен: {e}")
+
+# Менеджер разговоров для поиска и генератор файлов заказов (создаются в startup_event)
+conversation_search = None
+job_file_generator = None
+
+# Окна пакетного распределения: заказы без мастера копятся по городам
+BATCH_DISPATCH_POLL_SECONDS = 1.0
+batch_window = BatchWindow() if MVP_MODULES_AVAILABLE else None
+batch_dispatch_task: Optional[asyncio.Task] = None
+
 # Инициализация БД при старте
 @app.on_event("startup")
 async def startup_event():
@@ -381,6 +474,13 @@ async def startup_event():
     
     init_database()
     
+    # Поиск по разговорам: схема FTS и backfill проверяются один раз за запуск
+    global conversation_search, job_file_generator, batch_dispatch_task
+    if MVP_MODULES_AVAILABLE:
+        conversation_search = ConversationManager(get_db_connection())
+        job_file_generator = JobFileGenerator(get_db_connection(), db_path=DATABASE_PATH)
+        batch_dispatch_task = asyncio.create_task(batch_dispatch_loop())
+    
     # Инициализация Google интеграции
     if GOOGLE_SYNC_AVAILABLE:
         try:
@@ -391,6 +491,16 @@ async def startup_event():
     
     print(f"🚀 AI Service Platform запущен (Environment: {ENVIRONMENT})")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    if batch_dispatch_task is not None:
+        batch_dispatch_task.cancel()
+    if job_file_generator is not None:
+        job_file_generator.close()
+        PDF_RENDERER.close()
+    if MVP_MODULES_AVAILABLE:
+        await geocoder.close_client()
+
 # ==================== МОДЕЛИ ДАННЫХ ====================
 
 class MasterRegister(BaseModel):
@@ -399,6 +509,10 @@ class MasterRegister(BaseModel):
     specializations: List[str] = Field(..., min_items=1)
     city: str = Field(..., min_length=2, max_length=50)
     preferred_channel: str = Field(default="telegram")
+    # База мастера (откуда начинается день): координаты или адрес для геокодера
+    base_address: Optional[str] = None
+    base_lat: Optional[float] = Field(default=None, ge=-90, le=90)
+    base_lon: Optional[float] = Field(default=None, ge=-180, le=180)
 
 class ClientRequest(BaseModel):
     name: str = Field(..., min_length=2, max_length=100)
@@ -406,6 +520,10 @@ class ClientRequest(BaseModel):
     category: str
     problem_description: str = Field(..., min_length=10)
     address: str = Field(..., min_length=5)
+    city: Optional[str] = None
+    # Координаты адреса (с карты на сайте); без них адрес геокодируется
+    address_lat: Optional[float] = Field(default=None, ge=-90, le=90)
+    address_lon: Optional[float] = Field(default=None, ge=-180, le=180)
     photos: Optional[List[str]] = None
 
 class JobStatusUpdate(BaseModel):
@@ -477,6 +595,21 @@ def find_available_master(category: str, city: str) -> Optional[int]:
     
     return result['id'] if result else None
 
+async def resolve_coordinates(
+    lat: Optional[float],
+    lon: Optional[float],
+    address: Optional[str],
+    city: Optional[str]
+) -> Tuple[Optional[float], Optional[float]]:
+    """Переданные координаты или координаты адреса от геокодера; (None, None), если их нет"""
+    if lat is not None and lon is not None:
+        return lat, lon
+    if address and MVP_MODULES_AVAILABLE:
+        coords = await geocoder.geocode_address(address, city)
+        if coords:
+            return coords
+    return None, None
+
 def calculate_platform_fee(amount: float) -> Dict[str, float]:
     """Расчёт комиссий платформы"""
     payment_gateway_fee = amount * 0.02  # 2% платёжный шлюз
@@ -2039,19 +2172,22 @@ async def health_check():
 @app.post("/api/v1/masters/register")
 async def register_master(master: MasterRegister):
     """Регистрация нового мастера"""
+    base = await resolve_coordinates(master.base_lat, master.base_lon, master.base_address, master.city)
+    
     conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
         cursor.execute("""
-            INSERT INTO masters (full_name, phone, specializations, city, preferred_channel)
-            VALUES (?, ?, ?, ?, ?)
+            INSERT INTO masters (full_name, phone, specializations, city, preferred_channel, base_lat, base_lon)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
         """, (
             master.full_name,
             master.phone,
             json.dumps(master.specializations),
             master.city,
-            master.preferred_channel
+            master.preferred_channel,
+            *base
         ))
         
         conn.commit()
@@ -2116,9 +2252,44 @@ async def get_available_masters(category: str, city: Optional[str] = None):
     
     return {"count": len(masters), "masters": masters}
 
-@app.get("/api/v1/masters/{telegram_id}")
+@app.get("/api/v1/masters")
+async def list_masters(status: Optional[str] = None, city: Optional[str] = None):
+    """Список мастеров (status=active - только активные); по нему рассылаются новые заявки"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    query = """
+        SELECT id, full_name, telegram_id, specializations, city, rating, is_active, terminal_active
+        FROM masters
+        WHERE 1=1
+    """
+    params = []
+    
+    if status == "active":
+        query += " AND is_active = 1"
+    elif status == "inactive":
+        query += " AND is_active = 0"
+    elif status:
+        conn.close()
+        raise HTTPException(status_code=400, detail="Неверный статус")
+    
+    if city:
+        query += " AND city = ?"
+        params.append(city)
+    
+    query += " ORDER BY id"
+    
+    cursor.execute(query, params)
+    masters = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    
+    for master in masters:
+        master['specializations'] = json.loads(master['specializations'])
+    return masters
+
+@app.get("/api/v1/masters/by-telegram/{telegram_id}")
 async def get_master_by_telegram(telegram_id: int):
-    """Получить информацию о мастере по Telegram ID"""
+    """Получить информацию о мастере по Telegram ID (поиск по индексу telegram_id)"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -2138,6 +2309,11 @@ async def get_master_by_telegram(telegram_id: int):
     master_dict['specializations'] = json.loads(master_dict['specializations'])
     return master_dict
 
+@app.get("/api/v1/masters/{telegram_id}")
+async def get_master_by_telegram_legacy(telegram_id: int):
+    """Старый адрес поиска по Telegram ID (оставлен для совместимости)"""
+    return await get_master_by_telegram(telegram_id)
+
 @app.patch("/api/v1/masters/{master_id}/terminal")
 async def update_terminal_status(master_id: int, data: dict):
     """Обновить статус терминала мастера"""
@@ -2162,7 +2338,10 @@ async def update_master(master_id: int, data: dict):
     cursor = conn.cursor()
     
     # Поддерживаемые поля для обновления
-    allowed_fields = ['telegram_id', 'phone', 'full_name', 'city', 'specializations', 'terminal_active', 'is_active']
+    allowed_fields = [
+        'telegram_id', 'phone', 'full_name', 'city', 'specializations', 'terminal_active', 'is_active',
+        'base_lat', 'base_lon'
+    ]
     updates = []
     params = []
     
@@ -2247,23 +2426,73 @@ async def get_master_statistics(master_id: int):
     
     return stats
 
+JOBS_PAGE_MAX_LIMIT = 50
+
+def encode_jobs_cursor(job: dict) -> str:
+    """Курсор следующей страницы: позиция последнего заказа (created_at, id)"""
+    raw = f"{job['created_at']}|{job['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_jobs_cursor(cursor: str) -> tuple:
+    """Разобрать курсор страницы, 400 если он испорчен"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, job_id = raw.rsplit("|", 1)
+        return created_at, int(job_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Некорректный курсор страницы")
+
+def fetch_jobs_page(db_cursor, where: str, params: list, limit: Optional[int], page_cursor: Optional[str]):
+    """
+    Заказы по условию, новые сверху.
+    
+    Без limit/cursor - весь список (как раньше). С ними - одна страница
+    {"items": [...], "next_cursor": ...}: keyset по (created_at, id) идёт по
+    индексу и не пропускает и не дублирует заказы при вставке новых.
+    """
+    query = f"SELECT * FROM jobs WHERE {where}"
+    params = list(params)
+    
+    if limit is None and page_cursor is None:
+        db_cursor.execute(query + " ORDER BY created_at DESC, id DESC", params)
+        return [dict(row) for row in db_cursor.fetchall()]
+    
+    limit = max(1, min(limit or JOBS_PAGE_MAX_LIMIT, JOBS_PAGE_MAX_LIMIT))
+    if page_cursor:
+        query += " AND (created_at, id) < (?, ?)"
+        params.extend(decode_jobs_cursor(page_cursor))
+    
+    # Берём на одну запись больше, чтобы узнать, есть ли следующая страница
+    db_cursor.execute(query + " ORDER BY created_at DESC, id DESC LIMIT ?", params + [limit + 1])
+    items = [dict(row) for row in db_cursor.fetchall()]
+    
+    next_cursor = encode_jobs_cursor(items[limit - 1]) if len(items) > limit else None
+    return {"items": items[:limit], "next_cursor": next_cursor}
+
 @app.get("/api/v1/jobs")
-async def get_jobs(status: Optional[str] = None, city: Optional[str] = None):
-    """Получить список заказов"""
+async def get_jobs(
+    status: Optional[str] = None,
+    city: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None
+):
+    """Получить список заказов (постранично, если передан limit или cursor)"""
     conn = get_db_connection()
-    cursor = conn.cursor()
+    db_cursor = conn.cursor()
     
-    query = "SELECT * FROM jobs WHERE 1=1"
+    where = "1=1"
     params = []
     
     if status:
-        query += " AND status = ?"
+        where += " AND status = ?"
         params.append(status)
     
-    query += " ORDER BY created_at DESC"
+    try:
+        result = fetch_jobs_page(db_cursor, where, params, limit, cursor)
+    finally:
+        conn.close()
     
-    cursor.execute(query, params)
-    jobs = [dict(row) for row in cursor.fetchall()]
+    jobs = result if isinstance(result, list) else result["items"]
     
     # Добавляем читабельное название категории
     category_names = {
@@ -2276,26 +2505,37 @@ async def get_jobs(status: Optional[str] = None, city: Optional[str] = None):
     for job in jobs:
         job['category_name'] = category_names.get(job.get('category'), job.get('category'))
     
-    conn.close()
-    
-    return jobs
+    return result
 
 @app.get("/api/v1/masters/{master_id}/jobs")
-async def get_master_jobs_all(master_id: int):
-    """Получить все заказы мастера"""
+async def get_master_jobs_all(master_id: int, limit: Optional[int] = None, cursor: Optional[str] = None):
+    """Получить все заказы мастера (постранично, если передан limit или cursor)"""
     conn = get_db_connection()
-    cursor = conn.cursor()
+    db_cursor = conn.cursor()
     
-    cursor.execute("""
-        SELECT * FROM jobs 
-        WHERE master_id = ? 
-        ORDER BY created_at DESC
-    """, (master_id,))
+    try:
+        result = fetch_jobs_page(db_cursor, "master_id = ?", [master_id], limit, cursor)
+    finally:
+        conn.close()
     
-    jobs = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    return result
+
+@app.get("/api/v1/jobs/{job_id}/file.pdf")
+async def get_job_file_pdf(job_id: int):
+    """Файл заказа в PDF: рендер в пуле процессов, ответ отдаётся частями"""
+    if job_file_generator is None or not REPORTLAB_AVAILABLE:
+        raise HTTPException(status_code=503, detail="PDF файлы заказов недоступны")
     
-    return jobs
+    job_file = await job_file_generator.load_job_file(job_id)
+    if job_file is None:
+        raise HTTPException(status_code=404, detail="Заказ не найден")
+    
+    path = await job_file_generator.export_to_pdf_async(job_file)
+    return StreamingResponse(
+        PdfRenderer.iter_chunks(path),
+        media_type="application/pdf",
+        headers={"Content-Disposition": f'inline; filename="job_{job_id}.pdf"'}
+    )
 
 @app.post("/api/v1/jobs/{job_id}/assign")
 async def assign_job_to_master(job_id: int, data: dict):
@@ -2349,22 +2589,38 @@ async def process_client_request(request: ClientRequest):
     # Расчёт цены
     estimated_price = calculate_pricing(request.category, request.problem_description)
     
-    # Поиск мастера
-    master_id = find_available_master(request.category, "Москва")  # Пока по умолчанию Москва
+    city = request.city or DEFAULT_CITY
+    
+    # Поиск мастера: заказ ждёт пакета своего города, чтобы первые заказы окна
+    # не забирали лучших мастеров у следующих; жадно - по флагу или без пакетов
+    master_id = None
+    if INSTANT_ASSIGNMENT or batch_window is None:
+        master_id = find_available_master(request.category, city)
+    
+    # Координаты адреса - для расстояний в пакетном распределении и маршрута мастера
+    address_lat, address_lon = await resolve_coordinates(
+        request.address_lat, request.address_lon, request.address, city
+    )
     
     # Создание заказа
     conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute("""
-        INSERT INTO jobs (client_name, client_phone, category, problem_description, address, estimated_price, master_id, status)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        INSERT INTO jobs (
+            client_name, client_phone, category, problem_description, address, city,
+            address_lat, address_lon, estimated_price, master_id, status
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     """, (
         request.name,
         request.phone,
         request.category,
         request.problem_description,
         request.address,
+        city,
+        address_lat,
+        address_lon,
         estimated_price,
         master_id,
         'accepted' if master_id else 'pending'
@@ -2374,6 +2630,10 @@ async def process_client_request(request: ClientRequest):
     job_id = cursor.lastrowid
     conn.close()
     
+    # Заказ без мастера ждёт пакетного распределения по городу
+    if not master_id and batch_window is not None:
+        batch_window.job_received(city)
+    
     # 🔥 СИНХРОНИЗАЦИЯ С GOOGLE CALENDAR И TASKS
     google_sync_result = {'calendar_event_id': None, 'task_id': None}
     if GOOGLE_SYNC_AVAILABLE and master_id:
@@ -2419,6 +2679,73 @@ async def process_client_request(request: ClientRequest):
     
     return response
 
+# ==================== РАЗГОВОРЫ ====================
+
+@app.get("/api/v1/conversations/search")
+async def search_conversations(q: str, limit: int = 20, offset: int = 0):
+    """
+    Полнотекстовый поиск по сообщениям разговоров (фраза, телефон, адрес)
+    
+    truncated: true - совпадений больше SEARCH_RANK_WINDOW (2000): по релевантности
+    упорядочены только самые свежие из них, а страницы дальше окна пусты.
+    Запрос стоит уточнить (добавить слово, телефон или адрес).
+    """
+    if conversation_search is None:
+        raise HTTPException(status_code=503, detail="Поиск по разговорам недоступен")
+    
+    results, truncated = conversation_search.search_messages(q, limit=limit, offset=offset)
+    
+    return {"count": len(results), "offset": offset, "truncated": truncated, "results": results}
+
+# ==================== РАСПРЕДЕЛЕНИЕ ЗАКАЗОВ ====================
+
+def run_batch_dispatch(city: str):
+    """Распределить пакет города на своём подключении (вызывается в потоке)"""
+    conn = get_db_connection()
+    try:
+        return BatchDispatcher(conn).dispatch(city)
+    finally:
+        conn.close()
+
+async def batch_dispatch_loop():
+    """Фоновый планировщик: распределяет город, когда истекло окно его пакета"""
+    while True:
+        await asyncio.sleep(BATCH_DISPATCH_POLL_SECONDS)
+        for city in batch_window.due_cities():
+            try:
+                await asyncio.to_thread(run_batch_dispatch, city)
+            except Exception as e:
+                print(f"⚠️ Ошибка пакетного распределения ({city}): {e}")
+
+@app.post("/api/v1/dispatch/batch")
+async def dispatch_pending_jobs(city: str = DEFAULT_CITY):
+    """Распределить все ожидающие заказы города пакетом сейчас, не дожидаясь окна"""
+    if not MVP_MODULES_AVAILABLE:
+        raise HTTPException(status_code=503, detail="Пакетное распределение недоступно")
+    
+    result = await asyncio.to_thread(run_batch_dispatch, city)
+    
+    return result.to_dict()
+
+@app.get("/api/v1/masters/{master_id}/route")
+async def get_master_route(master_id: int, date: Optional[str] = None):
+    """Маршрут мастера на день: порядок объезда заказов и время прибытия"""
+    if not MVP_MODULES_AVAILABLE:
+        raise HTTPException(status_code=503, detail="Планирование маршрутов недоступно")
+    
+    try:
+        day = datetime.strptime(date, "%Y-%m-%d") if date else datetime.now()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Дата должна быть в формате ГГГГ-ММ-ДД")
+    
+    conn = get_db_connection()
+    try:
+        plan = RoutePlanner(conn).plan_master_day(master_id, day)
+    finally:
+        conn.close()
+    
+    return {"master_id": master_id, "date": day.strftime("%Y-%m-%d"), **plan.to_dict()}
+
 # ==================== ТЕРМИНАЛ МАСТЕРА ====================
 
 @app.get("/api/v1/terminal/jobs/{master_id}")
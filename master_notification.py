@@ -3,12 +3,20 @@
 БАЛТСЕТЬ - auto-assign система
 """
 import os
+import asyncio
 import logging
+import time
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime
+from typing import Deque, Optional
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter
 import httpx
 from dotenv import load_dotenv
 
+from notification_service import TokenBucket
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
@@ -16,6 +24,107 @@ logger = logging.getLogger(__name__)
 TELEGRAM_MASTER_BOT_TOKEN = os.getenv("TELEGRAM_MASTER_BOT_TOKEN", "")
 API_URL = os.getenv("API_URL", "https://heallshoking-ai-service-platform-mvp-11-12-2025-2f94.twc1.net")
 
+MAX_CONCURRENT_SENDS = 20  # Одновременных запросов к Telegram
+TELEGRAM_RATE_LIMIT = 30.0  # Сообщений в секунду на бота
+MAX_RETRY_AFTER_ATTEMPTS = 3  # Сколько раз повторять после RetryAfter
+
+# Бот, HTTP-клиент и лимитер живут всё время работы процесса
+_master_bot: Optional[Bot] = None
+_http_client: Optional[httpx.AsyncClient] = None
+_send_limit: Optional[TokenBucket] = None
+_bot_lock = asyncio.Lock()  # Параллельные первые вызовы не создают второго бота
+_shared_clients = False  # Бот и клиент принадлежат webhook-раннеру - не закрываем их сами
+
+
+@dataclass
+class FanoutMetrics:
+    """Скорость рассылки одной заявки"""
+    order_id: int
+    masters: int
+    delivered: int
+    failed: int
+    first_delivery_ms: Optional[float]  # От начала рассылки
+    last_delivery_ms: Optional[float]
+    
+    @property
+    def spread_ms(self) -> Optional[float]:
+        """Сколько последний мастер ждал после первого"""
+        if self.first_delivery_ms is None:
+            return None
+        return self.last_delivery_ms - self.first_delivery_ms
+
+
+# Последние рассылки - для мониторинга
+fanout_metrics: Deque[FanoutMetrics] = deque(maxlen=100)
+
+
+class MasterNotificationError(Exception):
+    """Рассылка не состоялась (нет токена, API или Telegram недоступны) - её стоит повторить"""
+
+
+async def get_master_bot() -> Bot:
+    """Общий экземпляр мастер-бота"""
+    global _master_bot
+    if _master_bot is None:
+        async with _bot_lock:
+            if _master_bot is None:
+                bot = Bot(token=TELEGRAM_MASTER_BOT_TOKEN)
+                await bot.initialize()
+                _master_bot = bot
+    return _master_bot
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Общий HTTP-клиент для запросов к API"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=10.0)
+    return _http_client
+
+
+def use_shared_clients(bot: Bot, http_client: httpx.AsyncClient):
+    """Рассылать через уже запущенного мастер-бота и его HTTP-клиент (все боты в одном процессе)"""
+    global _master_bot, _http_client, _shared_clients
+    _master_bot = bot
+    _http_client = http_client
+    _shared_clients = True
+
+
+async def close_clients():
+    """Закрыть бота и HTTP-клиент при остановке приложения"""
+    global _master_bot, _http_client, _shared_clients
+    if _shared_clients:
+        # Закроет владелец - здесь только забываем ссылки
+        _master_bot = None
+        _http_client = None
+        _shared_clients = False
+        return
+    if _master_bot is not None:
+        await _master_bot.shutdown()
+        _master_bot = None
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def _send_with_retry(bot: Bot, chat_id: int, **kwargs):
+    """Отправить сообщение с учётом общего лимита и RetryAfter от Telegram"""
+    global _send_limit
+    if _send_limit is None:
+        _send_limit = TokenBucket(TELEGRAM_RATE_LIMIT)
+    
+    for attempt in range(MAX_RETRY_AFTER_ATTEMPTS + 1):
+        await _send_limit.acquire()
+        try:
+            return await bot.send_message(chat_id=chat_id, **kwargs)
+        except RetryAfter as e:
+            if attempt == MAX_RETRY_AFTER_ATTEMPTS:
+                raise
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            logger.warning(f"⏳ Telegram просит подождать {retry_after} с (чат {chat_id})")
+            # Флуд-лимит общий на бота: ждут все отправки, а не только эта
+            _send_limit.pause(retry_after)
+
 
 async def notify_masters_about_new_order(
     order_id: int,
@@ -24,92 +133,126 @@ async def notify_masters_about_new_order(
     address: str,
     client_name: str,
     client_phone: str
-):
-    """Уведомить всех активных мастеров о новой заявке"""
+) -> FanoutMetrics:
+    """
+    Уведомить всех активных мастеров о новой заявке (параллельно, с лимитом Telegram)
+    
+    Returns:
+        FanoutMetrics; masters=0 - активных мастеров нет
+    
+    Raises:
+        MasterNotificationError, httpx.HTTPError: мастера не получили заявку,
+        рассылку нужно повторить (очередь заявок повторит её сама)
+    """
     
     if not TELEGRAM_MASTER_BOT_TOKEN:
-        logger.error("❌ TELEGRAM_MASTER_BOT_TOKEN не установлен!")
-        return
+        raise MasterNotificationError("TELEGRAM_MASTER_BOT_TOKEN не установлен")
     
     try:
         # Получаем список активных мастеров из API
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{API_URL}/api/v1/masters",
-                params={"status": "active"},
-                timeout=10.0
+        response = await get_http_client().get(
+            f"{API_URL}/api/v1/masters",
+            params={"status": "active"}
+        )
+        
+        if response.status_code != 200:
+            raise MasterNotificationError(f"Не удалось получить список мастеров: {response.status_code}")
+        
+        masters = response.json()
+        
+        if not masters:
+            logger.warning("⚠️ Нет активных мастеров для уведомления")
+            return FanoutMetrics(
+                order_id=order_id, masters=0, delivered=0, failed=0,
+                first_delivery_ms=None, last_delivery_ms=None
             )
-            
-            if response.status_code != 200:
-                logger.error(f"❌ Не удалось получить список мастеров: {response.status_code}")
-                return
-            
-            masters = response.json()
-            
-            if not masters:
-                logger.warning("⚠️ Нет активных мастеров для уведомления")
-                return
-            
-            # Создаем экземпляр мастер-бота
-            master_bot = Bot(token=TELEGRAM_MASTER_BOT_TOKEN)
-            
-            # Формируем МИЛОЕ сообщение о новой заявке
-            time_now = datetime.now().strftime('%H:%M')
-            notification_message = (
-                f"🆕 <b>Новая заявка для вас!</b> 🚀\n\n"
-                f"📋 <b>Заказ #{order_id}</b>\n"
-                f"⏰ Время: {time_now}\n\n"
-                f"━━━━━━━━━━━━━━\n\n"
-                f"🔧 <b>Категория:</b> {category}\n"
-                f"💬 <b>Проблема:</b>\n{problem[:150]}{'...' if len(problem) > 150 else ''}\n\n"
-                f"📍 <b>Адрес:</b> {address}\n\n"
-                f"━━━━━━━━━━━━━━\n\n"
-                f"👤 <b>Клиент:</b> {client_name}\n"
-                f"📞 <b>Телефон:</b> {client_phone}\n\n"
-                f"🎯 <b>Будьте первым!</b> 🚀\n"
-                f"💡 <i>Первый откликнувшийся получает заказ!</i>"
+        
+        master_bot = await get_master_bot()
+        
+        # Формируем МИЛОЕ сообщение о новой заявке
+        time_now = datetime.now().strftime('%H:%M')
+        notification_message = (
+            f"🆕 <b>Новая заявка для вас!</b> 🚀\n\n"
+            f"📋 <b>Заказ #{order_id}</b>\n"
+            f"⏰ Время: {time_now}\n\n"
+            f"━━━━━━━━━━━━━━\n\n"
+            f"🔧 <b>Категория:</b> {category}\n"
+            f"💬 <b>Проблема:</b>\n{problem[:150]}{'...' if len(problem) > 150 else ''}\n\n"
+            f"📍 <b>Адрес:</b> {address}\n\n"
+            f"━━━━━━━━━━━━━━\n\n"
+            f"👤 <b>Клиент:</b> {client_name}\n"
+            f"📞 <b>Телефон:</b> {client_phone}\n\n"
+            f"🎯 <b>Будьте первым!</b> 🚀\n"
+            f"💡 <i>Первый откликнувшийся получает заказ!</i>"
+        )
+        
+        # Inline кнопка для принятия заявки - ЯРКАЯ И ПРИВЛЕКАТЕЛЬНАЯ
+        keyboard = [[
+            InlineKeyboardButton(
+                "✅ ПРИНЯТЬ ЗАКАЗ 🚀", 
+                callback_data=f"accept_{order_id}"
             )
-            
-            # Inline кнопка для принятия заявки - ЯРКАЯ И ПРИВЛЕКАТЕЛЬНАЯ
-            keyboard = [[
-                InlineKeyboardButton(
-                    "✅ ПРИНЯТЬ ЗАКАЗ 🚀", 
-                    callback_data=f"accept_{order_id}"
-                )
-            ]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            # Отправляем уведомление каждому мастеру
-            notified_count = 0
-            for master in masters:
-                telegram_id = master.get('telegram_id')
-                if telegram_id:
-                    try:
-                        # Отправляем с звуковым уведомлением
-                        await master_bot.send_message(
-                            chat_id=telegram_id,
-                            text=notification_message,
-                            parse_mode='HTML',
-                            reply_markup=reply_markup,
-                            disable_notification=False  # Звуковое уведомление!
-                        )
-                        notified_count += 1
-                        logger.info(f"✅ Мастер {master.get('full_name')} уведомлен")
-                    except Exception as e:
-                        logger.error(f"❌ Ошибка отправки мастеру {master.get('full_name')}: {e}")
-            
-            logger.info(f"✅ Уведомлено мастеров: {notified_count}/{len(masters)}")
-            
+        ]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        # Отправляем всем мастерам параллельно, но не больше MAX_CONCURRENT_SENDS сразу
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+        started = time.perf_counter()
+        delivered_at = []
+        
+        async def notify(master: dict) -> bool:
+            async with semaphore:
+                try:
+                    # Отправляем с звуковым уведомлением
+                    await _send_with_retry(
+                        master_bot,
+                        master['telegram_id'],
+                        text=notification_message,
+                        parse_mode='HTML',
+                        reply_markup=reply_markup,
+                        disable_notification=False  # Звуковое уведомление!
+                    )
+                    delivered_at.append((time.perf_counter() - started) * 1000)
+                    logger.info(f"✅ Мастер {master.get('full_name')} уведомлен")
+                    return True
+                except Exception as e:
+                    logger.error(f"❌ Ошибка отправки мастеру {master.get('full_name')}: {e}")
+                    return False
+        
+        recipients = [master for master in masters if master.get('telegram_id')]
+        results = await asyncio.gather(*(notify(master) for master in recipients))
+        notified_count = sum(results)
+        
+        metrics = FanoutMetrics(
+            order_id=order_id,
+            masters=len(recipients),
+            delivered=notified_count,
+            failed=len(recipients) - notified_count,
+            first_delivery_ms=min(delivered_at) if delivered_at else None,
+            last_delivery_ms=max(delivered_at) if delivered_at else None
+        )
+        fanout_metrics.append(metrics)
+        
+        if recipients and not notified_count:
+            raise MasterNotificationError(f"Заявка #{order_id}: сообщение не доставлено ни одному мастеру")
+        
+        logger.info(f"✅ Уведомлено мастеров: {notified_count}/{len(masters)}")
+        if metrics.spread_ms is not None:
+            logger.info(
+                f"⏱ Заявка #{order_id}: первый мастер через {metrics.first_delivery_ms:.0f} мс, "
+                f"последний через {metrics.last_delivery_ms:.0f} мс"
+            )
+        return metrics
+    
     except Exception as e:
         logger.error(f"❌ Ошибка в notify_masters_about_new_order: {e}")
+        raise
 
 
 if __name__ == "__main__":
     # Тест
-    import asyncio
-    
     async def test():
-        await notify_masters_about_new_order(
+        metrics = await notify_masters_about_new_order(
             order_id=999,
             category="⚡ Электрика",
             problem="Не работает розетка в гостиной",
@@ -117,6 +260,10 @@ if __name__ == "__main__":
             client_name="Иван Тестовый",
             client_phone="+79001234567"
         )
+        if metrics:
+            print(f"✅ Доставлено {metrics.delivered}/{metrics.masters}, "
+                  f"разброс первый-последний {metrics.spread_ms or 0:.0f} мс")
+        await close_clients()
     
     asyncio.run(test())
     print("✅ Тест завершен!")
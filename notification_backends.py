@@ -0,0 +1,264 @@
+"""
+Notification Backends - Channel backends for NotificationService
+Бэкенды каналов: SMTP, локальные приёмники SMS и email для разработки и нагрузочных тестов
+"""
+import asyncio
+import random
+import smtplib
+import sqlite3
+import time
+from email.message import EmailMessage
+from typing import Dict, List, Optional, Tuple
+
+
+class ChannelSendError(Exception):
+    """Канал не принял сообщение"""
+
+
+class _FaultInjection:
+    """Задержка и случайные отказы - чтобы проверять fallback и повторы"""
+    
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+    
+    async def _simulate(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            raise ChannelSendError("Injected failure")
+
+
+class SqliteSmsSink(_FaultInjection):
+    """SMS-бэкенд, который пишет сообщения в таблицу sms_outbox вместо отправки"""
+    
+    def __init__(self, db_path: str = ":memory:", latency: float = 0.0, failure_rate: float = 0.0, seed: Optional[int] = None):
+        super().__init__(latency, failure_rate, seed)
+        self.db = sqlite3.connect(db_path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS sms_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                phone TEXT NOT NULL,
+                message TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self.db.commit()
+        self.sent_at: Dict[str, float] = {}
+    
+    async def send(self, phone: str, message: str):
+        await self._simulate()
+        self.db.execute("INSERT INTO sms_outbox (phone, message) VALUES (?, ?)", (phone, message))
+        self.db.commit()
+        self.sent_at[phone] = time.perf_counter()
+    
+    def count(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM sms_outbox").fetchone()[0]
+
+
+class SmtpEmailBackend(_FaultInjection):
+    """Email-бэкенд через SMTP (smtplib в отдельном потоке)"""
+    
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 25,
+        sender: str = "noreply@localhost",
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        use_tls: bool = False,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        seed: Optional[int] = None
+    ):
+        super().__init__(latency, failure_rate, seed)
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+    
+    def _send_sync(self, email: str, subject: str, message: str):
+        mail = EmailMessage()
+        mail["From"] = self.sender
+        mail["To"] = email
+        mail["Subject"] = subject
+        mail.set_content(message)
+        
+        with smtplib.SMTP(self.host, self.port, timeout=10) as smtp:
+            if self.use_tls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(mail)
+    
+    async def send(self, email: str, subject: str, message: str):
+        await self._simulate()
+        await asyncio.to_thread(self._send_sync, email, subject, message)
+
+
+class LocalSmtpSink:
+    """
+    Минимальный SMTP-сервер, который складывает письма в память
+    
+    Только для разработки и бенчмарков: понимает HELO/EHLO, MAIL, RCPT,
+    DATA, RSET, NOOP и QUIT, без аутентификации и TLS.
+    """
+    
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.messages: List[Tuple[List[str], bytes]] = []  # (получатели, письмо)
+        self.received_at: Dict[str, float] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+    
+    async def start(self) -> int:
+        """Запустить сервер; возвращает порт"""
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+    
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+    
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        async def reply(line: str):
+            writer.write(line.encode() + b"\r\n")
+            await writer.drain()
+        
+        await reply("220 localhost sink")
+        recipients: List[str] = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors="replace").strip()
+                verb = command[:4].upper()
+                
+                if verb == "EHLO":
+                    await reply("250-localhost")
+                    await reply("250 8BITMIME")
+                elif verb in ("HELO", "NOOP"):
+                    await reply("250 OK")
+                elif verb == "MAIL":
+                    recipients = []
+                    await reply("250 OK")
+                elif verb == "RCPT":
+                    recipients.append(command.split(":", 1)[1].strip().strip("<>"))
+                    await reply("250 OK")
+                elif verb == "DATA":
+                    await reply("354 End data with <CR><LF>.<CR><LF>")
+                    body = []
+                    while True:
+                        data_line = await reader.readline()
+                        if data_line in (b".\r\n", b".\n", b""):
+                            break
+                        body.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                    self.messages.append((recipients, b"".join(body)))
+                    now = time.perf_counter()
+                    for recipient in recipients:
+                        self.received_at[recipient] = now
+                    await reply("250 OK")
+                elif verb == "RSET":
+                    recipients = []
+                    await reply("250 OK")
+                elif verb == "QUIT":
+                    await reply("221 Bye")
+                    break
+                else:
+                    await reply("502 Command not implemented")
+        finally:
+            writer.close()
+
+
+class FakeTelegramBot(_FaultInjection):
+    """Заглушка Telegram-бота с задержкой и отказами для бенчмарков"""
+    
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, seed: Optional[int] = None):
+        super().__init__(latency, failure_rate, seed)
+        self.sent_at: Dict[str, float] = {}
+    
+    async def send_message(self, chat_id, text, parse_mode=None):
+        await self._simulate()
+        self.sent_at[str(chat_id)] = time.perf_counter()
+
+
+async def _bench_pipeline(
+    notifications: int = 100000,
+    telegram_failure_rate: float = 0.05,
+    sms_failure_rate: float = 0.05
+):
+    """
+    Нагрузочный прогон через весь конвейер NotificationService
+    
+    Telegram -> SMS -> email: отказы первых двух каналов проверяют fallback,
+    письма уходят по настоящему SMTP в локальный приёмник.
+    """
+    from notification_service import NotificationService, NotificationChannel, NotificationType
+    
+    smtp_sink = LocalSmtpSink()
+    port = await smtp_sink.start()
+    
+    telegram = FakeTelegramBot(latency=0.001, failure_rate=telegram_failure_rate, seed=1)
+    sms = SqliteSmsSink(latency=0.002, failure_rate=sms_failure_rate, seed=2)
+    email = SmtpEmailBackend(host="127.0.0.1", port=port)
+    
+    # Лимиты каналов сняты (получатели разные, лимит чата не мешает):
+    # меряем пропускную способность самого конвейера
+    service = NotificationService(
+        sqlite3.connect(":memory:"),
+        telegram_bot=telegram,
+        sms_client=sms,
+        email_client=email,
+        workers=64,
+        rate_limits={channel: 1e9 for channel in NotificationChannel},
+        coalesce_window=0
+    )
+    
+    channels = [NotificationChannel.TELEGRAM, NotificationChannel.SMS, NotificationChannel.EMAIL]
+    enqueued_at: Dict[str, float] = {}
+    started = time.perf_counter()
+    for i in range(notifications):
+        recipient = f"user{i}@example.com"
+        enqueued_at[recipient] = time.perf_counter()
+        await service.send_notification(
+            recipient, "client", NotificationType.REQUEST_RECEIVED, {"job_id": i}, channels=channels
+        )
+        if i % 1000 == 0:
+            await asyncio.sleep(0)  # Даём воркерам работать во время постановки
+    await service.stop()
+    elapsed = time.perf_counter() - started
+    await smtp_sink.stop()
+    
+    delivered_at = {**smtp_sink.received_at, **sms.sent_at, **telegram.sent_at}
+    latencies = sorted((delivered_at[r] - enqueued_at[r]) * 1000 for r in delivered_at if r in enqueued_at)
+    
+    def percentile(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+    
+    cursor = service.db.cursor()
+    cursor.execute("SELECT status, COUNT(*) FROM notifications GROUP BY status")
+    statuses = dict(cursor.fetchall())
+    stats = service.channel_stats
+    
+    print(f"✅ {notifications} уведомлений за {elapsed:.1f} с: {notifications / elapsed:,.0f}/с")
+    print(f"✅ Задержка постановка -> доставка: p50 {percentile(0.5):.0f} мс, "
+          f"p95 {percentile(0.95):.0f} мс, p99 {percentile(0.99):.0f} мс")
+    print(f"✅ Доставлено: telegram {len(telegram.sent_at)}, sms {sms.count()}, email {len(smtp_sink.messages)}; "
+          f"статусы {statuses}")
+    print(f"✅ Отказы каналов: telegram {stats['telegram']['failures']}/{stats['telegram']['attempts']}, "
+          f"sms {stats['sms']['failures']}/{stats['sms']['attempts']}, "
+          f"email {stats['email']['failures']}/{stats['email']['attempts']}")
+    
+    assert len(telegram.sent_at) + sms.count() + len(smtp_sink.messages) == statuses.get("sent", 0) == notifications
+
+
+if __name__ == "__main__":
+    # Бенчмарк: python notification_backends.py
+    asyncio.run(_bench_pipeline())
@@ -3,9 +3,15 @@ Notification Service - Multi-channel notification delivery
 Сервис многоканальных уведомлений
 """
 import asyncio
-from typing import Dict, List, Optional, Any
+import math
+import random
+import time
+from operator import itemgetter
+from string import Formatter
+from typing import Callable, Dict, List, Optional, Any, Tuple
 from enum import Enum
-from datetime import datetime
+from datetime import datetime, timedelta
+from dataclasses import dataclass
 import json
 
 
@@ -37,6 +43,109 @@ class NotificationType(str, Enum):
     ASSIGNMENT_FAILED = "assignment_failed"
     PAYMENT_ERROR = "payment_error"
     SYSTEM_ERROR = "system_error"
+    
+    # Несколько уведомлений одним сообщением
+    DIGEST = "digest"
+
+
+# Лимиты отправки (сообщений в секунду). Telegram: ~30/с на бота и 1/с в один чат
+CHANNEL_RATE_LIMITS = {
+    NotificationChannel.TELEGRAM: 30.0,
+    NotificationChannel.SMS: 10.0,
+    NotificationChannel.EMAIL: 10.0,
+}
+TELEGRAM_PER_CHAT_RATE = 1.0
+NOTIFICATION_WORKERS = 8  # Параллельных отправок
+STATUS_FLUSH_INTERVAL = 0.5  # Как часто сбрасывать статусы в БД (сек)
+STATUS_FLUSH_BATCH = 200  # ...или сразу, когда накопилось столько
+MAX_DELIVERY_ATTEMPTS = 5  # После стольких попыток - в очередь недоставленных
+RETRY_BASE_SECONDS = 30.0  # Первая повторная попытка; дальше задержка удваивается
+RETRY_MAX_SECONDS = 3600.0
+RETRY_POLL_INTERVAL = 5.0  # Как часто искать уведомления, которым пора повторить
+RETRY_BATCH = 100
+COALESCE_WINDOW_SECONDS = 10.0  # Окно склейки уведомлений одному получателю (0 - выключено)
+DIGEST_SEPARATOR = "\n\n━━━━━━━━━━━━━━\n\n"
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше burst подряд"""
+    
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def pause(self, seconds: float):
+        """Не выдавать токены seconds секунд (сервер попросил подождать)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    async def acquire(self):
+        """Дождаться токена"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if self.paused_until > now:
+                    await asyncio.sleep(self.paused_until - now)
+                    # За паузу токены не копятся: после неё - обычный темп
+                    self.tokens = 0.0
+                    self.updated = time.monotonic()
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    break
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+            self.tokens -= 1
+    
+    @property
+    def idle(self) -> bool:
+        """Ведро полное - ограничитель можно выбросить"""
+        self._refill()
+        return self.tokens >= self.burst
+
+
+def retry_delay(attempts: int, base_seconds: float, max_seconds: float) -> float:
+    """Экспоненциальная задержка перед попыткой attempts + 1 с джиттером (от половины до полной)"""
+    delay = min(max_seconds, base_seconds * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+@dataclass
+class QueuedNotification:
+    """Уведомление в очереди на отправку"""
+    notification_id: int
+    recipient_id: str
+    channels: List[NotificationChannel]
+    title: str
+    message: str
+    attempts: int = 0  # Сколько попыток уже было
+
+
+@dataclass
+class _BufferedNotification:
+    """Уведомление, отложенное до конца окна склейки"""
+    recipient_type: str
+    notification_type: NotificationType
+    channels: List[NotificationChannel]
+    rendered: Dict[str, str]
+    data: Dict[str, Any]
+
+
+class _RecipientWindow:
+    """Окно склейки: что уже ушло получателю и что ждёт сводки"""
+    
+    def __init__(self):
+        self.started = time.monotonic()
+        self.sent: Dict[Tuple[str, Any], str] = {}  # ключ -> текст
+        self.buffered: Dict[Tuple[str, Any], _BufferedNotification] = {}
+        self.flush_task: Optional[asyncio.Task] = None
 
 
 class NotificationTemplate:
@@ -101,36 +210,173 @@ class NotificationTemplate:
     @classmethod
     def render(cls, notification_type: NotificationType, data: Dict[str, Any]) -> Dict[str, str]:
         """Рендер шаблона с данными"""
-        template = cls.TEMPLATES.get(notification_type, {
-            "title": "Уведомление",
-            "message": str(data)
-        })
+        return TEMPLATE_REGISTRY.render(notification_type, data)
+
+
+def compile_template(text: str) -> Tuple[Callable[[Dict[str, Any]], str], frozenset]:
+    """
+    Разобрать шаблон один раз и собрать функцию рендера
+    
+    Плейсхолдеры - только имена ({job_id}, {price:.0f}); обращения к
+    атрибутам и индексам запрещены. Из разобранных кусков (литерал, поле,
+    формат) собирается строка с позиционными полями ({0}, {1:.0f}), рендер -
+    один str.format по значениям из data. Код из текста шаблона не
+    выполняется.
+    
+    Returns:
+        (функция data -> строка, множество имён плейсхолдеров)
+    """
+    pieces = []
+    names = []
+    for literal, field, spec, conversion in Formatter().parse(text):
+        pieces.append(literal.replace("{", "{{").replace("}", "}}"))
+        if field is None:
+            continue
+        if not field.isidentifier():
+            raise ValueError(f"Недопустимый плейсхолдер {{{field}}}")
+        if spec and "{" in spec:
+            raise ValueError(f"Вложенный формат в {{{field}:{spec}}} не поддерживается")
+        pieces.append(
+            "{" + str(len(names)) + (f"!{conversion}" if conversion else "") + (f":{spec}" if spec else "") + "}"
+        )
+        names.append(field)
+    
+    positional = "".join(pieces)
+    if not names:
+        return lambda d: positional.format(), frozenset()
+    
+    render = positional.format
+    if len(names) == 1:
+        name = names[0]
+        return lambda d: render(d[name]), frozenset(names)
+    values = itemgetter(*names)
+    return lambda d: render(*values(d)), frozenset(names)
+
+
+@dataclass
+class CompiledTemplate:
+    """Шаблон, разобранный при загрузке"""
+    title_text: str
+    message_text: str
+    title: Callable[[Dict[str, Any]], str]
+    message: Callable[[Dict[str, Any]], str]
+    fields: frozenset
+    
+    @staticmethod
+    def compile(title: str, message: str) -> 'CompiledTemplate':
+        render_title, title_fields = compile_template(title)
+        render_message, message_fields = compile_template(message)
+        return CompiledTemplate(title, message, render_title, render_message, title_fields | message_fields)
+
+
+class TemplateRegistry:
+    """Скомпилированные шаблоны; можно перезагрузить без перезапуска"""
+    
+    def __init__(self, templates: Dict[NotificationType, Dict[str, str]]):
+        self._compiled: Dict[NotificationType, CompiledTemplate] = {}
+        self.reload(templates)
+    
+    def reload(self, templates: Dict[NotificationType, Dict[str, str]]):
+        """Скомпилировать все шаблоны и подменить разом (при ошибке остаются старые)"""
+        compiled = {}
+        for notification_type, template in templates.items():
+            try:
+                compiled[notification_type] = CompiledTemplate.compile(template["title"], template["message"])
+            except (KeyError, ValueError) as e:
+                raise ValueError(f"Шаблон {notification_type.value}: {e}") from e
+        self._compiled = compiled
+    
+    def get(self, notification_type: NotificationType) -> Optional[CompiledTemplate]:
+        return self._compiled.get(notification_type)
+    
+    def render(self, notification_type: NotificationType, data: Dict[str, Any]) -> Dict[str, str]:
+        """Рендер шаблона с данными"""
+        template = self._compiled.get(notification_type)
+        if template is None:
+            return {"title": "Уведомление", "message": str(data)}
         
         try:
-            return {
-                "title": template["title"].format(**data),
-                "message": template["message"].format(**data)
-            }
-        except KeyError as e:
+            return {"title": template.title(data), "message": template.message(data)}
+        except KeyError:
             # Если не хватает данных, вернуть шаблон как есть
             return {
-                "title": template["title"],
-                "message": template["message"] + f"\n\nДанные: {data}"
+                "title": template.title_text,
+                "message": template.message_text + f"\n\nДанные: {data}"
             }
+    
+    def render_many(self, notification_type: NotificationType, rows: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        """Рендер одного шаблона для многих получателей (рассылки)"""
+        template = self._compiled.get(notification_type)
+        if template is None:
+            return [self.render(notification_type, data) for data in rows]
+        
+        render_title = template.title
+        render_message = template.message
+        rendered = []
+        for data in rows:
+            try:
+                rendered.append({"title": render_title(data), "message": render_message(data)})
+            except KeyError:
+                rendered.append(self.render(notification_type, data))
+        return rendered
+
+
+TEMPLATE_REGISTRY = TemplateRegistry(NotificationTemplate.TEMPLATES)
 
 
 class NotificationService:
     """Сервис уведомлений"""
     
-    def __init__(self, db_connection, telegram_bot=None, sms_client=None, email_client=None):
+    def __init__(
+        self,
+        db_connection,
+        telegram_bot=None,
+        sms_client=None,
+        email_client=None,
+        workers: int = NOTIFICATION_WORKERS,
+        rate_limits: Optional[Dict[NotificationChannel, float]] = None,
+        max_attempts: int = MAX_DELIVERY_ATTEMPTS,
+        retry_base_seconds: float = RETRY_BASE_SECONDS,
+        coalesce_window: float = COALESCE_WINDOW_SECONDS
+    ):
         self.db = db_connection
         self.telegram_bot = telegram_bot
         self.sms_client = sms_client
         self.email_client = email_client
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.coalesce_window = coalesce_window
+        
+        limits = dict(CHANNEL_RATE_LIMITS, **(rate_limits or {}))
+        self._channel_limits = {channel: TokenBucket(rate) for channel, rate in limits.items()}
+        # Чат -> когда в него можно отправлять (inf - отправка уже идёт)
+        self._chat_ready: Dict[str, float] = {}
+        
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._status_updates: List[Tuple] = []
+        self._flush_needed: Optional[asyncio.Event] = None
+        
+        # Попытки и ошибки доставки по каналам с момента запуска
+        self.channel_stats: Dict[str, Dict[str, int]] = {
+            channel.value: {"attempts": 0, "failures": 0} for channel in NotificationChannel
+        }
+        
+        # Склейка: окна по получателям и счётчики сэкономленных отправок
+        self._windows: Dict[str, _RecipientWindow] = {}
+        self.coalesce_stats: Dict[str, int] = {
+            "received": 0, "sent": 0, "suppressed": 0, "merged": 0, "digested": 0
+        }
+        
         self._init_notifications_table()
     
     def _init_notifications_table(self):
-        """Инициализация таблицы уведомлений"""
+        """
+        Инициализация таблицы уведомлений
+        
+        Миграции старой таблицы и индекс повторов - в init_database (main.py)
+        """
         cursor = self.db.cursor()
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS notifications (
@@ -145,21 +391,76 @@ class NotificationService:
                 status TEXT DEFAULT 'pending',
                 sent_at TIMESTAMP,
                 error TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                
+                -- Повторные попытки доставки
+                channels TEXT,
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at TIMESTAMP
             )
         """)
         self.db.commit()
     
+    # ==================== ОЧЕРЕДЬ И ВОРКЕРЫ ====================
+    
+    async def start(self):
+        """Запустить воркеры доставки и вернуть в очередь уведомления, не отправленные до падения"""
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._flush_needed = asyncio.Event()
+        recovered = self._load_unsent()
+        for item in recovered:
+            self._queue.put_nowait(item)
+        if recovered:
+            print(f"♻️ Из очереди уведомлений восстановлено: {len(recovered)}")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._status_flusher()))
+        self._tasks.append(asyncio.create_task(self._retry_scheduler()))
+    
+    async def stop(self):
+        """Доставить всё из очереди, остановить воркеры и записать статусы"""
+        # Отложенные сводки отправляем сразу, не дожидаясь конца окна
+        for recipient_id, window in list(self._windows.items()):
+            if window.flush_task:
+                window.flush_task.cancel()
+            if window.buffered:
+                await self._flush_window(recipient_id)
+        
+        if self._queue is None:
+            return
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._flush_status_updates()
+    
     async def send_notification(
         self,
         recipient_id: str,
         recipient_type: str,  # 'client', 'master', 'admin'
         notification_type: NotificationType,
         data: Dict[str, Any],
-        channels: List[NotificationChannel] = None
-    ):
-        """Отправить уведомление"""
+        channels: List[NotificationChannel] = None,
+        entity_id: Any = None
+    ) -> Optional[int]:
+        """
+        Поставить уведомление в очередь
+        
+        Возвращает сразу после записи в БД; отправкой занимаются воркеры.
+        Первое уведомление получателю уходит сразу, следующие в течение
+        coalesce_window склеиваются по ключу (тип, сущность): точные повторы
+        отбрасываются, обновления одной сущности заменяют друг друга,
+        остальное уходит одной сводкой в конце окна.
         
+        Args:
+            entity_id: Сущность для склейки (по умолчанию data["job_id"])
+        
+        Returns:
+            ID уведомления или None, если оно отложено или отброшено
+        """
         # Если каналы не указаны, определить автоматически
         if not channels:
             channels = await self._get_preferred_channels(recipient_id, recipient_type)
@@ -167,44 +468,434 @@ class NotificationService:
         # Рендер шаблона
         rendered = NotificationTemplate.render(notification_type, data)
         
+        if self.coalesce_window > 0:
+            if entity_id is None:
+                entity_id = data.get("job_id")
+            if self._coalesce(recipient_id, recipient_type, notification_type, channels, rendered, data, entity_id):
+                return None
+        
+        return await self._enqueue(recipient_id, recipient_type, notification_type, channels, rendered, data)
+    
+    def _coalesce(
+        self,
+        recipient_id: str,
+        recipient_type: str,
+        notification_type: NotificationType,
+        channels: List[NotificationChannel],
+        rendered: Dict[str, str],
+        data: Dict[str, Any],
+        entity_id: Any
+    ) -> bool:
+        """Склеить с окном получателя; True - отправлять сейчас не нужно"""
+        stats = self.coalesce_stats
+        stats["received"] += 1
+        key = (notification_type.value, entity_id)
+        now = time.monotonic()
+        
+        window = self._windows.get(recipient_id)
+        if window is None or (now - window.started > self.coalesce_window and not window.buffered):
+            if len(self._windows) > 10000:
+                self._windows = {
+                    chat_id: chat_window for chat_id, chat_window in self._windows.items()
+                    if chat_window.buffered or now - chat_window.started <= self.coalesce_window
+                }
+            window = self._windows[recipient_id] = _RecipientWindow()
+            window.sent[key] = rendered["message"]
+            stats["sent"] += 1
+            return False
+        
+        buffered = window.buffered.get(key)
+        if window.sent.get(key) == rendered["message"] or (buffered and buffered.rendered["message"] == rendered["message"]):
+            stats["suppressed"] += 1
+            return True
+        
+        if buffered:
+            # Более свежее состояние той же сущности заменяет прежнее
+            stats["merged"] += 1
+            del window.buffered[key]
+        
+        window.buffered[key] = _BufferedNotification(recipient_type, notification_type, channels, rendered, data)
+        if window.flush_task is None:
+            delay = max(0.0, window.started + self.coalesce_window - now)
+            window.flush_task = asyncio.create_task(self._flush_later(recipient_id, delay))
+        return True
+    
+    async def _flush_later(self, recipient_id: str, delay: float):
+        await asyncio.sleep(delay)
+        await self._flush_window(recipient_id)
+    
+    async def _flush_window(self, recipient_id: str) -> Optional[int]:
+        """Отправить отложенное получателю: одно уведомление или сводку"""
+        window = self._windows.get(recipient_id)
+        if window is None or not window.buffered:
+            return None
+        items = list(window.buffered.values())
+        
+        # Новое окно: сразу после сводки повтор тех же сообщений не нужен
+        next_window = self._windows[recipient_id] = _RecipientWindow()
+        next_window.sent = {key: item.rendered["message"] for key, item in window.buffered.items()}
+        self.coalesce_stats["sent"] += 1
+        
+        if len(items) == 1:
+            item = items[0]
+            return await self._enqueue(
+                recipient_id, item.recipient_type, item.notification_type,
+                item.channels, item.rendered, item.data
+            )
+        
+        self.coalesce_stats["digested"] += len(items) - 1
+        rendered = {
+            "title": f"Новых уведомлений: {len(items)}",
+            "message": DIGEST_SEPARATOR.join(
+                f"<b>{item.rendered['title']}</b>\n{item.rendered['message']}" for item in items
+            )
+        }
+        return await self._enqueue(
+            recipient_id, items[0].recipient_type, NotificationType.DIGEST, items[0].channels, rendered,
+            {"items": [{"type": item.notification_type.value, **item.data} for item in items]}
+        )
+    
+    @property
+    def sends_saved(self) -> int:
+        """Сколько отправок сэкономила склейка"""
+        stats = self.coalesce_stats
+        return stats["suppressed"] + stats["merged"] + stats["digested"]
+    
+    async def _enqueue(
+        self,
+        recipient_id: str,
+        recipient_type: str,
+        notification_type: NotificationType,
+        channels: List[NotificationChannel],
+        rendered: Dict[str, str],
+        data: Dict[str, Any]
+    ) -> int:
+        """Записать уведомление и поставить в очередь воркеров"""
+        # Сначала запуск: восстановление при старте не должно подхватить эту же строку
+        await self.start()
+        
         # Сохранить в БД
         notification_id = self._save_notification(
             recipient_id, recipient_type, notification_type,
-            channels[0] if channels else NotificationChannel.TELEGRAM,
-            rendered["title"], rendered["message"], data
+            channels, rendered["title"], rendered["message"], data
         )
         
-        # Отправить по всем каналам
-        success = False
+        self._queue.put_nowait(QueuedNotification(
+            notification_id=notification_id,
+            recipient_id=recipient_id,
+            channels=channels,
+            title=rendered["title"],
+            message=rendered["message"]
+        ))
+        
+        return notification_id
+    
+    async def broadcast(
+        self,
+        recipients: List[Tuple[str, Dict[str, Any]]],
+        recipient_type: str,
+        notification_type: NotificationType,
+        channels: List[NotificationChannel] = None
+    ) -> List[int]:
+        """
+        Массовая рассылка: рендер пачкой, одна транзакция на все строки
+        
+        Args:
+            recipients: Пары (получатель, данные для шаблона)
+        
+        Returns:
+            ID уведомлений в порядке получателей
+        """
+        if not recipients:
+            return []
+        channels = channels or [NotificationChannel.TELEGRAM]
+        channel_names = ",".join(channel.value for channel in channels)
+        rendered = TEMPLATE_REGISTRY.render_many(notification_type, [data for _, data in recipients])
+        
+        await self.start()
+        cursor = self.db.cursor()
+        cursor.executemany("""
+            INSERT INTO notifications (
+                recipient_id, recipient_type, notification_type,
+                channel, channels, title, message, data_json, status
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'pending')
+        """, [
+            (
+                recipient_id, recipient_type, notification_type.value,
+                channels[0].value, channel_names, message["title"], message["message"],
+                json.dumps(data, ensure_ascii=False)
+            )
+            for (recipient_id, data), message in zip(recipients, rendered)
+        ])
+        # Транзакция держит блокировку записи, поэтому ID идут подряд
+        cursor.execute("SELECT MAX(id) FROM notifications")
+        last_id = cursor.fetchone()[0]
+        self.db.commit()
+        notification_ids = list(range(last_id - len(recipients) + 1, last_id + 1))
+        
+        for notification_id, (recipient_id, _), message in zip(notification_ids, recipients, rendered):
+            self._queue.put_nowait(QueuedNotification(
+                notification_id=notification_id,
+                recipient_id=recipient_id,
+                channels=channels,
+                title=message["title"],
+                message=message["message"]
+            ))
+        
+        return notification_ids
+    
+    async def _worker(self):
+        """Воркер: берёт уведомления из очереди и доставляет"""
+        while True:
+            item = await self._queue.get()
+            
+            delay = self._claim_chat(item)
+            if delay:
+                # Чат на лимите: воркер не ждёт, уведомление вернётся в очередь к своему слоту
+                asyncio.get_running_loop().call_later(delay, self._requeue_deferred, item)
+                continue
+            
+            try:
+                await self._deliver(item)
+            except Exception as e:
+                self._schedule_retry(item, str(e))
+            finally:
+                self._release_chat(item)
+                self._queue.task_done()
+    
+    def _claim_chat(self, item: QueuedNotification) -> float:
+        """
+        Занять чат получателя под отправку в Telegram
+        
+        Returns:
+            0 - чат занят этим уведомлением, иначе через сколько секунд повторить
+        """
+        if NotificationChannel.TELEGRAM not in item.channels:
+            return 0.0
+        
+        now = time.monotonic()
+        ready = self._chat_ready.get(item.recipient_id, 0.0)
+        if ready > now:
+            return ready - now if ready != math.inf else 1 / TELEGRAM_PER_CHAT_RATE
+        
+        if len(self._chat_ready) > 10000:
+            # Чаты без недавних отправок больше не ограничены
+            self._chat_ready = {
+                chat_id: chat_ready
+                for chat_id, chat_ready in self._chat_ready.items()
+                if chat_ready > now
+            }
+        self._chat_ready[item.recipient_id] = math.inf
+        return 0.0
+    
+    def _release_chat(self, item: QueuedNotification):
+        """Освободить чат, если до Telegram дело не дошло (отправил другой канал)"""
+        if self._chat_ready.get(item.recipient_id) == math.inf:
+            del self._chat_ready[item.recipient_id]
+    
+    def _requeue_deferred(self, item: QueuedNotification):
+        """Вернуть отложенное уведомление в очередь (task_done - только после put, чтобы join его ждал)"""
+        self._queue.put_nowait(item)
+        self._queue.task_done()
+    
+    async def _deliver(self, item: QueuedNotification) -> bool:
+        """Отправить по каналам по очереди, пока один не сработает"""
         errors = []
         
-        for channel in channels:
+        for channel in item.channels:
             try:
+                await self._acquire_rate_limit(channel, item.recipient_id)
+                self.channel_stats[channel.value]["attempts"] += 1
                 if channel == NotificationChannel.TELEGRAM:
-                    await self._send_telegram(recipient_id, rendered["title"], rendered["message"])
-                    success = True
-                    break  # Если Telegram успешно, не пробуем другие
+                    await self._send_telegram(item.recipient_id, item.title, item.message)
                 elif channel == NotificationChannel.SMS:
-                    await self._send_sms(recipient_id, rendered["message"])
-                    success = True
-                    break
+                    await self._send_sms(item.recipient_id, item.message)
                 elif channel == NotificationChannel.EMAIL:
-                    await self._send_email(recipient_id, rendered["title"], rendered["message"])
-                    success = True
-                    break
+                    await self._send_email(item.recipient_id, item.title, item.message)
+                else:
+                    continue
+                
+                self._queue_status(item.notification_id, "sent", attempts=item.attempts + 1)
+                return True
             except Exception as e:
+                self.channel_stats[channel.value]["failures"] += 1
                 errors.append(f"{channel.value}: {str(e)}")
         
-        # Обновить статус
-        if success:
-            self._update_notification_status(notification_id, "sent")
-        else:
-            self._update_notification_status(
-                notification_id, "failed",
-                error="; ".join(errors)
-            )
+        self._schedule_retry(item, "; ".join(errors))
+        return False
+    
+    def _schedule_retry(self, item: QueuedNotification, error: str):
+        """Запланировать повтор или отправить в недоставленные"""
+        attempts = item.attempts + 1
+        if attempts >= self.max_attempts:
+            self._queue_status(item.notification_id, "dead", error=error, attempts=attempts)
+            return
+        
+        delay = retry_delay(attempts, self.retry_base_seconds, RETRY_MAX_SECONDS)
+        next_attempt_at = datetime.now() + timedelta(seconds=delay)
+        self._queue_status(
+            item.notification_id, "retry", error=error,
+            attempts=attempts, next_attempt_at=next_attempt_at.isoformat()
+        )
+    
+    async def _retry_scheduler(self):
+        """Периодически возвращать в очередь уведомления, которым пора повторить"""
+        while True:
+            await asyncio.sleep(RETRY_POLL_INTERVAL)
+            self.requeue_due_retries()
+    
+    def requeue_due_retries(self) -> int:
+        """Поставить в очередь уведомления с наступившим next_attempt_at"""
+        if self._queue is None:
+            return 0
+        # Сначала записываем свежие статусы, иначе повтор может потеряться
+        self._flush_status_updates()
+        
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT id, recipient_id, channels, channel, title, message, attempts
+            FROM notifications
+            WHERE status = 'retry' AND next_attempt_at <= ?
+            ORDER BY next_attempt_at
+            LIMIT ?
+        """, (datetime.now().isoformat(), RETRY_BATCH))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+        
+        cursor.executemany(
+            "UPDATE notifications SET status = 'queued' WHERE id = ?",
+            [(row[0],) for row in rows]
+        )
+        self.db.commit()
+        
+        for row in rows:
+            self._queue.put_nowait(self._queued_from_row(row))
+        return len(rows)
+    
+    @staticmethod
+    def _queued_from_row(row) -> QueuedNotification:
+        notification_id, recipient_id, channels, channel, title, message, attempts = row
+        return QueuedNotification(
+            notification_id=notification_id,
+            recipient_id=recipient_id,
+            channels=[NotificationChannel(value) for value in (channels or channel).split(",")],
+            title=title,
+            message=message,
+            attempts=attempts or 0
+        )
+    
+    def _load_unsent(self) -> List[QueuedNotification]:
+        """Уведомления, записанные или взятые в очередь, но не отправленные (процесс упал)"""
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT id, recipient_id, channels, channel, title, message, attempts
+            FROM notifications
+            WHERE status IN ('pending', 'queued')
+            ORDER BY id
+        """)
+        return [self._queued_from_row(row) for row in cursor.fetchall()]
+    
+    def get_dead_letters(self, limit: int = 50) -> List[Dict]:
+        """Уведомления, которые не удалось доставить за все попытки"""
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT id, recipient_id, recipient_type, notification_type, channels,
+                attempts, error, created_at
+            FROM notifications
+            WHERE status = 'dead'
+            ORDER BY id DESC
+            LIMIT ?
+        """, (limit,))
+        columns = [col[0] for col in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    
+    def requeue_dead_letter(self, notification_id: int) -> bool:
+        """Вернуть недоставленное уведомление в повтор (попытки с нуля)"""
+        cursor = self.db.cursor()
+        cursor.execute("""
+            UPDATE notifications
+            SET status = 'retry', attempts = 0, next_attempt_at = ?
+            WHERE id = ? AND status = 'dead'
+        """, (datetime.now().isoformat(), notification_id))
+        self.db.commit()
+        return cursor.rowcount > 0
+    
+    def get_retry_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Статистика повторов по основному каналу уведомления"""
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT channel,
+                COUNT(*),
+                SUM(status = 'sent'),
+                SUM(attempts > 1 OR status = 'retry'),
+                SUM(status = 'dead')
+            FROM notifications
+            GROUP BY channel
+        """)
+        stats = {}
+        for channel, total, sent, retried, dead in cursor.fetchall():
+            stats[channel] = {
+                "total": total,
+                "sent": sent,
+                "retried": retried,
+                "dead": dead,
+                "retry_rate": round(retried / total, 4) if total else 0.0
+            }
+        return stats
+    
+    async def _acquire_rate_limit(self, channel: NotificationChannel, recipient_id: str):
+        """
+        Подождать общий лимит канала
         
-        return success
+        Лимит чата Telegram здесь не ждём: чат уже занят воркером в
+        _claim_chat, остаётся отметить, когда в него можно писать снова.
+        """
+        limit = self._channel_limits.get(channel)
+        if limit:
+            await limit.acquire()
+        
+        if channel == NotificationChannel.TELEGRAM:
+            self._chat_ready[recipient_id] = time.monotonic() + 1 / TELEGRAM_PER_CHAT_RATE
+    
+    def _queue_status(
+        self,
+        notification_id: int,
+        status: str,
+        error: str = None,
+        attempts: int = None,
+        next_attempt_at: str = None
+    ):
+        """Запомнить новый статус; в БД он попадёт пакетом"""
+        sent_at = datetime.now().isoformat() if status == "sent" else None
+        self._status_updates.append((status, sent_at, error, attempts, next_attempt_at, notification_id))
+        if len(self._status_updates) >= STATUS_FLUSH_BATCH and self._flush_needed:
+            self._flush_needed.set()
+    
+    async def _status_flusher(self):
+        """Периодически записывать накопленные статусы одной транзакцией"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=STATUS_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            self._flush_status_updates()
+    
+    def _flush_status_updates(self):
+        """Записать накопленные статусы"""
+        if not self._status_updates:
+            return
+        updates, self._status_updates = self._status_updates, []
+        
+        cursor = self.db.cursor()
+        cursor.executemany("""
+            UPDATE notifications
+            SET status = ?, sent_at = COALESCE(?, sent_at), error = ?,
+                attempts = COALESCE(?, attempts), next_attempt_at = ?
+            WHERE id = ?
+        """, updates)
+        self.db.commit()
     
     async def _get_preferred_channels(
         self,
@@ -237,67 +928,43 @@ class NotificationService:
         if not self.sms_client:
             raise Exception("SMS client not configured")
         
-        # TODO: Интеграция с SMS провайдером (SMS.ru, Twilio, etc)
-        # await self.sms_client.send(phone, message)
-        raise Exception("SMS not implemented yet")
+        # Любой backend с async send(phone, message) - см. notification_backends
+        await self.sms_client.send(phone, message)
     
     async def _send_email(self, email: str, subject: str, message: str):
         """Отправить Email"""
         if not self.email_client:
             raise Exception("Email client not configured")
         
-        # TODO: Интеграция с SMTP
-        # await self.email_client.send(email, subject, message)
-        raise Exception("Email not implemented yet")
+        # Любой backend с async send(email, subject, message) - см. notification_backends
+        await self.email_client.send(email, subject, message)
     
     def _save_notification(
         self,
         recipient_id: str,
         recipient_type: str,
         notification_type: NotificationType,
-        channel: NotificationChannel,
+        channels: List[NotificationChannel],
         title: str,
         message: str,
         data: Dict
     ) -> int:
         """Сохранить уведомление в БД"""
+        channel = channels[0] if channels else NotificationChannel.TELEGRAM
         cursor = self.db.cursor()
         cursor.execute("""
             INSERT INTO notifications (
                 recipient_id, recipient_type, notification_type,
-                channel, title, message, data_json, status
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, 'pending')
+                channel, channels, title, message, data_json, status
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'pending')
         """, (
             recipient_id, recipient_type, notification_type.value,
-            channel.value, title, message, json.dumps(data, ensure_ascii=False)
+            channel.value, ",".join(c.value for c in channels) or channel.value,
+            title, message, json.dumps(data, ensure_ascii=False)
         ))
         self.db.commit()
         return cursor.lastrowid
     
-    def _update_notification_status(
-        self,
-        notification_id: int,
-        status: str,
-        error: str = None
-    ):
-        """Обновить статус уведомления"""
-        cursor = self.db.cursor()
-        
-        if status == "sent":
-            cursor.execute("""
-                UPDATE notifications
-                SET status = ?, sent_at = ?
-                WHERE id = ?
-            """, (status, datetime.now().isoformat(), notification_id))
-        else:
-            cursor.execute("""
-                UPDATE notifications
-                SET status = ?, error = ?
-                WHERE id = ?
-            """, (status, error, notification_id))
-        
-        self.db.commit()
-    
     # Вспомогательные методы для частых уведомлений
     
     async def notify_client_request_received(self, client_phone: str, job_id: int):
@@ -373,3 +1040,259 @@ class NotificationService:
                 "daily_total": daily_total
             }
         )
+
+
+async def _check_worker_pool(messages: int = 120, chats: int = 40):
+    """Проверка очереди: вызов возвращается сразу, лимиты Telegram соблюдаются"""
+    import sqlite3
+    
+    class FakeBot:
+        def __init__(self):
+            self.sent: List[Tuple[float, str]] = []
+        
+        async def send_message(self, chat_id, text, parse_mode=None):
+            await asyncio.sleep(0.01)  # Сетевая задержка
+            self.sent.append((time.monotonic(), chat_id))
+    
+    bot = FakeBot()
+    service = NotificationService(sqlite3.connect(":memory:"), telegram_bot=bot, coalesce_window=0)
+    
+    started = time.monotonic()
+    for i in range(messages):
+        await service.send_notification(
+            recipient_id=str(i % chats),
+            recipient_type="master",
+            notification_type=NotificationType.REQUEST_RECEIVED,
+            data={"job_id": i},
+            channels=[NotificationChannel.TELEGRAM]
+        )
+    enqueue_ms = (time.monotonic() - started) * 1000 / messages
+    
+    await service.stop()
+    elapsed = time.monotonic() - started
+    
+    times = sorted(sent_at for sent_at, _ in bot.sent)
+    global_limit = CHANNEL_RATE_LIMITS[NotificationChannel.TELEGRAM]
+    assert len(times) == messages
+    assert all(times[i + int(global_limit)] - times[i] >= 1 - 0.05 for i in range(len(times) - int(global_limit))), \
+        "Превышен общий лимит Telegram"
+    
+    by_chat: Dict[str, List[float]] = {}
+    for sent_at, chat_id in bot.sent:
+        by_chat.setdefault(chat_id, []).append(sent_at)
+    for chat_times in by_chat.values():
+        chat_times.sort()
+        assert all(b - a >= 1 / TELEGRAM_PER_CHAT_RATE - 0.05 for a, b in zip(chat_times, chat_times[1:])), \
+            "Превышен лимит на чат"
+    
+    cursor = service.db.cursor()
+    cursor.execute("SELECT status, COUNT(*) FROM notifications GROUP BY status")
+    assert dict(cursor.fetchall()) == {"sent": messages}
+    
+    print(f"✅ {messages} уведомлений: постановка в очередь {enqueue_ms:.2f} мс, "
+          f"доставка {elapsed:.1f} с ({messages / elapsed:.0f}/с при лимите {global_limit:.0f}/с)")
+
+
+async def _check_chat_burst(burst: int = 10, others: int = 20):
+    """Пачка в один чат не задерживает остальных получателей"""
+    import sqlite3
+    
+    class FakeBot:
+        def __init__(self):
+            self.sent: Dict[str, List[float]] = {}
+        
+        async def send_message(self, chat_id, text, parse_mode=None):
+            await asyncio.sleep(0.01)
+            self.sent.setdefault(chat_id, []).append(time.monotonic())
+    
+    bot = FakeBot()
+    service = NotificationService(sqlite3.connect(":memory:"), telegram_bot=bot, coalesce_window=0)
+    
+    started = time.monotonic()
+    for i in range(burst):
+        await service.send_notification(
+            "busy", "master", NotificationType.REQUEST_RECEIVED, {"job_id": i},
+            channels=[NotificationChannel.TELEGRAM]
+        )
+    for i in range(others):
+        await service.send_notification(
+            f"chat{i}", "master", NotificationType.REQUEST_RECEIVED, {"job_id": i},
+            channels=[NotificationChannel.TELEGRAM]
+        )
+    
+    while sum(len(bot.sent.get(f"chat{i}", [])) for i in range(others)) < others:
+        await asyncio.sleep(0.01)
+    others_ms = (time.monotonic() - started) * 1000
+    await service.stop()
+    
+    busy = bot.sent["busy"]
+    assert len(busy) == burst
+    assert all(b - a >= 1 / TELEGRAM_PER_CHAT_RATE - 0.05 for a, b in zip(busy, busy[1:])), "Превышен лимит на чат"
+    assert others_ms < 1000, f"Остальные чаты ждали {others_ms:.0f} мс"
+    print(f"✅ {burst} сообщений в один чат: остальные {others} чатов получили всё за {others_ms:.0f} мс")
+
+
+async def _check_retries():
+    """Повторы с backoff: временные сбои доставляются, постоянные - в недоставленные"""
+    import sqlite3
+    
+    class FlakyBot:
+        def __init__(self):
+            self.calls: Dict[str, int] = {}
+        
+        async def send_message(self, chat_id, text, parse_mode=None):
+            self.calls[chat_id] = self.calls.get(chat_id, 0) + 1
+            if chat_id == "broken" or (chat_id.startswith("flaky") and self.calls[chat_id] <= 2):
+                raise RuntimeError("Bad Gateway")
+    
+    bot = FlakyBot()
+    service = NotificationService(
+        sqlite3.connect(":memory:"), telegram_bot=bot,
+        max_attempts=4, retry_base_seconds=0.05
+    )
+    
+    # Индекс повторов в рабочей БД создаёт init_database в main.py
+    cursor = service.db.cursor()
+    cursor.execute("""
+        CREATE INDEX idx_notifications_retry ON notifications (next_attempt_at)
+        WHERE status = 'retry'
+    """)
+    cursor.execute("""
+        EXPLAIN QUERY PLAN SELECT id FROM notifications
+        WHERE status = 'retry' AND next_attempt_at <= ? ORDER BY next_attempt_at
+    """, (datetime.now().isoformat(),))
+    assert "idx_notifications_retry" in " ".join(str(row) for row in cursor.fetchall())
+    
+    recipients = ["ok", "flaky1", "flaky2", "broken"]
+    for recipient in recipients:
+        await service.send_notification(
+            recipient, "master", NotificationType.REQUEST_RECEIVED, {"job_id": 1},
+            channels=[NotificationChannel.TELEGRAM]
+        )
+    
+    for _ in range(100):
+        await asyncio.sleep(0.05)
+        await service._queue.join()
+        service.requeue_due_retries()
+        cursor.execute("SELECT COUNT(*) FROM notifications WHERE status IN ('sent', 'dead')")
+        if cursor.fetchone()[0] == len(recipients):
+            break
+    await service.stop()
+    
+    cursor.execute("SELECT recipient_id, status, attempts FROM notifications ORDER BY id")
+    rows = cursor.fetchall()
+    assert rows == [("ok", "sent", 1), ("flaky1", "sent", 3), ("flaky2", "sent", 3), ("broken", "dead", 4)], rows
+    assert [letter["recipient_id"] for letter in service.get_dead_letters()] == ["broken"]
+    
+    stats = service.get_retry_stats()["telegram"]
+    assert stats["retried"] == 3 and stats["dead"] == 1
+    
+    # Процесс упал, не отправив записанное и взятое из повтора: следующий запуск их дошлёт
+    cursor.executemany("""
+        INSERT INTO notifications (recipient_id, recipient_type, notification_type, channel, channels, title, message, status)
+        VALUES (?, 'master', ?, 'telegram', 'telegram', 'Заявка', 'Текст', ?)
+    """, [
+        ("lost1", NotificationType.REQUEST_RECEIVED.value, "pending"),
+        ("lost2", NotificationType.REQUEST_RECEIVED.value, "queued")
+    ])
+    service.db.commit()
+    restarted = NotificationService(service.db, telegram_bot=bot)
+    await restarted.start()
+    await restarted._queue.join()
+    await restarted.stop()
+    cursor.execute("SELECT status FROM notifications WHERE recipient_id LIKE 'lost%'")
+    assert [row[0] for row in cursor.fetchall()] == ["sent", "sent"]
+    assert bot.calls["lost1"] == bot.calls["lost2"] == 1
+    print(f"✅ Повторы: 2 временных сбоя доставлены с 3-й попытки, постоянный - в недоставленных; "
+          f"доля повторов telegram {stats['retry_rate']:.0%}; неотправленное до падения дослано")
+
+
+async def _check_coalescing():
+    """Склейка: повторы отброшены, обновления слиты, остальное - одной сводкой"""
+    import sqlite3
+    
+    class RecordingBot:
+        def __init__(self):
+            self.messages: List[str] = []
+        
+        async def send_message(self, chat_id, text, parse_mode=None):
+            self.messages.append(text)
+    
+    bot = RecordingBot()
+    service = NotificationService(sqlite3.connect(":memory:"), telegram_bot=bot, coalesce_window=0.3)
+    master = "555"
+    
+    async def send(notification_type: NotificationType, data: Dict[str, Any]):
+        return await service.send_notification(
+            master, "master", notification_type, data, channels=[NotificationChannel.TELEGRAM]
+        )
+    
+    new_job = {"job_id": 7, "category": "Электрика", "address": "ул. Ленина, 10", "earnings": 1500, "scheduled_time": "14:00"}
+    assert await send(NotificationType.NEW_JOB_ASSIGNED, new_job) is not None  # первое - сразу
+    assert await send(NotificationType.NEW_JOB_ASSIGNED, new_job) is None  # точный повтор
+    await send(NotificationType.PAYMENT_RECEIVED, {"job_id": 7, "earnings": 1500, "daily_total": 1500})
+    await send(NotificationType.PAYMENT_RECEIVED, {"job_id": 7, "earnings": 1500, "daily_total": 3000})  # обновление
+    await send(NotificationType.SCHEDULE_CONFIRMATION, {"schedule": "08:00-20:00"})
+    
+    await asyncio.sleep(0.5)
+    await service.stop()
+    
+    assert len(bot.messages) == 2, bot.messages
+    digest = bot.messages[1]
+    assert "Новых уведомлений: 2" in digest and "3000" in digest and "Всего сегодня: 1500" not in digest
+    stats = service.coalesce_stats
+    assert stats == {"received": 5, "sent": 2, "suppressed": 1, "merged": 1, "digested": 1}, stats
+    print(f"✅ Склейка: 5 уведомлений -> 2 сообщения, сэкономлено отправок: {service.sends_saved}")
+
+
+async def _bench_broadcast(masters: int = 10000):
+    """Бенчмарк рассылки всем мастерам: format на каждый вызов против скомпилированных шаблонов"""
+    import sqlite3
+    
+    rows = [
+        (str(100000 + i), {"jobs_count": i % 9, "total_earnings": 1500 + i, "avg_rating": 4.5 + i % 5 / 10})
+        for i in range(masters)
+    ]
+    template = NotificationTemplate.TEMPLATES[NotificationType.DAILY_SUMMARY]
+    
+    # Прежний путь: поиск шаблона и разбор строки на каждое сообщение
+    started = time.perf_counter()
+    legacy = []
+    for _, data in rows:
+        found = NotificationTemplate.TEMPLATES.get(NotificationType.DAILY_SUMMARY)
+        legacy.append({"title": found["title"].format(**data), "message": found["message"].format(**data)})
+    legacy_s = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    compiled = TEMPLATE_REGISTRY.render_many(NotificationType.DAILY_SUMMARY, [data for _, data in rows])
+    compiled_s = time.perf_counter() - started
+    assert compiled == legacy
+    
+    # Все шаблоны дают тот же текст, что и str.format
+    for notification_type, source in NotificationTemplate.TEMPLATES.items():
+        fields = TEMPLATE_REGISTRY.get(notification_type).fields
+        sample = {field: f"<{field}>" for field in fields}
+        assert TEMPLATE_REGISTRY.render(notification_type, sample) == {
+            "title": source["title"].format(**sample), "message": source["message"].format(**sample)
+        }
+    
+    service = NotificationService(sqlite3.connect(":memory:"))
+    started = time.perf_counter()
+    ids = await service.broadcast(rows, "master", NotificationType.DAILY_SUMMARY)
+    broadcast_s = time.perf_counter() - started
+    for task in service._tasks:
+        task.cancel()
+    assert len(ids) == masters and service._queue.qsize() == masters
+    
+    print(f"✅ Рендер {masters} сообщений: format {masters / legacy_s:,.0f}/с, "
+          f"скомпилированные {masters / compiled_s:,.0f}/с")
+    print(f"✅ Рассылка {masters} мастерам (рендер + запись + очередь): {broadcast_s * 1000:.0f} мс")
+
+
+if __name__ == "__main__":
+    # Самопроверка: python notification_service.py
+    asyncio.run(_check_worker_pool())
+    asyncio.run(_check_chat_burst())
+    asyncio.run(_check_retries())
+    asyncio.run(_check_coalescing())
+    asyncio.run(_bench_broadcast())
@@ -0,0 +1,412 @@
+"""
+Order Queue - Durable local queue for bot orders
+Локальная очередь заявок: бот пишет заявку в SQLite и сразу отвечает клиенту,
+запись в Google Sheets и рассылка мастерам идут в фоновых воркерах
+"""
+import os
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from notification_service import retry_delay
+
+logger = logging.getLogger(__name__)
+
+ORDER_QUEUE_DB = os.getenv("ORDER_QUEUE_DB", "order_queue.db")
+NOTIFY_WORKERS = 4  # Параллельных рассылок мастерам
+MAX_ORDER_ATTEMPTS = 8  # После стольких попыток этап считается проваленным
+ORDER_RETRY_BASE_SECONDS = 5.0  # Первый повтор; дальше задержка удваивается
+ORDER_RETRY_MAX_SECONDS = 600.0
+ORDER_RETRY_POLL_INTERVAL = 1.0  # Как часто искать заявки, которым пора повторить
+ORDER_DRAIN_TIMEOUT = 10.0  # Сколько ждать текущие записи при остановке
+
+# Статусы: new -> saved -> done; *_retry - ждут повтора этапа, dead - попытки кончились
+STAGE_RETRY_STATUS = {"new": "sheets_retry", "saved": "notify_retry"}
+
+
+@dataclass
+class QueuedOrder:
+    """Заявка в локальной очереди"""
+    queue_id: int
+    chat_id: int
+    data: Dict[str, Any]  # name, phone, category, problem, address
+    order_id: Optional[int] = None  # Номер из Google Sheets
+    attempts: int = 0
+
+
+class OrderQueue:
+    """
+    Очередь заявок из бота
+    
+    Этапы:
+    1. enqueue - одна вставка в SQLite (WAL, synchronous=FULL), клиент сразу получает ответ
+    2. запись в Google Sheets - ОДИН воркер: номер заявки = число строк таблицы,
+       параллельные записи выдали бы одинаковые номера
+    3. рассылка мастерам - несколько воркеров
+    
+    Доставка "хотя бы один раз": если процесс упал после записи в Sheets, но до
+    смены статуса, после перезапуска заявка запишется ещё раз.
+    """
+    
+    def __init__(
+        self,
+        db_path: str = ORDER_QUEUE_DB,
+        save_order: Optional[Callable[[Dict[str, Any]], Optional[int]]] = None,
+        notify_masters: Optional[Callable[[QueuedOrder], Awaitable[Any]]] = None,
+        on_saved: Optional[Callable[[QueuedOrder], Awaitable[Any]]] = None,
+        notify_workers: int = NOTIFY_WORKERS,
+        max_attempts: int = MAX_ORDER_ATTEMPTS,
+        retry_base_seconds: float = ORDER_RETRY_BASE_SECONDS
+    ):
+        # Об ошибке этапа save_order и notify_masters сообщают исключением - только тогда
+        # заявка уходит на повтор, а после max_attempts попыток - в dead
+        self.save_order = save_order  # Синхронная (gspread) - вызывается в потоке
+        self.notify_masters = notify_masters
+        self.on_saved = on_saved  # Например, прислать клиенту номер заявки
+        self.notify_workers = notify_workers
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        self._init_orders_table()
+        
+        self._save_queue: Optional[asyncio.Queue] = None
+        self._notify_queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        
+        self.stats: Dict[str, int] = {"enqueued": 0, "saved": 0, "notified": 0, "retries": 0, "dead": 0}
+    
+    def _init_orders_table(self):
+        """Инициализация таблицы очереди"""
+        cursor = self.db.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=FULL")  # Принятая заявка переживает и сбой питания
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS order_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                data_json TEXT NOT NULL,
+                status TEXT DEFAULT 'new',
+                order_id INTEGER,
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at TIMESTAMP,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_order_queue_open
+            ON order_queue (status, next_attempt_at)
+            WHERE status NOT IN ('done', 'dead')
+        """)
+        self.db.commit()
+    
+    def _execute(self, query: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._db_lock:
+            cursor = self.db.execute(query, params)
+            self.db.commit()
+            return cursor
+    
+    def _fetch(self, query: str, params: tuple = ()) -> List[tuple]:
+        with self._db_lock:
+            return self.db.execute(query, params).fetchall()
+    
+    # ==================== ПРИЁМ ЗАЯВОК ====================
+    
+    async def enqueue(self, chat_id: int, data: Dict[str, Any]) -> int:
+        """Сохранить заявку локально и поставить в обработку; возвращает id в очереди"""
+        cursor = await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO order_queue (chat_id, data_json) VALUES (?, ?)",
+            (chat_id, json.dumps(data, ensure_ascii=False))
+        )
+        order = QueuedOrder(queue_id=cursor.lastrowid, chat_id=chat_id, data=dict(data))
+        self.stats["enqueued"] += 1
+        if self._save_queue is not None:
+            self._save_queue.put_nowait(order)
+        return order.queue_id
+    
+    def pending_count(self) -> int:
+        """Сколько заявок ещё не дошли до мастеров"""
+        return self._fetch("SELECT COUNT(*) FROM order_queue WHERE status NOT IN ('done', 'dead')")[0][0]
+    
+    def get_dead_orders(self, limit: int = 50) -> List[Dict]:
+        """Заявки, которые не удалось обработать за все попытки"""
+        rows = self._fetch("""
+            SELECT id, chat_id, data_json, order_id, attempts, error, created_at
+            FROM order_queue WHERE status = 'dead'
+            ORDER BY id DESC LIMIT ?
+        """, (limit,))
+        return [
+            {
+                "queue_id": row[0], "chat_id": row[1], "data": json.loads(row[2]), "order_id": row[3],
+                "attempts": row[4], "error": row[5], "created_at": row[6]
+            }
+            for row in rows
+        ]
+    
+    # ==================== ВОРКЕРЫ ====================
+    
+    async def start(self):
+        """Запустить воркеры и вернуть в работу заявки, оставшиеся с прошлого запуска"""
+        if self._save_queue is not None:
+            return
+        # Обновления в бот идут только после post_init, так что новых заявок во время загрузки нет
+        recovered = await asyncio.to_thread(self._load_orders, "new", "saved")
+        self._save_queue = asyncio.Queue()
+        self._notify_queue = asyncio.Queue()
+        for order, status in recovered:
+            (self._save_queue if status == "new" else self._notify_queue).put_nowait(order)
+        if recovered:
+            logger.info(f"♻️ Из очереди заявок восстановлено: {len(recovered)}")
+        
+        self._tasks = [asyncio.create_task(self._sheets_worker())]
+        self._tasks += [asyncio.create_task(self._notify_worker()) for _ in range(self.notify_workers)]
+        self._tasks.append(asyncio.create_task(self._retry_scheduler()))
+    
+    async def stop(self, drain_timeout: float = ORDER_DRAIN_TIMEOUT):
+        """Дождаться текущих заявок (не дольше drain_timeout) и остановить воркеры"""
+        if self._save_queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._drain(), drain_timeout)
+        except asyncio.TimeoutError:
+            # Не дождались - заявки остались в SQLite и продолжатся после перезапуска
+            logger.warning(f"⚠️ Очередь заявок остановлена, не обработано: {self.pending_count()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._save_queue = None
+        self._notify_queue = None
+    
+    async def _drain(self):
+        # Сначала Sheets: каждая сохранённая заявка ещё попадёт в очередь рассылки
+        await self._save_queue.join()
+        await self._notify_queue.join()
+    
+    def _load_orders(self, *statuses: str) -> List[tuple]:
+        placeholders = ", ".join("?" * len(statuses))
+        rows = self._fetch(f"""
+            SELECT id, chat_id, data_json, order_id, attempts, status
+            FROM order_queue WHERE status IN ({placeholders})
+            ORDER BY id
+        """, statuses)
+        return [
+            (QueuedOrder(queue_id=row[0], chat_id=row[1], data=json.loads(row[2]), order_id=row[3], attempts=row[4]), row[5])
+            for row in rows
+        ]
+    
+    async def _sheets_worker(self):
+        """Воркер записи в Google Sheets (строго по одной заявке)"""
+        while True:
+            order = await self._save_queue.get()
+            try:
+                if self.save_order is not None:
+                    order.order_id = await asyncio.to_thread(self.save_order, order.data)
+                order.attempts = 0
+                await asyncio.to_thread(
+                    self._execute,
+                    "UPDATE order_queue SET status = 'saved', order_id = ?, attempts = 0, error = NULL, "
+                    "updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (order.order_id, order.queue_id)
+                )
+                self.stats["saved"] += 1
+                logger.info(f"✅ Заявка #{order.order_id} из очереди ({order.queue_id}) сохранена")
+                self._notify_queue.put_nowait(order)
+                await self._run_callback(self.on_saved, order)
+            except Exception as e:
+                await self._schedule_retry(order, "new", str(e))
+            finally:
+                self._save_queue.task_done()
+    
+    async def _notify_worker(self):
+        """Воркер рассылки мастерам"""
+        while True:
+            order = await self._notify_queue.get()
+            try:
+                if self.notify_masters is not None:
+                    await self.notify_masters(order)
+                await asyncio.to_thread(
+                    self._execute,
+                    "UPDATE order_queue SET status = 'done', error = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (order.queue_id,)
+                )
+                self.stats["notified"] += 1
+            except Exception as e:
+                await self._schedule_retry(order, "saved", str(e))
+            finally:
+                self._notify_queue.task_done()
+    
+    @staticmethod
+    async def _run_callback(callback, order: QueuedOrder):
+        """Сообщение клиенту не повторяем: ошибка не должна откатывать этап"""
+        if callback is None:
+            return
+        try:
+            await callback(order)
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка обработчика заявки {order.queue_id}: {e}")
+    
+    async def _schedule_retry(self, order: QueuedOrder, stage: str, error: str):
+        """Запланировать повтор этапа или отметить заявку как проваленную"""
+        order.attempts += 1
+        logger.error(f"⚠️ Заявка {order.queue_id}, этап {stage}, попытка {order.attempts}: {error}")
+        if order.attempts >= self.max_attempts:
+            status, next_attempt_at = "dead", None
+            self.stats["dead"] += 1
+        else:
+            status = STAGE_RETRY_STATUS[stage]
+            delay = retry_delay(order.attempts, self.retry_base_seconds, ORDER_RETRY_MAX_SECONDS)
+            next_attempt_at = (datetime.now() + timedelta(seconds=delay)).isoformat()
+            self.stats["retries"] += 1
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE order_queue SET status = ?, attempts = ?, next_attempt_at = ?, error = ?, "
+            "updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (status, order.attempts, next_attempt_at, error, order.queue_id)
+        )
+    
+    async def _retry_scheduler(self):
+        """Периодически возвращать в работу заявки, которым пора повторить"""
+        while True:
+            await asyncio.sleep(ORDER_RETRY_POLL_INTERVAL)
+            for order, status in await asyncio.to_thread(self._take_due_retries):
+                (self._save_queue if status == "new" else self._notify_queue).put_nowait(order)
+    
+    def _take_due_retries(self) -> List[tuple]:
+        """Заявки с наступившим next_attempt_at - возвращаются в статус своего этапа"""
+        with self._db_lock:
+            rows = self.db.execute("""
+                SELECT id, chat_id, data_json, order_id, attempts, status
+                FROM order_queue
+                WHERE status IN ('sheets_retry', 'notify_retry') AND next_attempt_at <= ?
+                ORDER BY next_attempt_at
+            """, (datetime.now().isoformat(),)).fetchall()
+            if not rows:
+                return []
+            self.db.executemany(
+                "UPDATE order_queue SET status = ? WHERE id = ?",
+                [("new" if row[5] == "sheets_retry" else "saved", row[0]) for row in rows]
+            )
+            self.db.commit()
+        return [
+            (
+                QueuedOrder(queue_id=row[0], chat_id=row[1], data=json.loads(row[2]), order_id=row[3], attempts=row[4]),
+                "new" if row[5] == "sheets_retry" else "saved"
+            )
+            for row in rows
+        ]
+
+
+async def _check_handler_latency(orders: int = 20, sheets_latencies=(0.05, 0.5, 2.0)):
+    """
+    Задержка обработчика подтверждения не зависит от скорости Google Sheets
+    
+    save_order блокирует поток (time.sleep, как gspread). Обработчики приходят
+    все разом; параллельно меряем, насколько замирает event loop.
+    """
+    import tempfile
+    
+    print(f"📊 {orders} одновременных подтверждений заявки")
+    for sheets_latency in sheets_latencies:
+        saved_ids: List[int] = []
+        notified: List[int] = []
+        
+        in_flight = [0, 0]  # Сейчас и максимум одновременных записей в Sheets
+        
+        def save_order(data: Dict[str, Any]) -> int:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+            time.sleep(sheets_latency)  # gspread: get_all_values + append_row
+            saved_ids.append(data["n"])
+            in_flight[0] -= 1
+            return len(saved_ids)
+        
+        async def notify_masters(order: QueuedOrder):
+            await asyncio.sleep(0.05)
+            notified.append(order.order_id)
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            queue = OrderQueue(f"{tmp}/orders.db", save_order=save_order, notify_masters=notify_masters)
+            await queue.start()
+            
+            stalls: List[float] = []
+            running = True
+            
+            async def ticker():
+                while running:
+                    started = time.perf_counter()
+                    await asyncio.sleep(0.005)
+                    stalls.append((time.perf_counter() - started - 0.005) * 1000)
+            
+            async def handler(n: int) -> float:
+                started = time.perf_counter()
+                await queue.enqueue(chat_id=n, data={"n": n, "name": "Клиент", "problem": "Не работает розетка"})
+                return (time.perf_counter() - started) * 1000
+            
+            ticker_task = asyncio.create_task(ticker())
+            latencies = sorted(await asyncio.gather(*(handler(n) for n in range(orders))))
+            await queue.stop(drain_timeout=orders * sheets_latency + 10)
+            running = False
+            await ticker_task
+        
+        p95 = latencies[int(len(latencies) * 0.95)]
+        print(f"✅ Sheets {sheets_latency * 1000:.0f} мс на заявку: обработчик p50 {latencies[len(latencies) // 2]:.1f} мс, "
+              f"p95 {p95:.1f} мс; макс. замирание loop {max(stalls):.1f} мс; "
+              f"в фоне сохранено {len(saved_ids)} за {orders * sheets_latency:.0f}+ с, мастерам {len(notified)}")
+        assert p95 < 100, "Обработчик ждёт Google Sheets"
+        assert sorted(saved_ids) == list(range(orders)) and in_flight[1] == 1, "Записи в Sheets - строго по одной"
+        assert sorted(notified) == list(range(1, orders + 1))
+
+
+async def _check_recovery():
+    """Заявки из упавшего процесса дорабатываются после перезапуска; ошибки - с повтором"""
+    import tempfile
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = f"{tmp}/orders.db"
+        
+        # "Падение": заявки приняты, воркеры не запускались
+        crashed = OrderQueue(db_path)
+        for n in range(3):
+            await crashed.enqueue(chat_id=n, data={"n": n})
+        crashed.db.close()
+        
+        attempts: Dict[int, int] = {}
+        
+        def flaky_save(data: Dict[str, Any]) -> int:
+            attempts[data["n"]] = attempts.get(data["n"], 0) + 1
+            if attempts[data["n"]] == 1:
+                raise ConnectionError("Sheets API 503")
+            return 100 + data["n"]
+        
+        confirmed: List[int] = []
+        
+        async def on_saved(order: QueuedOrder):
+            confirmed.append(order.order_id)
+        
+        queue = OrderQueue(db_path, save_order=flaky_save, on_saved=on_saved, retry_base_seconds=0.1)
+        await queue.start()
+        deadline = time.time() + 10
+        while queue.pending_count() and time.time() < deadline:
+            await asyncio.sleep(0.1)
+        await queue.stop()
+        
+        assert sorted(confirmed) == [100, 101, 102], confirmed
+        assert queue.stats["retries"] == 3 and queue.pending_count() == 0
+        print(f"✅ Восстановление после падения: 3 заявки дошли, повторов {queue.stats['retries']}")
+
+
+if __name__ == "__main__":
+    # Проверка: python order_queue.py
+    asyncio.run(_check_handler_latency())
+    asyncio.run(_check_recovery())
@@ -0,0 +1,402 @@
+"""
+Route Planner - Daily route for a master's booked jobs
+Порядок объезда заказов мастера за день с учётом временных окон
+"""
+import time as timer
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass
+
+from batch_dispatcher import haversine_km
+
+
+AVERAGE_SPEED_KMH = 30.0  # Средняя скорость по городу
+ROAD_FACTOR = 1.3  # Дорога длиннее прямой примерно на треть
+WINDOW_SLACK_MINUTES = 60  # Насколько позже забронированного времени можно начать заказ
+LATE_PENALTY = 100.0  # Штраф за минуту опоздания (в минутах пути)
+
+
+def _format_minutes(minutes: float) -> str:
+    """Минуты от полуночи -> ЧЧ:ММ"""
+    minutes = int(round(minutes))
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+@dataclass
+class RouteStop:
+    """Заказ, который нужно посетить"""
+    job_id: int
+    lat: float
+    lon: float
+    window_start: int  # Минуты от полуночи
+    window_end: int  # Позже этого начинать нельзя
+    service_minutes: int
+    address: str = ""
+
+
+@dataclass
+class PlannedStop:
+    """Заказ в плане маршрута"""
+    job_id: int
+    address: str
+    arrival: float
+    start: float
+    departure: float
+    travel_minutes: float
+    late_minutes: float
+    
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "address": self.address,
+            "arrival": _format_minutes(self.arrival),
+            "start": _format_minutes(self.start),
+            "departure": _format_minutes(self.departure),
+            "travel_minutes": round(self.travel_minutes),
+            "late_minutes": round(self.late_minutes)
+        }
+
+
+@dataclass
+class RoutePlan:
+    """План объезда на день"""
+    stops: List[PlannedStop]
+    travel_minutes: float
+    distance_km: float
+    late_minutes: float
+    unrouted: List[int]  # Заказы без координат
+    
+    @property
+    def feasible(self) -> bool:
+        return self.late_minutes == 0
+    
+    def to_dict(self) -> Dict:
+        return {
+            "stops": [stop.to_dict() for stop in self.stops],
+            "travel_minutes": round(self.travel_minutes),
+            "distance_km": round(self.distance_km, 1),
+            "late_minutes": round(self.late_minutes),
+            "feasible": self.feasible,
+            "unrouted": self.unrouted
+        }
+
+
+class DistanceCache:
+    """
+    Расстояния между точками
+    
+    По умолчанию - гаверсинус с поправкой на дороги; реальные дорожные
+    расстояния (например, из картографического API) можно положить в кэш.
+    """
+    
+    def __init__(self, speed_kmh: float = AVERAGE_SPEED_KMH, road_factor: float = ROAD_FACTOR):
+        self.speed_kmh = speed_kmh
+        self.road_factor = road_factor
+        self._road_km: Dict[Tuple[Tuple[float, float], Tuple[float, float]], float] = {}
+    
+    @staticmethod
+    def _key(point: Tuple[float, float]) -> Tuple[float, float]:
+        return round(point[0], 5), round(point[1], 5)
+    
+    def set_road_km(self, a: Tuple[float, float], b: Tuple[float, float], km: float):
+        """Запомнить дорожное расстояние между точками"""
+        self._road_km[(self._key(a), self._key(b))] = km
+    
+    def km(self, a: Tuple[float, float], b: Tuple[float, float]) -> float:
+        cached = self._road_km.get((self._key(a), self._key(b)))
+        if cached is not None:
+            return cached
+        return haversine_km(a[0], a[1], b[0], b[1]) * self.road_factor
+    
+    def matrix(self, points: List[Tuple[float, float]]) -> List[List[float]]:
+        """Матрица расстояний в км"""
+        return [[0.0 if i == j else self.km(a, b) for j, b in enumerate(points)] for i, a in enumerate(points)]
+
+
+class _Route:
+    """Оценка порядка объезда: точка 0 - старт мастера, заказы - 1..n"""
+    
+    def __init__(self, stops: List[RouteStop], travel: List[List[float]], start_minute: int):
+        self.stops = stops
+        self.travel = travel
+        self.start_minute = start_minute
+    
+    def cost(self, order: List[int]) -> float:
+        """Время в пути + штраф за опоздания"""
+        now = self.start_minute
+        previous = 0
+        total = 0.0
+        for index in order:
+            stop = self.stops[index - 1]
+            leg = self.travel[previous][index]
+            total += leg
+            begin = max(now + leg, stop.window_start)
+            if begin > stop.window_end:
+                total += (begin - stop.window_end) * LATE_PENALTY
+            now = begin + stop.service_minutes
+            previous = index
+        return total
+    
+    def nearest_neighbour(self) -> List[int]:
+        """Жадный старт: следующим - заказ, который можно начать раньше всех"""
+        remaining = set(range(1, len(self.stops) + 1))
+        order = []
+        now = self.start_minute
+        previous = 0
+        while remaining:
+            def key(index: int):
+                stop = self.stops[index - 1]
+                begin = max(now + self.travel[previous][index], stop.window_start)
+                return begin > stop.window_end, begin, self.travel[previous][index], index
+            
+            index = min(remaining, key=key)
+            stop = self.stops[index - 1]
+            now = max(now + self.travel[previous][index], stop.window_start) + stop.service_minutes
+            previous = index
+            order.append(index)
+            remaining.remove(index)
+        return order
+    
+    def two_opt(self, order: List[int], best: float) -> Tuple[List[int], float]:
+        """Разворот отрезков маршрута, пока это улучшает стоимость"""
+        improved = True
+        while improved:
+            improved = False
+            for i in range(len(order) - 1):
+                for j in range(i + 1, len(order)):
+                    candidate = order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+                    cost = self.cost(candidate)
+                    if cost < best - 1e-9:
+                        order, best, improved = candidate, cost, True
+        return order, best
+    
+    def or_opt(self, order: List[int], best: float) -> Tuple[List[int], float]:
+        """Перенос цепочек из 1-3 заказов на другое место"""
+        improved = True
+        while improved:
+            improved = False
+            for length in (1, 2, 3):
+                for i in range(len(order) - length + 1):
+                    segment = order[i:i + length]
+                    rest = order[:i] + order[i + length:]
+                    for j in range(len(rest) + 1):
+                        if j == i:
+                            continue
+                        candidate = rest[:j] + segment + rest[j:]
+                        cost = self.cost(candidate)
+                        if cost < best - 1e-9:
+                            order, best, improved = candidate, cost, True
+                            break
+                    if improved:
+                        break
+                if improved:
+                    break
+        return order, best
+    
+    def optimize(self) -> List[int]:
+        """Ближайший сосед, затем 2-opt и Or-opt до локального минимума"""
+        order = self.nearest_neighbour()
+        best = self.cost(order)
+        while True:
+            order, cost = self.two_opt(order, best)
+            order, cost = self.or_opt(order, cost)
+            if cost >= best - 1e-9:
+                return order
+            best = cost
+
+
+def plan_route(
+    stops: List[RouteStop],
+    start_point: Optional[Tuple[float, float]],
+    start_minute: int,
+    distances: Optional[DistanceCache] = None,
+    order: Optional[List[int]] = None
+) -> RoutePlan:
+    """
+    Спланировать порядок объезда
+    
+    Args:
+        stops: Заказы с координатами и окнами
+        start_point: Откуда мастер выезжает (None - с первого заказа)
+        start_minute: Когда мастер начинает день
+        distances: Кэш расстояний (по умолчанию гаверсинус)
+        order: Готовый порядок (индексы stops) - только посчитать план
+    """
+    distances = distances or DistanceCache()
+    points = [(stop.lat, stop.lon) for stop in stops]
+    km = distances.matrix([start_point or points[0]] + points) if stops else [[0.0]]
+    if start_point is None:
+        km[0] = [0.0] * len(km)
+    minutes_per_km = 60 / distances.speed_kmh
+    travel = [[value * minutes_per_km for value in row] for row in km]
+    
+    route = _Route(stops, travel, start_minute)
+    sequence = [index + 1 for index in order] if order is not None else route.optimize()
+    
+    planned = []
+    now = start_minute
+    previous = 0
+    distance_km = 0.0
+    late_total = 0.0
+    for index in sequence:
+        stop = stops[index - 1]
+        leg = travel[previous][index]
+        distance_km += km[previous][index]
+        arrival = now + leg
+        begin = max(arrival, stop.window_start)
+        late = max(0.0, begin - stop.window_end)
+        late_total += late
+        now = begin + stop.service_minutes
+        planned.append(PlannedStop(stop.job_id, stop.address, arrival, begin, now, leg, late))
+        previous = index
+    
+    return RoutePlan(
+        stops=planned,
+        travel_minutes=sum(stop.travel_minutes for stop in planned),
+        distance_km=distance_km,
+        late_minutes=late_total,
+        unrouted=[]
+    )
+
+
+class RoutePlanner:
+    """Маршруты мастеров по забронированным заказам"""
+    
+    def __init__(self, db_connection, distances: Optional[DistanceCache] = None):
+        self.db = db_connection
+        self.distances = distances or DistanceCache()
+    
+    def plan_master_day(self, master_id: int, date: datetime) -> RoutePlan:
+        """Маршрут мастера на дату по заказам из master_slots"""
+        cursor = self.db.cursor()
+        date_key = date.strftime("%Y-%m-%d")
+        
+        cursor.execute("""
+            SELECT s.job_id, MIN(s.start_minute), MAX(s.end_minute),
+                j.address, j.address_lat, j.address_lon
+            FROM master_slots s
+            JOIN jobs j ON j.id = s.job_id
+            WHERE s.master_id = ? AND s.date = ? AND s.job_id IS NOT NULL
+            GROUP BY s.job_id
+            ORDER BY s.job_id
+        """, (master_id, date_key))
+        
+        stops = []
+        unrouted = []
+        for job_id, start_minute, end_minute, address, lat, lon in cursor.fetchall():
+            if lat is None or lon is None:
+                unrouted.append(job_id)
+                continue
+            stops.append(RouteStop(
+                job_id=job_id,
+                lat=lat,
+                lon=lon,
+                window_start=start_minute,
+                window_end=start_minute + WINDOW_SLACK_MINUTES,
+                service_minutes=end_minute - start_minute,
+                address=address or ""
+            ))
+        
+        cursor.execute("SELECT base_lat, base_lon FROM masters WHERE id = ?", (master_id,))
+        row = cursor.fetchone()
+        start_point = (row[0], row[1]) if row and row[0] is not None and row[1] is not None else None
+        
+        cursor.execute(
+            "SELECT MIN(start_minute) FROM master_slots WHERE master_id = ? AND date = ?",
+            (master_id, date_key)
+        )
+        day_start = cursor.fetchone()[0]
+        if day_start is None:
+            day_start = min((stop.window_start for stop in stops), default=0)
+        
+        if not stops:
+            return RoutePlan(stops=[], travel_minutes=0, distance_km=0, late_minutes=0, unrouted=unrouted)
+        
+        plan = plan_route(stops, start_point, day_start, self.distances)
+        plan.unrouted = unrouted
+        return plan
+
+
+def _random_stops(count: int, seed: int) -> Tuple[List[RouteStop], Tuple[float, float]]:
+    """
+    Случайный день мастера в Калининграде
+    
+    Окна строятся вокруг времени прохождения случайного маршрута, поэтому
+    выполнимый порядок всегда существует; заказы перемешаны как при создании.
+    """
+    import random
+    
+    rng = random.Random(seed)
+    base = (54.71, 20.51)
+    distances = DistanceCache()
+    now = 8 * 60
+    previous = base
+    stops = []
+    for _ in range(count):
+        point = (54.65 + rng.random() * 0.12, 20.40 + rng.random() * 0.22)
+        service = rng.choice([10, 15, 20, 30])
+        now += distances.km(previous, point) * 60 / distances.speed_kmh + rng.randrange(0, 30)
+        stops.append(RouteStop(
+            job_id=0,
+            lat=point[0],
+            lon=point[1],
+            window_start=int(now) - 60,
+            window_end=int(now) + 60,
+            service_minutes=service
+        ))
+        now += service
+        previous = point
+    
+    rng.shuffle(stops)
+    for job_id, stop in enumerate(stops, start=1):
+        stop.job_id = job_id
+    return stops, base
+
+
+def _check_small_routes(rounds: int = 30, count: int = 7):
+    """Сверка с полным перебором порядков на маленьких днях"""
+    import itertools
+    
+    gaps = []
+    for seed in range(rounds):
+        stops, base = _random_stops(count, seed)
+        distances = DistanceCache()
+        plan = plan_route(stops, base, 8 * 60, distances)
+        
+        points = [base] + [(stop.lat, stop.lon) for stop in stops]
+        travel = [[value * 60 / distances.speed_kmh for value in row] for row in distances.matrix(points)]
+        route = _Route(stops, travel, 8 * 60)
+        best = min(route.cost(list(order)) for order in itertools.permutations(range(1, count + 1)))
+        position = {stop.job_id: index + 1 for index, stop in enumerate(stops)}
+        found = route.cost([position[planned.job_id] for planned in plan.stops])
+        assert found >= best - 1e-6
+        gaps.append((found - best) / best * 100 if best else 0.0)
+    
+    print(f"✅ {count} заказов, {rounds} дней: отклонение от оптимума "
+          f"в среднем {sum(gaps) / len(gaps):.2f}%, максимум {max(gaps):.2f}%")
+
+
+def _bench_routes(rounds: int = 10):
+    """Качество и скорость на 5-30 заказах против порядка создания"""
+    for count in (5, 10, 20, 30):
+        saved = []
+        late_before = late_after = 0
+        elapsed = 0.0
+        for seed in range(rounds):
+            stops, base = _random_stops(count, seed)
+            creation = plan_route(stops, base, 8 * 60, order=list(range(count)))
+            started = timer.perf_counter()
+            plan = plan_route(stops, base, 8 * 60)
+            elapsed += timer.perf_counter() - started
+            saved.append((creation.distance_km - plan.distance_km) / creation.distance_km * 100)
+            late_before += creation.late_minutes > 0
+            late_after += plan.late_minutes > 0
+        print(f"✅ {count} заказов: -{sum(saved) / len(saved):.0f}% км к порядку создания, "
+              f"опоздания в {late_before} -> {late_after} из {rounds} дней, "
+              f"{elapsed * 1000 / rounds:.0f} мс на маршрут")
+
+
+if __name__ == "__main__":
+    # Самопроверка и бенчмарк: python route_planner.py
+    _check_small_routes()
+    _bench_routes()
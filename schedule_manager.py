@@ -3,11 +3,79 @@ Schedule Manager - Master availability and schedule management
 Управление расписанием и доступностью мастеров
 """
 import json
+from bisect import bisect_right, insort
 from datetime import datetime, timedelta, time
 from typing import Dict, List, Optional, Tuple
 from dataclasses import dataclass
 
 
+SLOT_MINUTES = 15  # Шаг сетки расписания
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES  # 96 бит на день
+DEFAULT_JOB_MINUTES = 60  # Длительность заказа по умолчанию
+DEFAULT_TRAVEL_MINUTES = 30  # Буфер на дорогу между заказами
+DISPATCH_CANDIDATES = 10  # Сколько лучших кандидатов проверять по календарю
+DEFAULT_WORKING_DAYS = "0,1,2,3,4"  # Пн-Пт
+CONFIRMATION_INTERVAL = timedelta(hours=12)  # Как часто мастер подтверждает расписание
+
+
+def _to_minutes(value: time) -> int:
+    """Время -> минуты от полуночи"""
+    return value.hour * 60 + value.minute
+
+
+def _from_minutes(minutes: int) -> time:
+    """Минуты от полуночи -> время (24:00 превращается в 23:59)"""
+    if minutes >= 24 * 60:
+        return time(23, 59)
+    return time(minutes // 60, minutes % 60)
+
+
+def _slot_start(value: time) -> int:
+    """Начало слота, в который попадает время"""
+    minutes = _to_minutes(value)
+    return minutes - minutes % SLOT_MINUTES
+
+
+def _slot_rows(master_id: int, date_key: str, time_slot: 'TimeSlot') -> List[Tuple[int, str, int, int]]:
+    """Нарезать рабочее окно на слоты для master_slots"""
+    start = _to_minutes(time_slot.start)
+    end = _to_minutes(time_slot.end)
+    return [
+        (master_id, date_key, minute, min(minute + SLOT_MINUTES, end))
+        for minute in range(start, end, SLOT_MINUTES)
+    ]
+
+
+def range_mask(start_minute: int, end_minute: int) -> int:
+    """Битовая маска слотов, покрывающих [start_minute, end_minute)"""
+    first = start_minute // SLOT_MINUTES
+    last = min(-(-end_minute // SLOT_MINUTES), SLOTS_PER_DAY)
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+
+def _day_from_slots(date_key: str, rows: List[Tuple[int, int, Optional[int]]]) -> 'DaySchedule':
+    """Собрать DaySchedule из строк master_slots (start, end, job_id) по порядку"""
+    booked_jobs = []
+    mask = DayMask()
+    for start_minute, _, job_id in rows:
+        bit = 1 << (start_minute // SLOT_MINUTES)
+        mask.working |= bit
+        if job_id is not None:
+            mask.booked |= bit
+            if job_id not in booked_jobs:
+                booked_jobs.append(job_id)
+    
+    return DaySchedule(
+        date=datetime.strptime(date_key, "%Y-%m-%d"),
+        available=True,
+        time_slot=mask.time_slot,
+        booked_jobs=booked_jobs,
+        mask=mask
+    )
+
+
 @dataclass
 class TimeSlot:
     """Временной слот"""
@@ -32,6 +100,68 @@ class TimeSlot:
         )
 
 
+@dataclass
+class DayMask:
+    """
+    Битовое представление дня: бит i = слот [i*SLOT_MINUTES, (i+1)*SLOT_MINUTES)
+    
+    Пересечение расписаний, поиск свободных окон и проверка
+    "свободен ли с 14:00 до 16:00" сводятся к AND и подсчёту бит.
+    """
+    working: int = 0
+    booked: int = 0
+    
+    @property
+    def free(self) -> int:
+        """Рабочие и не занятые слоты"""
+        return self.working & ~self.booked
+    
+    @property
+    def time_slot(self) -> Optional[TimeSlot]:
+        """Рабочее окно дня как TimeSlot (от первого до последнего рабочего слота)"""
+        if not self.working:
+            return None
+        first = (self.working & -self.working).bit_length() - 1
+        last = self.working.bit_length()
+        return TimeSlot(
+            start=_from_minutes(first * SLOT_MINUTES),
+            end=_from_minutes(last * SLOT_MINUTES)
+        )
+    
+    def is_free(self, start: time, end: time) -> bool:
+        """Свободен ли весь интервал [start, end)"""
+        needed = range_mask(_to_minutes(start), _to_minutes(end))
+        return self.free & needed == needed
+    
+    def free_minutes(self) -> int:
+        """Сколько свободных минут в дне"""
+        return self.free.bit_count() * SLOT_MINUTES
+    
+    def free_windows(self, min_minutes: int = SLOT_MINUTES) -> List[TimeSlot]:
+        """Свободные окна не короче min_minutes"""
+        return _mask_windows(self.free, min_minutes)
+    
+    @staticmethod
+    def from_time_slot(time_slot: TimeSlot) -> 'DayMask':
+        return DayMask(working=range_mask(_to_minutes(time_slot.start), _to_minutes(time_slot.end)))
+
+
+def _mask_windows(mask: int, min_minutes: int = SLOT_MINUTES) -> List[TimeSlot]:
+    """Непрерывные серии единиц маски -> список TimeSlot"""
+    windows = []
+    while mask:
+        first = (mask & -mask).bit_length() - 1
+        run = mask >> first
+        length = (run ^ (run + 1)).bit_length() - 1
+        if length * SLOT_MINUTES >= min_minutes:
+            windows.append(TimeSlot(
+                start=_from_minutes(first * SLOT_MINUTES),
+                end=_from_minutes((first + length) * SLOT_MINUTES)
+            ))
+        mask &= ~(((1 << length) - 1) << first)
+    return windows
+
+
 @dataclass
 class DaySchedule:
     """Расписание на день"""
@@ -39,12 +169,17 @@ class DaySchedule:
     available: bool
     time_slot: Optional[TimeSlot]
     booked_jobs: List[int]  # ID заказов
+    mask: Optional[DayMask] = None  # Слоты дня, если расписание из master_slots
     
     def is_available_at(self, check_time: time) -> bool:
         """Проверка доступности в определенное время"""
         if not self.available:
             return False
         
+        if self.mask is not None:
+            # Учитываем и рабочее окно, и уже занятые заказами слоты
+            return bool(self.mask.free >> (_to_minutes(check_time) // SLOT_MINUTES) & 1)
+        
         if not self.time_slot:
             return False
         
@@ -68,12 +203,119 @@ class DaySchedule:
         )
 
 
+@dataclass
+class MasterCandidate:
+    """Кандидат на заказ с составляющими балла"""
+    master_id: int
+    rating: float
+    workload: int
+    score: float
+
+
+class BookingCalendar:
+    """
+    Заказы мастера на день - отсортированный список интервалов (в минутах)
+    
+    Между заказами должно оставаться travel_minutes на дорогу. Интервалы
+    не пересекаются, поэтому для проверки конфликта достаточно соседей
+    по bisect - O(log n) вместо перебора всех заказов дня.
+    """
+    
+    def __init__(self, travel_minutes: int = DEFAULT_TRAVEL_MINUTES):
+        self.travel_minutes = travel_minutes
+        self._starts: List[int] = []
+        self._intervals: List[Tuple[int, int, Optional[int]]] = []
+    
+    def __len__(self) -> int:
+        return len(self._intervals)
+    
+    @property
+    def intervals(self) -> List[Tuple[int, int, Optional[int]]]:
+        """Интервалы (start, end, job_id) по возрастанию начала"""
+        return list(self._intervals)
+    
+    def conflicts(self, start_minute: int, end_minute: int) -> bool:
+        """Пересекается ли [start, end) с заказом с учётом буфера на дорогу"""
+        index = bisect_right(self._starts, start_minute)
+        if index > 0 and self._intervals[index - 1][1] + self.travel_minutes > start_minute:
+            return True
+        if index < len(self._intervals) and self._intervals[index][0] < end_minute + self.travel_minutes:
+            return True
+        return False
+    
+    def add(self, start_minute: int, end_minute: int, job_id: Optional[int] = None):
+        """Добавить заказ; ValueError, если он конфликтует с уже добавленными"""
+        if self.conflicts(start_minute, end_minute):
+            raise ValueError(f"Интервал {start_minute}-{end_minute} конфликтует с расписанием")
+        self._insert(start_minute, end_minute, job_id)
+    
+    def _insert(self, start_minute: int, end_minute: int, job_id: Optional[int]):
+        """Вставить без проверки (для заказов, уже записанных в БД)"""
+        index = bisect_right(self._starts, start_minute)
+        self._starts.insert(index, start_minute)
+        self._intervals.insert(index, (start_minute, end_minute, job_id))
+    
+    def remove(self, job_id: int) -> bool:
+        """Убрать заказ из календаря"""
+        for index, interval in enumerate(self._intervals):
+            if interval[2] == job_id:
+                del self._starts[index]
+                del self._intervals[index]
+                return True
+        return False
+    
+    def earliest_start(
+        self,
+        duration_minutes: int,
+        window_start: int,
+        window_end: int
+    ) -> Optional[int]:
+        """Самое раннее начало заказа в окне [window_start, window_end) или None"""
+        candidate = window_start
+        index = bisect_right(self._starts, candidate)
+        if index > 0:
+            candidate = max(candidate, self._intervals[index - 1][1] + self.travel_minutes)
+        
+        # Идём по промежуткам между заказами, пока не найдём достаточный
+        while index < len(self._intervals):
+            if candidate + duration_minutes + self.travel_minutes <= self._intervals[index][0]:
+                break
+            candidate = max(candidate, self._intervals[index][1] + self.travel_minutes)
+            index += 1
+        
+        if candidate + duration_minutes > window_end:
+            return None
+        return candidate
+    
+    @staticmethod
+    def from_slots(
+        rows: List[Tuple[int, int, Optional[int]]],
+        travel_minutes: int = DEFAULT_TRAVEL_MINUTES
+    ) -> 'BookingCalendar':
+        """Собрать календарь из занятых слотов (start, end, job_id) по порядку"""
+        calendar = BookingCalendar(travel_minutes)
+        run = None
+        for start_minute, end_minute, job_id in rows:
+            if run and run[2] == job_id and run[1] == start_minute:
+                run = (run[0], end_minute, job_id)
+                continue
+            if run:
+                calendar._insert(*run)
+            run = (start_minute, end_minute, job_id)
+        if run:
+            calendar._insert(*run)
+        return calendar
+
+
 class ScheduleManager:
     """Менеджер расписания мастеров"""
     
-    def __init__(self, db_connection):
+    def __init__(self, db_connection, travel_minutes: int = DEFAULT_TRAVEL_MINUTES):
         self.db = db_connection
+        self.travel_minutes = travel_minutes
         self._update_masters_table()
+        self._init_slots_table()
+        self._init_templates_table()
     
     def _update_masters_table(self):
         """Обновить таблицу мастеров (добавить поля расписания)"""
@@ -100,40 +342,152 @@ class ScheduleManager:
         
         self.db.commit()
     
+    def _init_slots_table(self):
+        """Таблица слотов расписания (вместо schedule_json)"""
+        cursor = self.db.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS master_slots (
+                master_id INTEGER NOT NULL,
+                date TEXT NOT NULL,
+                start_minute INTEGER NOT NULL,
+                end_minute INTEGER NOT NULL,
+                job_id INTEGER,
+                PRIMARY KEY (master_id, date, start_minute),
+                FOREIGN KEY (master_id) REFERENCES masters(id),
+                FOREIGN KEY (job_id) REFERENCES jobs(id)
+            )
+        """)
+        # Свободные слоты всех мастеров на дату/время - один индексный поиск
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_master_slots_free
+            ON master_slots (date, start_minute, master_id)
+            WHERE job_id IS NULL
+        """)
+        # Загрузка мастеров на дату - только по занятым слотам
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_master_slots_booked
+            ON master_slots (date, master_id, job_id)
+            WHERE job_id IS NOT NULL
+        """)
+        # Заказы из schedule_json, которые не удалось разместить в слотах
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS master_slot_conflicts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                master_id INTEGER NOT NULL,
+                date TEXT NOT NULL,
+                job_id INTEGER NOT NULL,
+                day_json TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (master_id) REFERENCES masters(id),
+                FOREIGN KEY (job_id) REFERENCES jobs(id)
+            )
+        """)
+        self.db.commit()
+        
+        self._migrate_schedule_json()
+    
+    def _init_templates_table(self):
+        """Шаблоны рабочей недели для массовой генерации расписаний"""
+        cursor = self.db.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS master_schedule_templates (
+                master_id INTEGER PRIMARY KEY,
+                start_minute INTEGER NOT NULL,
+                end_minute INTEGER NOT NULL,
+                working_days TEXT NOT NULL,
+                FOREIGN KEY (master_id) REFERENCES masters(id)
+            )
+        """)
+        self.db.commit()
+    
+    def _migrate_schedule_json(self):
+        """
+        Миграция: перенести schedule_json в master_slots
+        
+        Заказы, которые не помещаются в слоты (вне графика, пересечения),
+        не теряются: они записываются в master_slot_conflicts вместе с
+        исходным днём из schedule_json для ручного разбора.
+        """
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT id, schedule_json FROM masters
+            WHERE schedule_json IS NOT NULL AND schedule_json != ''
+        """)
+        
+        for master_id, schedule_json in cursor.fetchall():
+            legacy = json.loads(schedule_json)
+            schedule = {
+                date: DaySchedule.from_dict(day_data)
+                for date, day_data in legacy.items()
+            }
+            unplaced = self.set_master_schedule(master_id, schedule)
+            
+            for date_key, job_id in unplaced:
+                print(f"⚠️ schedule_json мастера #{master_id}: заказ #{job_id} на {date_key} "
+                      f"не помещается в слоты, сохранён в master_slot_conflicts")
+                cursor.execute("""
+                    INSERT INTO master_slot_conflicts (master_id, date, job_id, day_json)
+                    VALUES (?, ?, ?, ?)
+                """, (master_id, date_key, job_id, json.dumps(legacy[date_key])))
+            
+            cursor.execute("UPDATE masters SET schedule_json = NULL WHERE id = ?", (master_id,))
+            self.db.commit()
+    
     def set_master_schedule(
         self,
         master_id: int,
         schedule: Dict[str, DaySchedule]
-    ):
-        """Установить расписание мастера"""
-        schedule_json = json.dumps(
-            {date: day.to_dict() for date, day in schedule.items()},
-            ensure_ascii=False
-        )
+    ) -> List[Tuple[str, int]]:
+        """
+        Установить расписание мастера (забронированные слоты сохраняются)
         
+        Returns:
+            (дата, job_id) заказов из booked_jobs, которые не удалось забронировать
+        """
         cursor = self.db.cursor()
         cursor.execute(
-            "UPDATE masters SET schedule_json = ? WHERE id = ?",
-            (schedule_json, master_id)
+            "DELETE FROM master_slots WHERE master_id = ? AND job_id IS NULL",
+            (master_id,)
         )
+        
+        for date_key, day in schedule.items():
+            if day.available and day.time_slot:
+                cursor.executemany("""
+                    INSERT OR IGNORE INTO master_slots (master_id, date, start_minute, end_minute)
+                    VALUES (?, ?, ?, ?)
+                """, _slot_rows(master_id, date_key, day.time_slot))
+        
         self.db.commit()
+        
+        # Заказы без времени (старый формат) - в первые свободные слоты дня
+        unplaced = []
+        for date_key, day in schedule.items():
+            booked = self._get_booked_jobs(master_id, date_key)
+            for job_id in day.booked_jobs:
+                if job_id not in booked and not self.book_master_for_job(
+                    master_id, job_id, datetime.strptime(date_key, "%Y-%m-%d")
+                ):
+                    unplaced.append((date_key, job_id))
+        
+        return unplaced
     
     def get_master_schedule(self, master_id: int) -> Dict[str, DaySchedule]:
         """Получить расписание мастера"""
         cursor = self.db.cursor()
-        cursor.execute(
-            "SELECT schedule_json FROM masters WHERE id = ?",
-            (master_id,)
-        )
-        row = cursor.fetchone()
+        cursor.execute("""
+            SELECT date, start_minute, end_minute, job_id
+            FROM master_slots
+            WHERE master_id = ?
+            ORDER BY date, start_minute
+        """, (master_id,))
         
-        if not row or not row[0]:
-            return {}
+        rows_by_date: Dict[str, List[Tuple]] = {}
+        for date_key, start_minute, end_minute, job_id in cursor.fetchall():
+            rows_by_date.setdefault(date_key, []).append((start_minute, end_minute, job_id))
         
-        schedule_data = json.loads(row[0])
         return {
-            date: DaySchedule.from_dict(day_data)
-            for date, day_data in schedule_data.items()
+            date_key: _day_from_slots(date_key, rows)
+            for date_key, rows in rows_by_date.items()
         }
     
     def update_day_schedule(
@@ -145,24 +499,25 @@ class ScheduleManager:
         end_time: Optional[str] = None
     ):
         """Обновить расписание на конкретный день"""
-        schedule = self.get_master_schedule(master_id)
         date_key = date.strftime("%Y-%m-%d")
         
-        time_slot = None
+        cursor = self.db.cursor()
+        cursor.execute(
+            "DELETE FROM master_slots WHERE master_id = ? AND date = ? AND job_id IS NULL",
+            (master_id, date_key)
+        )
+        
         if available and start_time and end_time:
             time_slot = TimeSlot(
                 start=time.fromisoformat(start_time),
                 end=time.fromisoformat(end_time)
             )
+            cursor.executemany("""
+                INSERT OR IGNORE INTO master_slots (master_id, date, start_minute, end_minute)
+                VALUES (?, ?, ?, ?)
+            """, _slot_rows(master_id, date_key, time_slot))
         
-        schedule[date_key] = DaySchedule(
-            date=date,
-            available=available,
-            time_slot=time_slot,
-            booked_jobs=schedule.get(date_key, DaySchedule(date, False, None, [])).booked_jobs
-        )
-        
-        self.set_master_schedule(master_id, schedule)
+        self.db.commit()
     
     def is_master_available(
         self,
@@ -171,18 +526,21 @@ class ScheduleManager:
         check_time: Optional[time] = None
     ) -> bool:
         """Проверка доступности мастера на дату/время"""
-        schedule = self.get_master_schedule(master_id)
+        cursor = self.db.cursor()
         date_key = date.strftime("%Y-%m-%d")
         
-        if date_key not in schedule:
-            return False
-        
-        day_schedule = schedule[date_key]
-        
         if check_time:
-            return day_schedule.is_available_at(check_time)
+            cursor.execute("""
+                SELECT 1 FROM master_slots
+                WHERE master_id = ? AND date = ? AND start_minute = ? AND job_id IS NULL
+            """, (master_id, date_key, _slot_start(check_time)))
         else:
-            return day_schedule.available
+            cursor.execute(
+                "SELECT 1 FROM master_slots WHERE master_id = ? AND date = ? LIMIT 1",
+                (master_id, date_key)
+            )
+        
+        return cursor.fetchone() is not None
     
     def get_available_masters(
         self,
@@ -193,38 +551,232 @@ class ScheduleManager:
     ) -> List[int]:
         """Получить список доступных мастеров"""
         cursor = self.db.cursor()
+        date_key = date.strftime("%Y-%m-%d")
         
-        # Получить всех активных мастеров с нужной специализацией и городом
-        cursor.execute("""
-            SELECT id FROM masters
-            WHERE is_active = 1
-            AND city = ?
-            AND specializations LIKE ?
-        """, (city, f'%{specialization}%'))
+        if check_time:
+            # Свободный слот в нужное время - по частичному индексу сразу для всех мастеров
+            cursor.execute("""
+                SELECT m.id FROM master_slots s
+                JOIN masters m ON m.id = s.master_id
+                WHERE s.date = ? AND s.start_minute = ? AND s.job_id IS NULL
+                AND m.is_active = 1
+                AND m.city = ?
+                AND m.specializations LIKE ?
+            """, (date_key, _slot_start(check_time), city, f'%{specialization}%'))
+        else:
+            cursor.execute("""
+                SELECT m.id FROM masters m
+                WHERE m.is_active = 1
+                AND m.city = ?
+                AND m.specializations LIKE ?
+                AND EXISTS (
+                    SELECT 1 FROM master_slots s
+                    WHERE s.master_id = m.id AND s.date = ?
+                )
+            """, (city, f'%{specialization}%', date_key))
         
-        all_masters = [row[0] for row in cursor.fetchall()]
+        return [row[0] for row in cursor.fetchall()]
+    
+    def get_day_masks(self, date: datetime, master_ids: Optional[List[int]] = None) -> Dict[int, DayMask]:
+        """Битовые маски дня для всех (или выбранных) мастеров одним запросом"""
+        cursor = self.db.cursor()
+        
+        # Целые SQLite 64-битные, поэтому 96 слотов собираем из двух половин по 48
+        half = SLOTS_PER_DAY // 2
+        half_minutes = half * SLOT_MINUTES
+        query = f"""
+            SELECT
+                master_id,
+                SUM(CASE WHEN start_minute < {half_minutes}
+                    THEN 1 << (start_minute / {SLOT_MINUTES}) ELSE 0 END),
+                SUM(CASE WHEN start_minute >= {half_minutes}
+                    THEN 1 << (start_minute / {SLOT_MINUTES} - {half}) ELSE 0 END),
+                SUM(CASE WHEN job_id IS NOT NULL AND start_minute < {half_minutes}
+                    THEN 1 << (start_minute / {SLOT_MINUTES}) ELSE 0 END),
+                SUM(CASE WHEN job_id IS NOT NULL AND start_minute >= {half_minutes}
+                    THEN 1 << (start_minute / {SLOT_MINUTES} - {half}) ELSE 0 END)
+            FROM master_slots
+            WHERE date = ?
+        """
+        params: List = [date.strftime("%Y-%m-%d")]
+        
+        if master_ids is not None:
+            query += f" AND master_id IN ({', '.join('?' * len(master_ids))})"
+            params.extend(master_ids)
+        
+        query += " GROUP BY master_id"
+        cursor.execute(query, params)
         
-        # Отфильтровать по доступности
-        available_masters = []
-        for master_id in all_masters:
-            if self.is_master_available(master_id, date, check_time):
-                available_masters.append(master_id)
+        return {
+            master_id: DayMask(
+                working=working_low | (working_high << half),
+                booked=booked_low | (booked_high << half)
+            )
+            for master_id, working_low, working_high, booked_low, booked_high in cursor.fetchall()
+        }
+    
+    def find_free_masters(
+        self,
+        date: datetime,
+        start: time,
+        end: time,
+        master_ids: Optional[List[int]] = None
+    ) -> List[int]:
+        """Кто свободен весь интервал [start, end) - например, с 14:00 до 16:00"""
+        needed = range_mask(_to_minutes(start), _to_minutes(end))
+        return [
+            master_id
+            for master_id, mask in self.get_day_masks(date, master_ids).items()
+            if mask.free & needed == needed
+        ]
+    
+    def common_free_windows(
+        self,
+        master_ids: List[int],
+        date: datetime,
+        min_minutes: int = DEFAULT_JOB_MINUTES
+    ) -> List[TimeSlot]:
+        """Окна, когда свободны все указанные мастера (например, для бригады)"""
+        masks = self.get_day_masks(date, master_ids)
+        if len(masks) < len(set(master_ids)):
+            return []
         
-        return available_masters
+        common = (1 << SLOTS_PER_DAY) - 1
+        for mask in masks.values():
+            common &= mask.free
+        return _mask_windows(common, min_minutes)
     
     def book_master_for_job(
         self,
         master_id: int,
         job_id: int,
-        date: datetime
-    ):
-        """Забронировать мастера на заказ"""
-        schedule = self.get_master_schedule(master_id)
+        date: datetime,
+        duration_minutes: int = DEFAULT_JOB_MINUTES,
+        commit: bool = True
+    ) -> bool:
+        """
+        Забронировать мастера на заказ
+        
+        Если у date есть время - бронируется именно оно, иначе самое раннее
+        окно дня с учётом буфера на дорогу. Слоты занимаются одним условным
+        UPDATE, который заодно проверяет буфер до соседних заказов, поэтому
+        два параллельных бронирования одного окна невозможны.
+        
+        commit=False - бронь остаётся в транзакции вызывающего (при неудаче
+        откатывается только она сама).
+        
+        Returns:
+            True если бронь создана, False если окно занято или вне графика
+        """
+        cursor = self.db.cursor()
         date_key = date.strftime("%Y-%m-%d")
+        slots_needed = -(-duration_minutes // SLOT_MINUTES)
+        
+        if date.hour or date.minute:
+            start_minute = _slot_start(date.time())
+            calendar = self.get_booking_calendar(master_id, date)
+            if calendar.conflicts(start_minute, start_minute + slots_needed * SLOT_MINUTES):
+                return False
+        else:
+            start_minute = self.find_earliest_start(master_id, date, duration_minutes)
+            if start_minute is None:
+                return False
+        
+        end_minute = start_minute + slots_needed * SLOT_MINUTES
+        
+        cursor.execute("SAVEPOINT book_slots")
+        cursor.execute("""
+            UPDATE master_slots SET job_id = ?
+            WHERE master_id = ? AND date = ?
+            AND start_minute >= ? AND start_minute < ?
+            AND job_id IS NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM master_slots b
+                WHERE b.master_id = ? AND b.date = ?
+                AND b.job_id IS NOT NULL AND b.job_id != ?
+                AND b.start_minute < ? AND b.end_minute > ?
+            )
+        """, (
+            job_id, master_id, date_key, start_minute, end_minute,
+            master_id, date_key, job_id,
+            end_minute + self.travel_minutes, start_minute - self.travel_minutes
+        ))
         
-        if date_key in schedule:
-            schedule[date_key].booked_jobs.append(job_id)
-            self.set_master_schedule(master_id, schedule)
+        if cursor.rowcount != slots_needed:
+            # Часть окна занята, выходит за рабочее время или не хватает времени на дорогу
+            cursor.execute("ROLLBACK TO book_slots")
+            cursor.execute("RELEASE book_slots")
+            if commit:
+                self.db.rollback()
+            return False
+        
+        cursor.execute("RELEASE book_slots")
+        if commit:
+            self.db.commit()
+        return True
+    
+    def get_booking_calendar(self, master_id: int, date: datetime) -> BookingCalendar:
+        """Календарь заказов мастера на дату"""
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT start_minute, end_minute, job_id FROM master_slots
+            WHERE master_id = ? AND date = ? AND job_id IS NOT NULL
+            ORDER BY start_minute
+        """, (master_id, date.strftime("%Y-%m-%d")))
+        return BookingCalendar.from_slots(cursor.fetchall(), self.travel_minutes)
+    
+    def find_earliest_start(
+        self,
+        master_id: int,
+        date: datetime,
+        duration_minutes: int = DEFAULT_JOB_MINUTES,
+        not_before: Optional[time] = None
+    ) -> Optional[int]:
+        """
+        Самое раннее начало заказа (минуты от полуночи) или None
+        
+        Учитывает рабочие слоты мастера и буфер на дорогу до и после
+        уже назначенных заказов.
+        """
+        mask = self.get_day_masks(date, [master_id]).get(master_id)
+        if mask is None or not mask.working:
+            return None
+        
+        calendar = self.get_booking_calendar(master_id, date)
+        window_start = (mask.working & -mask.working).bit_length() - 1
+        window_end = mask.working.bit_length() * SLOT_MINUTES
+        candidate = window_start * SLOT_MINUTES
+        if not_before is not None:
+            candidate = max(candidate, _slot_start(not_before))
+        
+        slots_needed = -(-duration_minutes // SLOT_MINUTES)
+        while True:
+            start_minute = calendar.earliest_start(slots_needed * SLOT_MINUTES, candidate, window_end)
+            if start_minute is None:
+                return None
+            
+            # Бронь идёт по сетке слотов
+            aligned = -(-start_minute // SLOT_MINUTES) * SLOT_MINUTES
+            if aligned != start_minute:
+                candidate = aligned
+                continue
+            
+            # В рабочем окне могут быть перерывы
+            needed = range_mask(start_minute, start_minute + slots_needed * SLOT_MINUTES)
+            if mask.free & needed == needed:
+                return start_minute
+            candidate = start_minute + SLOT_MINUTES
+    
+    def _get_booked_jobs(self, master_id: int, date_key: str) -> List[int]:
+        """ID заказов мастера на дату в порядке начала"""
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT job_id FROM master_slots
+            WHERE master_id = ? AND date = ? AND job_id IS NOT NULL
+            GROUP BY job_id
+            ORDER BY MIN(start_minute)
+        """, (master_id, date_key))
+        return [row[0] for row in cursor.fetchall()]
     
     def confirm_daily_schedule(self, master_id: int) -> bool:
         """Подтвердить расписание на сегодня"""
@@ -250,7 +802,19 @@ class ScheduleManager:
         
         last_confirmation = datetime.fromisoformat(row[0])
         # Подтверждение нужно если последнее было больше 12 часов назад
-        return (datetime.now() - last_confirmation) > timedelta(hours=12)
+        return (datetime.now() - last_confirmation) > CONFIRMATION_INTERVAL
+    
+    def get_masters_needing_confirmation(self) -> List[int]:
+        """Все активные мастера, которым нужно подтвердить расписание (одним запросом)"""
+        cursor = self.db.cursor()
+        # ISO-строки сравниваются в хронологическом порядке
+        cursor.execute("""
+            SELECT id FROM masters
+            WHERE is_active = 1
+            AND (last_schedule_confirmation IS NULL OR last_schedule_confirmation < ?)
+            ORDER BY id
+        """, ((datetime.now() - CONFIRMATION_INTERVAL).isoformat(),))
+        return [row[0] for row in cursor.fetchall()]
     
     def create_weekly_schedule(
         self,
@@ -289,47 +853,512 @@ class ScheduleManager:
         
         self.set_master_schedule(master_id, schedule)
     
-    def get_master_workload(self, master_id: int, date: datetime) -> int:
-        """Получить количество заказов мастера на дату"""
-        schedule = self.get_master_schedule(master_id)
-        date_key = date.strftime("%Y-%m-%d")
+    def set_schedule_template(
+        self,
+        master_id: int,
+        default_start: str = "08:00",
+        default_end: str = "20:00",
+        working_days: List[int] = None
+    ):
+        """Сохранить шаблон рабочей недели мастера"""
+        if working_days is None:
+            working_days = [0, 1, 2, 3, 4]  # Пн-Пт
+        
+        cursor = self.db.cursor()
+        cursor.execute("""
+            INSERT OR REPLACE INTO master_schedule_templates
+            (master_id, start_minute, end_minute, working_days)
+            VALUES (?, ?, ?, ?)
+        """, (
+            master_id,
+            _to_minutes(time.fromisoformat(default_start)),
+            _to_minutes(time.fromisoformat(default_end)),
+            ",".join(str(day) for day in sorted(working_days))
+        ))
+        self.db.commit()
+    
+    def generate_weekly_schedules(self, week_start: Optional[datetime] = None) -> int:
+        """
+        Сгенерировать неделю слотов для всех активных мастеров по шаблонам
+        
+        Мастера без шаблона получают 08:00-20:00 Пн-Пт, как в
+        create_weekly_schedule. Свободные слоты недели пересоздаются,
+        занятые заказами остаются. Всё пишется одной транзакцией.
         
-        if date_key not in schedule:
-            return 0
+        Args:
+            week_start: Первый день недели (по умолчанию ближайший понедельник)
         
-        return len(schedule[date_key].booked_jobs)
+        Returns:
+            Количество созданных слотов
+        """
+        if week_start is None:
+            today = datetime.now().date()
+            week_start = datetime.combine(today + timedelta(days=7 - today.weekday()), datetime.min.time())
+        days = [week_start + timedelta(days=i) for i in range(7)]
+        date_keys = [day.strftime("%Y-%m-%d") for day in days]
+        
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT m.id,
+                COALESCE(t.start_minute, 480),
+                COALESCE(t.end_minute, 1200),
+                COALESCE(t.working_days, ?)
+            FROM masters m
+            LEFT JOIN master_schedule_templates t ON t.master_id = m.id
+            WHERE m.is_active = 1
+        """, (DEFAULT_WORKING_DAYS,))
+        templates = cursor.fetchall()
+        
+        def slot_rows():
+            # Строки для всей недели одного мастера - без промежуточных списков
+            for master_id, start_minute, end_minute, working_days in templates:
+                weekdays = {int(day) for day in working_days.split(",") if day}
+                for day, date_key in zip(days, date_keys):
+                    if day.weekday() not in weekdays:
+                        continue
+                    for minute in range(start_minute, end_minute, SLOT_MINUTES):
+                        yield (master_id, date_key, minute, min(minute + SLOT_MINUTES, end_minute))
+        
+        try:
+            cursor.execute("""
+                DELETE FROM master_slots
+                WHERE date >= ? AND date <= ? AND job_id IS NULL
+                AND master_id IN (SELECT id FROM masters WHERE is_active = 1)
+            """, (date_keys[0], date_keys[-1]))
+            cursor.executemany("""
+                INSERT OR IGNORE INTO master_slots (master_id, date, start_minute, end_minute)
+                VALUES (?, ?, ?, ?)
+            """, slot_rows())
+            created = cursor.rowcount
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        
+        return created
+    
+    def get_master_workload(self, master_id: int, date: datetime) -> int:
+        """Получить количество заказов мастера на дату"""
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT COUNT(DISTINCT job_id) FROM master_slots
+            WHERE master_id = ? AND date = ?
+        """, (master_id, date.strftime("%Y-%m-%d")))
+        return cursor.fetchone()[0]
     
     def find_best_available_master(
         self,
         specialization: str,
         city: str,
         date: datetime,
-        check_time: Optional[time] = None
+        check_time: Optional[time] = None,
+        duration_minutes: Optional[int] = None
     ) -> Optional[int]:
-        """Найти лучшего доступного мастера"""
-        available_masters = self.get_available_masters(
-            specialization, city, date, check_time
+        """
+        Найти лучшего доступного мастера
+        
+        Если указана длительность, заказ должен поместиться в календарь
+        мастера вместе с буфером на дорогу (со check_time - именно в это время).
+        """
+        if duration_minutes is None:
+            candidates = self.rank_available_masters(
+                specialization, city, date, check_time, limit=1
+            )
+            return candidates[0].master_id if candidates else None
+        
+        candidates = self.rank_available_masters(
+            specialization, city, date, check_time, limit=DISPATCH_CANDIDATES
         )
+        for candidate in candidates:
+            start_minute = self.find_earliest_start(
+                candidate.master_id, date, duration_minutes, not_before=check_time
+            )
+            if start_minute is None:
+                continue
+            if check_time is None or start_minute == _slot_start(check_time):
+                return candidate.master_id
         
-        if not available_masters:
-            return None
+        return None
+    
+    def rank_available_masters(
+        self,
+        specialization: str,
+        city: str,
+        date: datetime,
+        check_time: Optional[time] = None,
+        limit: int = 5
+    ) -> List[MasterCandidate]:
+        """
+        Топ доступных мастеров одним запросом
         
-        # Сортировка по рейтингу и загрузке
+        Балл = рейтинг * 10 - загрузка (число заказов на дату),
+        мастер без рейтинга считается как 5.0.
+        """
         cursor = self.db.cursor()
-        master_scores = []
+        date_key = date.strftime("%Y-%m-%d")
         
-        for master_id in available_masters:
-            cursor.execute(
-                "SELECT rating FROM masters WHERE id = ?",
-                (master_id,)
+        # Без времени достаточно рабочего дня, со временем - свободный слот
+        slot_condition = ""
+        slot_params: Tuple = ()
+        if check_time:
+            slot_condition = "AND s.start_minute = ? AND s.job_id IS NULL"
+            slot_params = (_slot_start(check_time),)
+        
+        cursor.execute(f"""
+            WITH workload AS (
+                SELECT master_id, COUNT(DISTINCT job_id) AS jobs
+                FROM master_slots
+                WHERE date = ? AND job_id IS NOT NULL
+                GROUP BY master_id
             )
-            rating = cursor.fetchone()[0] or 5.0
-            workload = self.get_master_workload(master_id, date)
-            
-            # Балл = рейтинг * 10 - загрузка
-            score = (rating * 10) - workload
-            master_scores.append((master_id, score))
+            SELECT
+                m.id,
+                COALESCE(NULLIF(m.rating, 0), 5.0) AS rating,
+                COALESCE(w.jobs, 0) AS workload,
+                COALESCE(NULLIF(m.rating, 0), 5.0) * 10 - COALESCE(w.jobs, 0) AS score
+            FROM masters m
+            LEFT JOIN workload w ON w.master_id = m.id
+            WHERE m.is_active = 1
+            AND m.city = ?
+            AND m.specializations LIKE ?
+            AND EXISTS (
+                SELECT 1 FROM master_slots s
+                WHERE s.master_id = m.id AND s.date = ?
+                {slot_condition}
+            )
+            ORDER BY score DESC, m.id
+            LIMIT ?
+        """, (date_key, city, f'%{specialization}%', date_key) + slot_params + (limit,))
+        
+        return [
+            MasterCandidate(master_id=row[0], rating=row[1], workload=row[2], score=row[3])
+            for row in cursor.fetchall()
+        ]
+
+
+def _create_test_masters(conn, count: int, city: str = "Калининград"):
+    """Тестовые мастера для проверок и бенчмарков"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS masters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            full_name TEXT NOT NULL,
+            phone TEXT UNIQUE NOT NULL,
+            specializations TEXT NOT NULL,
+            city TEXT NOT NULL,
+            rating REAL DEFAULT 5.0,
+            is_active BOOLEAN DEFAULT 1,
+            schedule_json TEXT
+        )
+    """)
+    conn.executemany(
+        "INSERT INTO masters (full_name, phone, specializations, city, rating) VALUES (?, ?, ?, ?, ?)",
+        [
+            (f"Мастер {i}", f"+7900{i:07d}", '["electrical"]', city, 3.5 + (i % 16) / 10)
+            for i in range(count)
+        ]
+    )
+    conn.commit()
+
+
+def _check_double_booking(db_path: str, workers: int = 16):
+    """Параллельные бронирования одного окна: успешно ровно одно"""
+    import sqlite3
+    import threading
+    
+    tomorrow = datetime.combine(datetime.now().date() + timedelta(days=1), time(10, 0))
+    barrier = threading.Barrier(workers)
+    results = []
+    
+    def worker(job_id: int):
+        conn = sqlite3.connect(db_path, timeout=30)
+        manager = ScheduleManager(conn)
+        barrier.wait()
+        # Окна пересекаются: 10:00-11:00 и 10:30-11:30
+        start = tomorrow if job_id % 2 else tomorrow + timedelta(minutes=30)
+        results.append((job_id, manager.book_master_for_job(1, job_id, start)))
+        conn.close()
+    
+    threads = [threading.Thread(target=worker, args=(job_id,)) for job_id in range(1, workers + 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    winners = [job_id for job_id, booked in results if booked]
+    assert len(winners) == 1, f"Двойное бронирование: {winners}"
+    print(f"✅ {workers} параллельных бронирований: успешно только заказ #{winners[0]}")
+
+
+def _check_booking_calendar(rounds: int = 300, queries: int = 200):
+    """Случайная сверка BookingCalendar с полным перебором"""
+    import random
+    
+    rng = random.Random(11)
+    for _ in range(rounds):
+        travel = rng.choice([0, 15, 30, 45])
+        calendar = BookingCalendar(travel)
+        oracle = []
+        
+        def brute_conflicts(start: int, end: int) -> bool:
+            return any(s < end + travel and start < e + travel for s, e in oracle)
         
-        # Выбрать мастера с наивысшим баллом
+        for job_id in range(rng.randint(0, 12)):
+            start = rng.randrange(0, 24 * 60 - 30, 5)
+            end = start + rng.randrange(5, 180, 5)
+            if brute_conflicts(start, end):
+                try:
+                    calendar.add(start, end, job_id)
+                except ValueError:
+                    continue
+                raise AssertionError("Конфликт не обнаружен при добавлении")
+            calendar.add(start, end, job_id)
+            oracle.append((start, end))
+        
+        assert [(s, e) for s, e, _ in calendar.intervals] == sorted(oracle)
+        
+        for _ in range(queries):
+            start = rng.randrange(0, 24 * 60, 5)
+            duration = rng.randrange(5, 240, 5)
+            assert calendar.conflicts(start, start + duration) == brute_conflicts(start, start + duration)
+            
+            window_start = rng.randrange(0, 24 * 60, 5)
+            window_end = rng.randrange(window_start, 24 * 60 + 1, 5)
+            expected = next(
+                (t for t in range(window_start, window_end - duration + 1)
+                 if not brute_conflicts(t, t + duration)),
+                None
+            )
+            assert calendar.earliest_start(duration, window_start, window_end) == expected
+    
+    print(f"✅ BookingCalendar совпал с перебором на {rounds * queries} запросах")
+
+
+def _fill_test_day(conn, masters_count: int) -> Tuple['ScheduleManager', datetime]:
+    """Мастера с рабочим днём 08:00-20:00 завтра и случайными заказами"""
+    import random
+    
+    _create_test_masters(conn, masters_count)
+    manager = ScheduleManager(conn)
+    
+    day = datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+    date_key = day.strftime("%Y-%m-%d")
+    working = TimeSlot(start=time(8, 0), end=time(20, 0))
+    rows = []
+    for master_id in range(1, masters_count + 1):
+        rows.extend(_slot_rows(master_id, date_key, working))
+    conn.executemany(
+        "INSERT INTO master_slots (master_id, date, start_minute, end_minute) VALUES (?, ?, ?, ?)",
+        rows
+    )
+    rng = random.Random(7)
+    conn.executemany(
+        "UPDATE master_slots SET job_id = ? WHERE master_id = ? AND date = ? AND start_minute = ?",
+        [
+            (job_id, rng.randint(1, masters_count), date_key, rng.randrange(8 * 60, 20 * 60, SLOT_MINUTES))
+            for job_id in range(masters_count * 2)
+        ]
+    )
+    conn.commit()
+    return manager, day
+
+
+def _bench_ranking(masters_count: int = 5000, rounds: int = 20):
+    """Бенчмарк ранжирования: один запрос против прежнего N+1"""
+    import sqlite3
+    import time as timer
+    
+    conn = sqlite3.connect(":memory:")
+    manager, day = _fill_test_day(conn, masters_count)
+    
+    def legacy_find_best(check_time):
+        # Прежний алгоритм: кандидаты, затем рейтинг и загрузка по одному
+        cursor = conn.cursor()
+        master_scores = []
+        for master_id in manager.get_available_masters("electrical", "Калининград", day, check_time):
+            cursor.execute("SELECT rating FROM masters WHERE id = ?", (master_id,))
+            rating = cursor.fetchone()[0] or 5.0
+            master_scores.append((master_id, rating * 10 - manager.get_master_workload(master_id, day)))
         master_scores.sort(key=lambda x: x[1], reverse=True)
         return master_scores[0][0] if master_scores else None
+    
+    for check_time in (None, time(14, 0)):
+        started = timer.perf_counter()
+        for _ in range(rounds):
+            expected = legacy_find_best(check_time)
+        legacy_ms = (timer.perf_counter() - started) * 1000 / rounds
+        
+        started = timer.perf_counter()
+        for _ in range(rounds):
+            actual = manager.find_best_available_master("electrical", "Калининград", day, check_time)
+        single_ms = (timer.perf_counter() - started) * 1000 / rounds
+        
+        assert actual == expected, f"Разные результаты: {actual} != {expected}"
+        label = check_time.strftime("%H:%M") if check_time else "весь день"
+        print(f"✅ Ранжирование {masters_count} мастеров ({label}): "
+              f"N+1 {legacy_ms:.1f} мс, один запрос {single_ms:.1f} мс")
+    
+    conn.close()
+
+
+def _bench_masks(masters_count: int = 5000, rounds: int = 20):
+    """Микро-бенчмарки битовых масок на типичных запросах"""
+    import sqlite3
+    import time as timer
+    
+    conn = sqlite3.connect(":memory:")
+    manager, day = _fill_test_day(conn, masters_count)
+    
+    def measure(label: str, func):
+        started = timer.perf_counter()
+        for _ in range(rounds):
+            result = func()
+        elapsed_ms = (timer.perf_counter() - started) * 1000 / rounds
+        print(f"✅ {label}: {elapsed_ms:.2f} мс")
+        return result
+    
+    masks = measure(f"Маски дня для {masters_count} мастеров (SQL)", lambda: manager.get_day_masks(day))
+    
+    # Сверка с построчной сборкой через DaySchedule
+    for master_id in (1, masters_count // 2, masters_count):
+        day_schedule = manager.get_master_schedule(master_id)[day.strftime("%Y-%m-%d")]
+        assert day_schedule.mask == masks[master_id]
+    
+    needed = range_mask(14 * 60, 16 * 60)
+    free = measure(
+        "Кто свободен 14:00-16:00 (по готовым маскам)",
+        lambda: [master_id for master_id, mask in masks.items() if mask.free & needed == needed]
+    )
+    measure("Кто свободен 14:00-16:00 (запрос + маски)", lambda: manager.find_free_masters(day, time(14, 0), time(16, 0)))
+    measure("Свободные окна >= 1 ч у всех мастеров", lambda: [mask.free_windows(60) for mask in masks.values()])
+    measure("Свободные минуты у всех мастеров", lambda: [mask.free_minutes() for mask in masks.values()])
+    measure("Общие окна бригады из 5 мастеров", lambda: manager.common_free_windows(free[:5], day))
+    
+    # Проверка по слотам: мастер свободен в 14:00-16:00, только если все 8 слотов свободны
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT master_id FROM master_slots
+        WHERE date = ? AND start_minute >= 840 AND start_minute < 960 AND job_id IS NULL
+        GROUP BY master_id HAVING COUNT(*) = 8
+    """, (day.strftime("%Y-%m-%d"),))
+    assert sorted(free) == sorted(row[0] for row in cursor.fetchall())
+    print(f"✅ Свободны 14:00-16:00: {len(free)} из {masters_count}")
+    
+    conn.close()
+
+
+def _bench_weekly_generation(masters_count: int = 10000, legacy_sample: int = 500):
+    """Бенчмарк генерации недели: массово против create_weekly_schedule по одному"""
+    import os
+    import sqlite3
+    import tempfile
+    import time as timer
+    
+    db_path = os.path.join(tempfile.mkdtemp(), "weekly_bench.db")
+    conn = sqlite3.connect(db_path)
+    _create_test_masters(conn, masters_count)
+    conn.execute("ALTER TABLE masters ADD COLUMN last_schedule_confirmation TIMESTAMP")
+    conn.commit()
+    manager = ScheduleManager(conn)
+    
+    # Часть мастеров со своим шаблоном, часть подтвердила расписание
+    for master_id in range(1, masters_count + 1, 10):
+        manager.set_schedule_template(master_id, "10:00", "18:00", [1, 2, 3, 4, 5])
+    conn.execute(
+        "UPDATE masters SET last_schedule_confirmation = ? WHERE id % 3 = 0",
+        (datetime.now().isoformat(),)
+    )
+    conn.commit()
+    
+    # Прежний путь: отдельная транзакция на каждого мастера (замер на выборке)
+    started = timer.perf_counter()
+    for master_id in range(1, legacy_sample + 1):
+        manager.create_weekly_schedule(master_id)
+    legacy_s = (timer.perf_counter() - started) * masters_count / legacy_sample
+    
+    started = timer.perf_counter()
+    needing = [
+        master_id for master_id in range(1, legacy_sample + 1)
+        if manager.needs_schedule_confirmation(master_id)
+    ]
+    legacy_confirm_ms = (timer.perf_counter() - started) * 1000 * masters_count / legacy_sample
+    
+    week_start = datetime.combine(datetime.now().date() + timedelta(days=7), datetime.min.time())
+    started = timer.perf_counter()
+    created = manager.generate_weekly_schedules(week_start)
+    bulk_s = timer.perf_counter() - started
+    
+    started = timer.perf_counter()
+    needing_all = manager.get_masters_needing_confirmation()
+    confirm_ms = (timer.perf_counter() - started) * 1000
+    
+    assert needing == [master_id for master_id in needing_all if master_id <= legacy_sample]
+    
+    # Шаблон 10:00-18:00 Вт-Сб: 5 дней по 32 слота, по умолчанию 5 дней по 48
+    custom = masters_count // 10
+    assert created == custom * 5 * 32 + (masters_count - custom) * 5 * 48, created
+    print(f"✅ Неделя для {masters_count} мастеров ({created} слотов): "
+          f"по одному ~{legacy_s:.1f} с, одной транзакцией {bulk_s:.1f} с")
+    print(f"✅ Кому нужно подтверждение ({len(needing_all)}): "
+          f"по одному ~{legacy_confirm_ms:.0f} мс, одним запросом {confirm_ms:.1f} мс")
+    
+    conn.close()
+
+
+if __name__ == "__main__":
+    # Самопроверка: python schedule_manager.py
+    import os
+    import sqlite3
+    import tempfile
+    
+    db_path = os.path.join(tempfile.mkdtemp(), "schedule_check.db")
+    conn = sqlite3.connect(db_path)
+    _create_test_masters(conn, 10)
+    
+    # Миграция старого schedule_json
+    tomorrow = datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+    legacy = {
+        tomorrow.strftime("%Y-%m-%d"): DaySchedule(
+            date=tomorrow,
+            available=True,
+            time_slot=TimeSlot(start=time(8, 0), end=time(20, 0)),
+            booked_jobs=[]
+        ).to_dict()
+    }
+    for master_id in range(1, 11):
+        conn.execute(
+            "UPDATE masters SET schedule_json = ? WHERE id = ?",
+            (json.dumps(legacy), master_id)
+        )
+    conn.commit()
+    
+    # Выходной день с заказом - разместить некуда, заказ должен сохраниться
+    day_off = tomorrow + timedelta(days=1)
+    legacy_with_job = dict(legacy)
+    legacy_with_job[day_off.strftime("%Y-%m-%d")] = DaySchedule(
+        date=day_off, available=False, time_slot=None, booked_jobs=[555]
+    ).to_dict()
+    conn.execute("UPDATE masters SET schedule_json = ? WHERE id = 1", (json.dumps(legacy_with_job),))
+    conn.commit()
+    
+    manager = ScheduleManager(conn)
+    assert manager.get_master_schedule(1)[tomorrow.strftime("%Y-%m-%d")].time_slot == TimeSlot(time(8, 0), time(20, 0))
+    conflicts = conn.execute("SELECT master_id, date, job_id FROM master_slot_conflicts").fetchall()
+    assert conflicts == [(1, day_off.strftime("%Y-%m-%d"), 555)], conflicts
+    print("✅ schedule_json перенесён в master_slots, неразмещённый заказ сохранён в конфликтах")
+    
+    _check_double_booking(db_path)
+    
+    # Буфер на дорогу: второй заказ не ближе чем через 30 минут после первого
+    assert manager.book_master_for_job(2, 101, tomorrow.replace(hour=10))
+    assert not manager.book_master_for_job(2, 102, tomorrow.replace(hour=11, minute=15))
+    assert manager.book_master_for_job(2, 102, tomorrow.replace(hour=11, minute=30))
+    assert manager.find_earliest_start(2, tomorrow) == 8 * 60
+    assert manager.find_earliest_start(2, tomorrow, 120, not_before=time(9, 0)) == 13 * 60
+    print("✅ Буфер на дорогу между заказами соблюдается")
+    conn.close()
+    
+    _check_booking_calendar()
+    
+    _bench_ranking()
+    _bench_masks()
+    _bench_weekly_generation()
@@ -7,12 +7,16 @@ Telegram бот для клиентов - BALT-SET.RU
 - Милые уведомления
 """
 import os
+import sys
+import asyncio
 import logging
 import httpx
+from typing import Optional
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
+    ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -45,6 +49,9 @@ except:
     print("⚠️ Master Notification не подключен")
     MASTER_NOTIFICATION_ENABLED = False
 
+from order_queue import OrderQueue, QueuedOrder
+from bot_persistence import SQLitePersistence
+
 # Загрузка переменных окружения
 load_dotenv()
 
@@ -63,6 +70,9 @@ API_URL = os.getenv("API_URL", "https://heallshoking-ai-service-platform-mvp-11-
 # Состояния диалога
 START, PROBLEM, ADDRESS, NAME, PHONE, CONFIRM, EDIT = range(7)
 
+# Очередь заявок (запускается в post_init, останавливается в post_shutdown)
+order_queue: Optional[OrderQueue] = None
+
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 
 def get_progress_bar(step: int, total: int = 5) -> str:
@@ -77,6 +87,85 @@ def get_back_to_menu_button():
     keyboard = [["🏠 Вернуться в меню"]]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+# ==================== ОЧЕРЕДЬ ЗАЯВОК ====================
+
+def save_order_to_sheets(data: dict) -> Optional[int]:
+    """Запись заявки в Google Sheets (gspread синхронный - воркер очереди вызывает в потоке)"""
+    if not GOOGLE_SHEETS_ENABLED:
+        return None
+    order_id = save_order_from_bot(source="telegram", **data)
+    if order_id is None:
+        # add_order глотает ошибки gspread и возвращает None - очередь должна повторить
+        raise RuntimeError("Google Sheets не сохранил заявку")
+    return order_id
+
+async def notify_masters(order: QueuedOrder):
+    """Рассылка мастерам из воркера очереди (при ошибке очередь повторит позже)"""
+    if not MASTER_NOTIFICATION_ENABLED:
+        return
+    data = order.data
+    metrics = await notify_masters_about_new_order(
+        order_id=order.order_id or 0,
+        category=data['category'],
+        problem=data['problem'],
+        address=data['address'],
+        client_name=data['name'],
+        client_phone=data['phone']
+    )
+    if metrics.masters:
+        logger.info(f"✅ Мастера уведомлены о заявке #{order.order_id}: {metrics.delivered}/{metrics.masters}")
+    else:
+        logger.warning(f"⚠️ Заявка #{order.order_id}: активных мастеров нет, рассылать некому")
+
+async def send_order_confirmation(bot, order: QueuedOrder):
+    """Номер заявки и ссылка на статус - клиенту, когда заявка записана в таблицу"""
+    order_id = order.order_id
+    reply_markup = None
+    
+    # Формируем итоговое сообщение
+    message = (
+        "✅ <b>Заявка создана!</b>\n\n"
+        f"🎫 Номер: <b>#{order_id if order_id else 'XXXX'}</b>\n"
+        f"📊 Статус: https://app.balt-set.ru/track.html?id={order_id if order_id else 'XXXX'}\n\n"
+        "📞 <b>Мастер свяжется с вами в течение 15 минут!</b>\n\n"
+        "💡 Отследить прогресс можно по ссылке выше"
+    )
+    
+    # === TELEGRAM FOLDERS: Предлагаем папку ===
+    if FOLDERS_ENABLED:
+        try:
+            folder_data = get_client_folder_invite()
+            message += "\n\n💡 <b>Совет:</b> Добавьте папку в Telegram для удобства!"
+            
+            keyboard = [[
+                InlineKeyboardButton(
+                    f"📁 Добавить папку \"{folder_data['folder_name']}\"",
+                    url=folder_data['link']
+                )
+            ]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+        except Exception as e:
+            logger.error(f"Ошибка папки: {e}")
+    
+    await bot.send_message(order.chat_id, message, parse_mode='HTML', reply_markup=reply_markup)
+
+async def post_init(application: Application):
+    """Запустить очередь заявок (и дообработать оставшиеся с прошлого запуска)"""
+    global order_queue
+    order_queue = OrderQueue(
+        save_order=save_order_to_sheets,
+        notify_masters=notify_masters,
+        on_saved=lambda order: send_order_confirmation(application.bot, order)
+    )
+    await order_queue.start()
+
+async def post_shutdown(application: Application):
+    """Остановить очередь заявок (необработанные останутся в SQLite)"""
+    global order_queue
+    if order_queue is not None:
+        await order_queue.stop()
+        order_queue = None
+
 # ==================== ОБРАБОТЧИКИ КОМАНД ====================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -365,73 +454,18 @@ async def handle_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return EDIT
     
     elif choice == "confirm_yes":
-        # Подтверждение - отправляем заявку
-        await query.edit_message_text("⏳ Создаю заявку...")
-        
+        # Заявка сразу ложится в локальную очередь: Google Sheets и мастера - в фоне,
+        # клиент не ждёт таблицу, а остальные пользователи бота - его
         data = context.user_data
+        order = {key: data[key] for key in ('name', 'phone', 'category', 'problem', 'address')}
+        await order_queue.enqueue(query.message.chat_id, order)
         
-        # === GOOGLE SHEETS: Сохраняем заявку ===
-        order_id = None
-        if GOOGLE_SHEETS_ENABLED:
-            try:
-                order_id = save_order_from_bot(
-                    name=data['name'],
-                    phone=data['phone'],
-                    category=data['category'],
-                    problem=data['problem'],
-                    address=data['address'],
-                    source="telegram"
-                )
-                logger.info(f"✅ Заявка #{order_id} сохранена в Google Sheets")
-            except Exception as e:
-                logger.error(f"⚠️ Ошибка Google Sheets: {e}")
-        
-        # === УВЕДОМЛЕНИЕ МАСТЕРОВ ===
-        await query.edit_message_text("🔍 Ищу подходящих мастеров...")
-        
-        if MASTER_NOTIFICATION_ENABLED:
-            try:
-                await notify_masters_about_new_order(
-                    order_id=order_id or 0,
-                    category=data['category'],
-                    problem=data['problem'],
-                    address=data['address'],
-                    client_name=data['name'],
-                    client_phone=data['phone']
-                )
-                logger.info(f"✅ Мастера уведомлены о заявке #{order_id}")
-            except Exception as e:
-                logger.error(f"⚠️ Ошибка уведомления мастеров: {e}")
-        
-        # Формируем итоговое сообщение
-        message = (
-            "✅ <b>Заявка создана!</b>\n\n"
-            f"🎫 Номер: <b>#{order_id if order_id else 'XXXX'}</b>\n"
-            f"📊 Статус: https://app.balt-set.ru/track.html?id={order_id if order_id else 'XXXX'}\n\n"
+        await query.edit_message_text(
+            "✅ <b>Заявка принята!</b>\n\n"
             "📞 <b>Мастер свяжется с вами в течение 15 минут!</b>\n\n"
-            "💡 Отследить прогресс можно по ссылке выше"
+            "🎫 Номер заявки и ссылку для отслеживания пришлю следующим сообщением",
+            parse_mode='HTML'
         )
-        
-        # === TELEGRAM FOLDERS: Предлагаем папку ===
-        if FOLDERS_ENABLED:
-            try:
-                folder_data = get_client_folder_invite()
-                message += "\n\n💡 <b>Совет:</b> Добавьте папку в Telegram для удобства!"
-                
-                keyboard = [[
-                    InlineKeyboardButton(
-                        f"📁 Добавить папку \"{folder_data['folder_name']}\"",
-                        url=folder_data['link']
-                    )
-                ]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.message.reply_text(message, parse_mode='HTML', reply_markup=reply_markup)
-            except Exception as e:
-                logger.error(f"Ошибка папки: {e}")
-                await query.message.reply_text(message, parse_mode='HTML')
-        else:
-            await query.message.reply_text(message, parse_mode='HTML')
-        
         return ConversationHandler.END
 
 async def handle_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -516,13 +550,18 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ==================== ЗАПУСК БОТА ====================
 
-def main():
-    """Запуск бота"""
-    if not TELEGRAM_BOT_TOKEN:
-        logger.error("❌ TELEGRAM_CLIENT_BOT_TOKEN не установлен!")
-        return
-    
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+def build_application(builder: Optional[ApplicationBuilder] = None) -> Application:
+    """Приложение бота с обработчиками (polling в main, webhook - в bot_webhooks)"""
+    if builder is None:
+        builder = Application.builder().token(TELEGRAM_BOT_TOKEN)
+    # Состояние диалогов и user_data переживают перезапуск (bot_state.db)
+    application = (
+        builder
+        .persistence(SQLitePersistence(namespace="client"))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Conversation Handler с улучшенным UX
     conv_handler = ConversationHandler(
@@ -537,12 +576,156 @@ def main():
             EDIT: [CallbackQueryHandler(handle_edit)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="order",
+        persistent=True,
     )
     
     application.add_handler(conv_handler)
+    return application
+
+def main():
+    """Запуск бота (polling)"""
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("❌ TELEGRAM_CLIENT_BOT_TOKEN не установлен!")
+        return
+    
+    application = build_application()
     
     logger.info("🤖 Telegram бот для клиентов (УЛУЧШЕННЫЙ) запущен!")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+async def _check_confirm_latency(confirmations: int = 20, sheets_latencies=(0.5, 2.0)):
+    """Задержка handle_confirm при медленном Google Sheets (Sheets и бот - заглушки)"""
+    import tempfile
+    import time
+    from types import SimpleNamespace
+    
+    global GOOGLE_SHEETS_ENABLED, MASTER_NOTIFICATION_ENABLED, FOLDERS_ENABLED, save_order_from_bot, order_queue
+    GOOGLE_SHEETS_ENABLED, MASTER_NOTIFICATION_ENABLED, FOLDERS_ENABLED = True, False, False
+    
+    for sheets_latency in sheets_latencies:
+        confirmed = []
+        
+        def slow_save(**order):
+            time.sleep(sheets_latency)  # gspread блокирует поток
+            confirmed.append(order['phone'])
+            return len(confirmed)
+        
+        async def noop(*args, **kwargs):
+            pass
+        
+        save_order_from_bot = slow_save
+        bot = SimpleNamespace(send_message=noop)
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            order_queue = OrderQueue(
+                f"{tmp}/orders.db",
+                save_order=save_order_to_sheets,
+                on_saved=lambda order: send_order_confirmation(bot, order)
+            )
+            await order_queue.start()
+            
+            async def confirm(n: int) -> float:
+                query = SimpleNamespace(
+                    data="confirm_yes", answer=noop, edit_message_text=noop,
+                    message=SimpleNamespace(chat_id=n)
+                )
+                context = SimpleNamespace(user_data={
+                    'name': 'Клиент', 'phone': f"+7900{n:07d}", 'category': '⚡ Электрика',
+                    'problem': 'Не работает розетка', 'address': 'ул. Ленина, 1'
+                })
+                started = time.perf_counter()
+                result = await handle_confirm(SimpleNamespace(callback_query=query), context)
+                assert result == ConversationHandler.END
+                return (time.perf_counter() - started) * 1000
+            
+            latencies = sorted(await asyncio.gather(*(confirm(n) for n in range(confirmations))))
+            await order_queue.stop(drain_timeout=confirmations * sheets_latency + 10)
+        
+        print(f"✅ Sheets {sheets_latency * 1000:.0f} мс: handle_confirm p50 {latencies[len(latencies) // 2]:.1f} мс, "
+              f"макс {latencies[-1]:.1f} мс (раньше последний из {confirmations} ждал бы "
+              f"~{confirmations * sheets_latency:.0f} с); в таблицу записано {len(confirmed)}")
+        assert latencies[-1] < 200 and len(confirmed) == confirmations
+
+async def _check_order_retries(orders: int = 5):
+    """
+    Сбои Sheets и API мастеров доходят до очереди как исключения и повторяются
+    
+    save_order_from_bot при первой попытке возвращает None (так add_order отвечает
+    на ошибку gspread), API мастеров первые запросы отвечает 503. Рассылка - настоящая
+    notify_masters_about_new_order через httpx.MockTransport и бота-заглушку.
+    """
+    import tempfile
+    import time
+    from types import SimpleNamespace
+    import master_notification
+    
+    global GOOGLE_SHEETS_ENABLED, MASTER_NOTIFICATION_ENABLED, FOLDERS_ENABLED, save_order_from_bot
+    GOOGLE_SHEETS_ENABLED, MASTER_NOTIFICATION_ENABLED, FOLDERS_ENABLED = True, True, False
+    master_notification.TELEGRAM_MASTER_BOT_TOKEN = "check"
+    
+    attempts = {}
+    
+    def flaky_save(**order):
+        attempts[order['phone']] = attempts.get(order['phone'], 0) + 1
+        return None if attempts[order['phone']] == 1 else 100 + int(order['phone'][-3:])
+    
+    api = {"calls": 0, "failures": orders, "masters": [{"id": 1, "full_name": "Мастер", "telegram_id": 501}]}
+    
+    def masters_api(request: httpx.Request) -> httpx.Response:
+        api["calls"] += 1
+        if api["calls"] <= api["failures"]:
+            return httpx.Response(503)
+        return httpx.Response(200, json=api["masters"])
+    
+    sent = []
+    
+    async def send_message(chat_id, text, **kwargs):
+        sent.append(text.split("Заказ #", 1)[1].split("<", 1)[0])
+    
+    save_order_from_bot = flaky_save
+    client = httpx.AsyncClient(transport=httpx.MockTransport(masters_api))
+    master_notification.use_shared_clients(SimpleNamespace(send_message=send_message), client)
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = OrderQueue(
+            f"{tmp}/orders.db", save_order=save_order_to_sheets,
+            notify_masters=notify_masters, retry_base_seconds=0.05
+        )
+        await queue.start()
+        for n in range(orders):
+            await queue.enqueue(chat_id=n, data={
+                'name': 'Клиент', 'phone': f"+7900{n:07d}", 'category': '⚡ Электрика',
+                'problem': 'Не работает розетка', 'address': 'ул. Ленина, 1'
+            })
+        deadline = time.time() + 30
+        while queue.pending_count() and time.time() < deadline:
+            await asyncio.sleep(0.1)
+        await queue.stop()
+    
+    print(f"✅ Сбои Sheets и API мастеров повторены: сохранено {queue.stats['saved']}, "
+          f"мастерам {queue.stats['notified']}, повторов {queue.stats['retries']}, потеряно {queue.stats['dead']}")
+    assert queue.stats["saved"] == queue.stats["notified"] == orders and queue.stats["dead"] == 0
+    assert queue.stats["retries"] == 2 * orders and sorted(sent) == [str(100 + n) for n in range(orders)]
+    
+    # Нет активных мастеров - отдельный результат, не ошибка; ошибка API - исключение
+    api.update(calls=0, failures=0, masters=[])
+    metrics = await master_notification.notify_masters_about_new_order(0, "", "", "", "", "")
+    assert metrics.masters == 0
+    api.update(calls=0, failures=1)
+    try:
+        await master_notification.notify_masters_about_new_order(0, "", "", "", "", "")
+        raise AssertionError("503 от API не дошёл до очереди")
+    except master_notification.MasterNotificationError:
+        pass
+    print("✅ Нет активных мастеров - FanoutMetrics(masters=0), 503 от API - MasterNotificationError")
+    
+    await master_notification.close_clients()
+    await client.aclose()
+
 if __name__ == "__main__":
-    main()
+    if "--check-orders" in sys.argv:
+        asyncio.run(_check_confirm_latency())
+        asyncio.run(_check_order_retries())
+    else:
+        main()
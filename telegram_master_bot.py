@@ -4,14 +4,20 @@ Telegram бот для мастеров - AI Service Platform
 Вдохновлён promo_bot_klg и vinyl_bot с применением принципов Donald Norman UX
 """
 import os
+import sys
+import html
+import asyncio
 import logging
+import time
 import httpx
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -20,6 +26,8 @@ from telegram.ext import (
     filters
 )
 
+from bot_persistence import SQLitePersistence
+
 # Загрузка переменных окружения
 load_dotenv()
 
@@ -34,11 +42,166 @@ logger = logging.getLogger(__name__)
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_MASTER_BOT_TOKEN", "")
 API_URL = os.getenv("API_URL", "https://heallshoking-ai-service-platform-mvp-11-12-2025-2f94.twc1.net")
 
+# HTTP-клиент к API: один на приложение, соединения переиспользуются
+API_TIMEOUT = httpx.Timeout(10.0, connect=5.0, pool=5.0)
+API_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60.0)
+
+try:
+    import h2  # noqa: F401 - HTTP/2 для httpx, если установлен
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
 # Состояния диалога регистрации
 REG_NAME, REG_PHONE, REG_CITY, REG_SPECIALIZATIONS, REG_CONFIRM = range(5)
 
-# Кэш состояния мастеров
-master_cache: Dict[int, Dict[str, Any]] = {}
+# Кэш профилей мастеров: изменения из других мест увидим не позже TTL
+MASTER_CACHE_TTL = 300  # секунд
+MASTER_CACHE_NEGATIVE_TTL = 30  # для незарегистрированных
+
+class MasterProfileCache:
+    """TTL-кэш профилей мастеров по Telegram ID со статистикой попаданий"""
+    
+    def __init__(self, ttl: float = MASTER_CACHE_TTL, negative_ttl: float = MASTER_CACHE_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: Dict[int, Tuple[float, Optional[Dict[str, Any]]]] = {}  # telegram_id -> (истекает, профиль)
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+    
+    def lookup(self, telegram_id: int) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """(найдено, профиль); профиль None - мастер точно не зарегистрирован"""
+        entry = self._entries.get(telegram_id)
+        if entry and entry[0] > time.monotonic():
+            self.stats["hits"] += 1
+            return True, entry[1]
+        self.stats["misses"] += 1
+        return False, None
+    
+    def get(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        """Профиль из кэша без обращения к API (и без учёта в статистике)"""
+        entry = self._entries.get(telegram_id)
+        return entry[1] if entry and entry[0] > time.monotonic() else None
+    
+    def set(self, telegram_id: int, master: Optional[Dict[str, Any]]):
+        ttl = self.ttl if master is not None else self.negative_ttl
+        self._entries[telegram_id] = (time.monotonic() + ttl, master)
+    
+    def invalidate(self, telegram_id: int):
+        """Событие изменения профиля: следующий запрос пойдёт в API"""
+        if self._entries.pop(telegram_id, None):
+            self.stats["invalidations"] += 1
+    
+    @property
+    def hit_ratio(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+master_cache = MasterProfileCache()
+
+# Постраничный просмотр заказов: курсоры страниц и сами страницы на пользователя
+JOBS_PAGE_SIZE = 5
+JOBS_PAGE_TTL = 60  # секунд; после действий с заказом кэш сбрасывается сразу
+JOBS_PAGE_CACHE_MAX_USERS = 1000
+JOBS_DESCRIPTION_PREVIEW = 60  # символов описания в строке списка
+
+class JobPageCache:
+    """
+    Кэш просмотра заказов по Telegram ID: цепочка курсоров (страница N ->
+    курсор API), загруженные страницы с TTL и последнее отрисованное
+    состояние сообщения - чтобы не отправлять в Telegram пустые правки.
+    
+    Живёт в памяти, а не в user_data: навигация меняется на каждое нажатие,
+    и писать её в persistence незачем.
+    """
+    
+    def __init__(self, ttl: float = JOBS_PAGE_TTL, max_users: int = JOBS_PAGE_CACHE_MAX_USERS):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries: Dict[Tuple[int, str], Dict[str, Any]] = {}  # (telegram_id, вид списка) -> состояние
+        self._rendered: Dict[Tuple[int, int], int] = {}  # (chat_id, message_id) -> хэш текста и кнопок
+        self.stats = {"hits": 0, "misses": 0, "edits": 0, "skipped_edits": 0}
+    
+    def _entry(self, telegram_id: int, kind: str) -> Dict[str, Any]:
+        entry = self._entries.get((telegram_id, kind))
+        if entry is None:
+            if len(self._entries) >= self.max_users:
+                # Вытесняем самые старые списки (dict хранит порядок вставки)
+                for key in list(self._entries)[:len(self._entries) // 4 or 1]:
+                    del self._entries[key]
+            entry = {"cursors": [None], "pages": {}}
+            self._entries[(telegram_id, kind)] = entry
+        return entry
+    
+    def reset(self, telegram_id: int, kind: str):
+        """Новый просмотр списка с первой страницы"""
+        self._entries.pop((telegram_id, kind), None)
+    
+    def cursor(self, telegram_id: int, kind: str, page: int) -> Tuple[bool, Optional[str]]:
+        """(известен ли курсор страницы, курсор); первая страница - курсор None"""
+        cursors = self._entry(telegram_id, kind)["cursors"]
+        if 0 <= page < len(cursors):
+            return True, cursors[page]
+        return False, None
+    
+    def get_page(self, telegram_id: int, kind: str, page: int) -> Optional[Tuple[list, Optional[str]]]:
+        """(заказы, курсор следующей страницы) из кэша, если не истекли"""
+        cached = self._entry(telegram_id, kind)["pages"].get(page)
+        if cached and cached[0] > time.monotonic():
+            self.stats["hits"] += 1
+            return cached[1], cached[2]
+        self.stats["misses"] += 1
+        return None
+    
+    def set_page(self, telegram_id: int, kind: str, page: int, jobs: list, next_cursor: Optional[str]):
+        entry = self._entry(telegram_id, kind)
+        entry["pages"][page] = (time.monotonic() + self.ttl, jobs, next_cursor)
+        # Курсоры дальше этой страницы могли устареть - цепочку строим заново
+        del entry["cursors"][page + 1:]
+        if next_cursor:
+            entry["cursors"].append(next_cursor)
+    
+    def find_job(self, telegram_id: int, kind: str, job_id: int) -> Optional[Dict[str, Any]]:
+        """Заказ из уже загруженных страниц (карточка открывается без запроса к API)"""
+        entry = self._entries.get((telegram_id, kind))
+        if not entry:
+            return None
+        now = time.monotonic()
+        for expires, jobs, _ in entry["pages"].values():
+            if expires > now:
+                for job in jobs:
+                    if job.get('id') == job_id:
+                        return job
+        return None
+    
+    def invalidate(self, telegram_id: int):
+        """Заказ принят/начат/отменён - страницы пользователя устарели"""
+        for kind in ("new", "my"):
+            entry = self._entries.get((telegram_id, kind))
+            if entry:
+                entry["pages"].clear()
+    
+    @staticmethod
+    def _state(text: str, reply_markup) -> int:
+        return hash((text, reply_markup.to_json() if reply_markup else ""))
+    
+    def is_unchanged(self, chat_id: int, message_id: int, text: str, reply_markup) -> bool:
+        """Сообщение уже показывает ровно это"""
+        if self._rendered.get((chat_id, message_id)) == self._state(text, reply_markup):
+            self.stats["skipped_edits"] += 1
+            return True
+        return False
+    
+    def remember(self, chat_id: int, message_id: int, text: str, reply_markup):
+        """Запомнить состояние сообщения - только после успешной правки"""
+        if len(self._rendered) >= self.max_users:
+            self._rendered.clear()
+        self._rendered[(chat_id, message_id)] = self._state(text, reply_markup)
+        self.stats["edits"] += 1
+
+job_pages = JobPageCache()
+
+# Общий HTTP-клиент (создаётся в post_init, закрывается в post_shutdown)
+api_client: Optional[httpx.AsyncClient] = None
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 
@@ -68,62 +231,119 @@ def format_price(amount: float) -> str:
     """Форматирование цены (минималистичное)"""
     return f"{amount:,.0f} ₽".replace(',', ' ')
 
+def create_api_client() -> httpx.AsyncClient:
+    """HTTP-клиент с keep-alive пулом и HTTP/2, если доступен"""
+    return httpx.AsyncClient(timeout=API_TIMEOUT, limits=API_LIMITS, http2=HTTP2_AVAILABLE)
+
+def get_api_client() -> httpx.AsyncClient:
+    """Общий клиент к API (создаётся при первом обращении, если бот запущен не через main)"""
+    global api_client
+    if api_client is None or api_client.is_closed:
+        api_client = create_api_client()
+    return api_client
+
+async def post_init(application: Application):
+    """Открыть общий HTTP-клиент при старте бота"""
+    global api_client
+    api_client = create_api_client()
+    logger.info(f"✅ HTTP-клиент к API готов (HTTP/2: {'да' if HTTP2_AVAILABLE else 'нет'})")
+
+async def post_shutdown(application: Application):
+    """Закрыть общий HTTP-клиент при остановке бота"""
+    global api_client
+    logger.info(f"📊 Кэш профилей мастеров: hit ratio {master_cache.hit_ratio:.1%}, {master_cache.stats}")
+    logger.info(f"📊 Кэш страниц заказов: {job_pages.stats}")
+    if api_client is not None:
+        await api_client.aclose()
+        api_client = None
+
 async def get_master_info(telegram_id: int) -> Optional[Dict[str, Any]]:
-    """Получить информацию о мастере из API по Telegram ID"""
+    """Получить информацию о мастере по Telegram ID (сначала из кэша)"""
+    found, master = master_cache.lookup(telegram_id)
+    if found:
+        return master
+    
     try:
-        async with httpx.AsyncClient() as client:
-            # Сначала пробуем получить по telegram_id через query параметр
-            response = await client.get(
-                f"{API_URL}/api/v1/masters",
-                params={"telegram_id": telegram_id},
-                timeout=10.0
-            )
-            
-            if response.status_code == 200:
-                masters = response.json()
-                if masters and len(masters) > 0:
-                    return masters[0]
-            return None
+        client = get_api_client()
+        response = await client.get(f"{API_URL}/api/v1/masters/by-telegram/{telegram_id}")
+        
+        if response.status_code == 200:
+            master = response.json()
+            master_cache.set(telegram_id, master)
+            return master
+        if response.status_code == 404:
+            # Незарегистрированных тоже запоминаем, но ненадолго
+            master_cache.set(telegram_id, None)
+        return None
     except Exception as e:
         logger.error(f"Ошибка получения информации о мастере: {e}")
         return None
 
-async def get_available_jobs(city: str = None) -> list:
-    """Получить доступные заказы"""
+def parse_jobs_page(data) -> Tuple[list, Optional[str]]:
+    """(заказы, курсор следующей страницы) из ответа API"""
+    if isinstance(data, list):
+        # Старый API без пагинации: отдаёт весь список
+        return data[:JOBS_PAGE_SIZE], None
+    return data.get("items", []), data.get("next_cursor")
+
+async def get_available_jobs(city: str = None, cursor: Optional[str] = None,
+                             limit: int = JOBS_PAGE_SIZE) -> Tuple[list, Optional[str]]:
+    """Получить страницу доступных заказов: (заказы, курсор следующей)"""
     try:
-        params = {"status": "pending"}
+        params = {"status": "pending", "limit": limit}
         if city:
             params["city"] = city
+        if cursor:
+            params["cursor"] = cursor
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{API_URL}/api/v1/jobs",
-                params=params,
-                timeout=10.0
-            )
-            
-            if response.status_code == 200:
-                return response.json()
-            return []
+        client = get_api_client()
+        response = await client.get(
+            f"{API_URL}/api/v1/jobs",
+            params=params
+        )
+        
+        if response.status_code == 200:
+            return parse_jobs_page(response.json())
+        return [], None
     except Exception as e:
         logger.error(f"Ошибка получения заказов: {e}")
-        return []
+        return [], None
 
-async def get_my_jobs(master_id: int) -> list:
-    """Получить заказы мастера"""
+async def get_my_jobs(master_id: int, cursor: Optional[str] = None,
+                      limit: int = JOBS_PAGE_SIZE) -> Tuple[list, Optional[str]]:
+    """Получить страницу заказов мастера: (заказы, курсор следующей)"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{API_URL}/api/v1/masters/{master_id}/jobs",
-                timeout=10.0
-            )
-            
-            if response.status_code == 200:
-                return response.json()
-            return []
+        params = {"limit": limit}
+        if cursor:
+            params["cursor"] = cursor
+        
+        client = get_api_client()
+        response = await client.get(
+            f"{API_URL}/api/v1/masters/{master_id}/jobs",
+            params=params
+        )
+        
+        if response.status_code == 200:
+            return parse_jobs_page(response.json())
+        return [], None
     except Exception as e:
         logger.error(f"Ошибка получения заказов мастера: {e}")
-        return []
+        return [], None
+
+async def get_route_plan(master_id: int) -> Optional[Dict[str, Any]]:
+    """Получить маршрут мастера на сегодня"""
+    try:
+        client = get_api_client()
+        response = await client.get(
+            f"{API_URL}/api/v1/masters/{master_id}/route"
+        )
+        
+        if response.status_code == 200:
+            return response.json()
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка получения маршрута: {e}")
+        return None
 
 # ==================== ОБРАБОТЧИКИ КОМАНД ====================
 
@@ -143,8 +363,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
         await update.message.reply_text(
-            "\ud83d\udc4b \u0414\u043e\u0431\u0440\u043e \u043f\u043e\u0436\u0430\u043b\u043e\u0432\u0430\u0442\u044c \u0432 <b>\u0422\u0435\u0440\u043c\u0438\u043d\u0430\u043b \u043c\u0430\u0441\u0442\u0435\u0440\u0430</b>!\n\n"
-            "\ud83d\udd27 \u0417\u0434\u0435\u0441\u044c \u0432\u044b \u0441\u043c\u043e\u0436\u0435\u0442\u0435:\n"
+            "\U0001f44b \u0414\u043e\u0431\u0440\u043e \u043f\u043e\u0436\u0430\u043b\u043e\u0432\u0430\u0442\u044c \u0432 <b>\u0422\u0435\u0440\u043c\u0438\u043d\u0430\u043b \u043c\u0430\u0441\u0442\u0435\u0440\u0430</b>!\n\n"
+            "\U0001f527 \u0417\u0434\u0435\u0441\u044c \u0432\u044b \u0441\u043c\u043e\u0436\u0435\u0442\u0435:\n"
             "\u2022 \u041f\u0440\u0438\u043d\u0438\u043c\u0430\u0442\u044c \u0437\u0430\u043a\u0430\u0437\u044b \u043e\u0442 \u043a\u043b\u0438\u0435\u043d\u0442\u043e\u0432\n"
             "\u2022 \u0423\u043f\u0440\u0430\u0432\u043b\u044f\u0442\u044c \u0441\u0432\u043e\u0438\u043c\u0438 \u0437\u0430\u043a\u0430\u0437\u0430\u043c\u0438\n"
             "\u2022 \u041f\u043e\u043b\u0443\u0447\u0430\u0442\u044c \u0441\u0442\u0430\u0442\u0438\u0441\u0442\u0438\u043a\u0443 \u0438 \u043e\u043f\u043b\u0430\u0442\u0443\n\n"
@@ -155,22 +375,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # С\u043e\u0445\u0440\u0430\u043d\u044f\u0435\u043c \u0432 \u043a\u044d\u0448
-    master_cache[user.id] = master
-    
     # \u041f\u043e\u0441\u0442\u043e\u044f\u043d\u043d\u0430\u044f \u043a\u043b\u0430\u0432\u0438\u0430\u0442\u0443\u0440\u0430 (Norman UX: \u0432\u0441\u0435\u0433\u0434\u0430 \u0434\u043e\u0441\u0442\u0443\u043f\u043d\u044b\u0435 \u0434\u0435\u0439\u0441\u0442\u0432\u0438\u044f)
     keyboard = ReplyKeyboardMarkup(
         [
-            ["\ud83c\udd95 \u041d\u043e\u0432\u044b\u0435 \u0437\u0430\u043a\u0430\u0437\u044b", "\ud83d\udccb \u041c\u043e\u0438 \u0437\u0430\u043a\u0430\u0437\u044b"],
-            ["\ud83d\udcb0 \u0421\u0442\u0430\u0442\u0438\u0441\u0442\u0438\u043a\u0430", "\u2699\ufe0f \u0422\u0435\u0440\u043c\u0438\u043d\u0430\u043b"]
+            ["\U0001f195 \u041d\u043e\u0432\u044b\u0435 \u0437\u0430\u043a\u0430\u0437\u044b", "\U0001f4cb \u041c\u043e\u0438 \u0437\u0430\u043a\u0430\u0437\u044b"],
+            ["\U0001f4b0 \u0421\u0442\u0430\u0442\u0438\u0441\u0442\u0438\u043a\u0430", "\u2699\ufe0f \u0422\u0435\u0440\u043c\u0438\u043d\u0430\u043b"]
         ],
         resize_keyboard=True
     )
     
     welcome_message = (
-        f"\ud83d\udc4b \u0417\u0434\u0440\u0430\u0432\u0441\u0442\u0432\u0443\u0439\u0442\u0435, {master.get('full_name')}!\n\n"
-        f"\ud83d\udd27 <b>\u0422\u0435\u0440\u043c\u0438\u043d\u0430\u043b \u043c\u0430\u0441\u0442\u0435\u0440\u0430</b>\n\n"
-        f"\ud83d\udccd \u0413\u043e\u0440\u043e\u0434: {master.get('city')}\n"
+        f"\U0001f44b \u0417\u0434\u0440\u0430\u0432\u0441\u0442\u0432\u0443\u0439\u0442\u0435, {master.get('full_name')}!\n\n"
+        f"\U0001f527 <b>\u0422\u0435\u0440\u043c\u0438\u043d\u0430\u043b \u043c\u0430\u0441\u0442\u0435\u0440\u0430</b>\n\n"
+        f"\U0001f4cd \u0413\u043e\u0440\u043e\u0434: {master.get('city')}\n"
         f"\u2b50 \u0420\u0435\u0439\u0442\u0438\u043d\u0433: {master.get('rating', 5.0):.1f}/5.0\n\n"
         f"\u0418\u0441\u043f\u043e\u043b\u044c\u0437\u0443\u0439\u0442\u0435 \u043a\u043d\u043e\u043f\u043a\u0438 \u043d\u0438\u0436\u0435 \u0434\u043b\u044f \u0440\u0430\u0431\u043e\u0442\u044b:"
     )
@@ -181,84 +398,137 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='HTML'
     )
 
-async def show_new_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать новые доступные заказы"""
-    user = update.effective_user
-    
-    # Получаем информацию о мастере
-    master = master_cache.get(user.id)
-    if not master:
-        master = await get_master_info(user.id)
-        if not master:
-            await update.message.reply_text("❌ Ошибка: мастер не найден")
-            return
-        master_cache[user.id] = master
+JOBS_LIST_TITLES = {"new": "🆕 Новые заказы", "my": "📋 Мои заказы"}
+
+async def load_jobs_page(telegram_id: int, master: dict, kind: str, page: int) -> Tuple[int, list, Optional[str]]:
+    """Страница списка (из кэша или API): (номер страницы, заказы, курсор следующей)"""
+    cached = job_pages.get_page(telegram_id, kind, page)
+    if cached:
+        return (page,) + cached
+    
+    known, cursor = job_pages.cursor(telegram_id, kind, page)
+    if not known:
+        # Цепочка курсоров потеряна (перезапуск бота, вытеснение) - с начала
+        page, cursor = 0, None
+    
+    if kind == "new":
+        jobs, next_cursor = await get_available_jobs(city=master.get('city'), cursor=cursor)
+    else:
+        jobs, next_cursor = await get_my_jobs(master['id'], cursor=cursor)
     
-    # Loading индикатор
-    loading = await update.message.reply_text(" Поиск заказов...")
+    job_pages.set_page(telegram_id, kind, page, jobs, next_cursor)
+    return page, jobs, next_cursor
+
+def render_jobs_page(kind: str, page: int, jobs: list, next_cursor: Optional[str]) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Одно сообщение на страницу: короткие строки заказов, кнопки карточек и навигация"""
+    if not jobs and page == 0:
+        if kind == "new":
+            return " Новых заказов пока нет.\nЯ уведомлю вас, когда появятся!", None
+        return (
+            " У вас пока нет активных заказов.\n\n"
+            "Нажмите <b> Новые заказы</b> чтобы принять работу!"
+        ), None
     
-    # Получаем доступные заказы
-    jobs = await get_available_jobs(city=master.get('city'))
+    blocks = [f"<b>{JOBS_LIST_TITLES[kind]}</b> · стр. {page + 1}"]
+    keyboard = []
     
-    await loading.delete()
+    for job in jobs:
+        status = job.get('status', 'pending')
+        description = job.get('problem_description') or ''
+        if len(description) > JOBS_DESCRIPTION_PREVIEW:
+            description = description[:JOBS_DESCRIPTION_PREVIEW].rstrip() + "…"
+        
+        blocks.append(
+            f"{get_status_emoji(status)} <b>#{job.get('id')}</b> "
+            f"{html.escape(str(job.get('category_name', job.get('category', ''))))} · "
+            f"{format_price(job.get('estimated_price') or 0)}\n"
+            f"{html.escape(description)}\n"
+            f"📍 {html.escape(job.get('address') or '')}"
+        )
+        keyboard.append([
+            InlineKeyboardButton(
+                f"#{job.get('id')} · {get_status_text(status)}",
+                callback_data=f"view_{kind}_{page}_{job['id']}"
+            )
+        ])
     
     if not jobs:
-        await update.message.reply_text(
-            " Новых заказов пока нет.\n"
-            "Я уведомлю вас, когда появятся!"
-        )
-        return
+        blocks.append("Больше заказов нет.")
     
-    # Показываем карточки заказов
-    for job in jobs[:5]:  # Максимум 5 заказов
-        await show_job_card(update, context, job, is_new=True)
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ Назад", callback_data=f"page_{kind}_{page - 1}"))
+    if next_cursor:
+        navigation.append(InlineKeyboardButton("Вперёд ▶️", callback_data=f"page_{kind}_{page + 1}"))
+    if navigation:
+        keyboard.append(navigation)
     
-    if len(jobs) > 5:
-        await update.message.reply_text(
-            f" Показано 5 из {len(jobs)} заказов.\n"
-            "Примите текущие, чтобы увидеть следующие."
-        )
+    return "\n\n".join(blocks), InlineKeyboardMarkup(keyboard) if keyboard else None
 
-async def show_my_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать мои заказы"""
+async def edit_jobs_message(message, text: str, reply_markup: Optional[InlineKeyboardMarkup]):
+    """Правка сообщения списка на месте; одинаковое состояние не отправляем"""
+    if job_pages.is_unchanged(message.chat_id, message.message_id, text, reply_markup):
+        return
+    try:
+        await message.edit_text(text, reply_markup=reply_markup, parse_mode='HTML')
+    except BadRequest as e:
+        # Сообщение правили в обход кэша (например, принятие заказа) - это не ошибка
+        if "not modified" not in str(e).lower():
+            raise
+    # Правка не прошла (сеть, флуд-лимит) - состояние не запоминаем, повтор отправит её снова
+    job_pages.remember(message.chat_id, message.message_id, text, reply_markup)
+
+async def show_jobs_list(update: Update, kind: str, loading_text: str):
+    """Новый просмотр списка: одно сообщение, дальше только правки"""
     user = update.effective_user
     
-    master = master_cache.get(user.id)
+    master = await get_master_info(user.id)
     if not master:
         await update.message.reply_text("❌ Ошибка: мастер не найден")
         return
     
-    loading = await update.message.reply_text(" Загрузка ваших заказов...")
-    
-    jobs = await get_my_jobs(master['id'])
+    # Loading индикатор - он же станет сообщением со списком
+    loading = await update.message.reply_text(loading_text)
     
-    await loading.delete()
+    job_pages.reset(user.id, kind)
+    page, jobs, next_cursor = await load_jobs_page(user.id, master, kind, 0)
     
-    if not jobs:
-        await update.message.reply_text(
-            " У вас пока нет активных заказов.\n\n"
-            "Нажмите <b> Новые заказы</b> чтобы принять работу!",
-            parse_mode='HTML'
-        )
+    text, reply_markup = render_jobs_page(kind, page, jobs, next_cursor)
+    await edit_jobs_message(loading, text, reply_markup)
+
+async def show_new_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать новые доступные заказы (постранично)"""
+    await show_jobs_list(update, "new", " Поиск заказов...")
+
+async def show_my_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать мои заказы (постранично)"""
+    await show_jobs_list(update, "my", " Загрузка ваших заказов...")
+
+async def show_jobs_page(query, master: dict, kind: str, page: int):
+    """Перелистнуть список: правим то же сообщение"""
+    page, jobs, next_cursor = await load_jobs_page(query.from_user.id, master, kind, page)
+    text, reply_markup = render_jobs_page(kind, page, jobs, next_cursor)
+    await edit_jobs_message(query.message, text, reply_markup)
+
+async def show_job_view(query, master: dict, kind: str, page: int, job_id: int):
+    """Открыть карточку заказа на месте списка, с возвратом к той же странице"""
+    job = job_pages.find_job(query.from_user.id, kind, job_id)
+    if job is None:
+        _, jobs, _ = await load_jobs_page(query.from_user.id, master, kind, page)
+        job = next((j for j in jobs if j.get('id') == job_id), None)
+    
+    if job is None:
+        # Заказ уже ушёл со страницы (его приняли) - показываем страницу заново
+        await show_jobs_page(query, master, kind, page)
         return
     
-    # Группируем по статусам
-    active = [j for j in jobs if j['status'] in ['accepted', 'in_progress']]
-    completed = [j for j in jobs if j['status'] == 'completed']
-    
-    if active:
-        await update.message.reply_text(f"<b>⚙ Активные заказы ({len(active)}):</b>", parse_mode='HTML')
-        for job in active:
-            await show_job_card(update, context, job, is_new=False)
-    
-    if completed:
-        await update.message.reply_text(f"<b>✅ Завершённые ({len(completed)}):</b>", parse_mode='HTML')
-        for job in completed[:3]:  # Только последние 3
-            await show_job_card(update, context, job, is_new=False)
+    text, keyboard = build_job_card(job, is_new=(kind == "new"))
+    keyboard.append([InlineKeyboardButton("⬅️ К списку", callback_data=f"page_{kind}_{page}")])
+    await edit_jobs_message(query.message, text, InlineKeyboardMarkup(keyboard))
 
-async def show_job_card(update: Update, context: ContextTypes.DEFAULT_TYPE, job: dict, is_new: bool = False):
+def build_job_card(job: dict, is_new: bool = False) -> Tuple[str, list]:
     """
-    Показать карточку заказа (Norman UX: минималистичный дизайн)
+    Карточка заказа: текст и ряды кнопок (Norman UX: минималистичный дизайн)
     
     Args:
         job: Данные заказа
@@ -271,12 +541,12 @@ async def show_job_card(update: Update, context: ContextTypes.DEFAULT_TYPE, job:
     # Форматирование (без placeholder, только факты)
     message = (
         f"{status_emoji} <b>Заказ #{job.get('id')}</b>\n\n"
-        f" {job.get('category_name', job.get('category', ''))}\n"
-        f" {job.get('problem_description', '')}\n\n"
-        f" {job.get('client_name', '')}\n"
-        f" {job.get('client_phone', '')}\n"
-        f" {job.get('address', '')}\n\n"
-        f" Примерно: {format_price(job.get('estimated_price', 0))}\n"
+        f" {html.escape(str(job.get('category_name', job.get('category', ''))))}\n"
+        f" {html.escape(str(job.get('problem_description') or ''))}\n\n"
+        f" {html.escape(str(job.get('client_name') or ''))}\n"
+        f" {html.escape(str(job.get('client_phone') or ''))}\n"
+        f" {html.escape(str(job.get('address') or ''))}\n\n"
+        f" Примерно: {format_price(job.get('estimated_price') or 0)}\n"
         f" {job.get('created_at', '')}"
     )
     
@@ -306,19 +576,13 @@ async def show_job_card(update: Update, context: ContextTypes.DEFAULT_TYPE, job:
                 InlineKeyboardButton(" Связаться с клиентом", url=f"tel:{job.get('client_phone', '')}")
             ])
     
-    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-    
-    await update.message.reply_text(
-        message,
-        reply_markup=reply_markup,
-        parse_mode='HTML'
-    )
+    return message, keyboard
 
 async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать статистику мастера"""
     user = update.effective_user
     
-    master = master_cache.get(user.id)
+    master = await get_master_info(user.id)
     if not master:
         await update.message.reply_text("❌ Ошибка: мастер не найден")
         return
@@ -326,44 +590,79 @@ async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     loading = await update.message.reply_text(" Загрузка статистики...")
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{API_URL}/api/v1/masters/{master['id']}/statistics",
-                timeout=10.0
-            )
+        client = get_api_client()
+        response = await client.get(
+            f"{API_URL}/api/v1/masters/{master['id']}/statistics"
+        )
+        
+        await loading.delete()
+        
+        if response.status_code == 200:
+            stats = response.json()
             
-            await loading.delete()
+            message = (
+                f" <b>Статистика</b>\n\n"
+                f"✅ Завершено заказов: {stats.get('completed_jobs', 0)}\n"
+                f" Общий заработок: {format_price(stats.get('total_earnings', 0))}\n"
+                f"⭐ Средняя оценка: {stats.get('average_rating', 5.0):.1f}/5.0\n\n"
+                f"<b>За сегодня:</b>\n"
+                f"• Заказов: {stats.get('today_jobs', 0)}\n"
+                f"• Заработано: {format_price(stats.get('today_earnings', 0))}\n\n"
+                f"<b>За месяц:</b>\n"
+                f"• Заказов: {stats.get('month_jobs', 0)}\n"
+                f"• Заработано: {format_price(stats.get('month_earnings', 0))}"
+            )
             
-            if response.status_code == 200:
-                stats = response.json()
-                
-                message = (
-                    f" <b>Статистика</b>\n\n"
-                    f"✅ Завершено заказов: {stats.get('completed_jobs', 0)}\n"
-                    f" Общий заработок: {format_price(stats.get('total_earnings', 0))}\n"
-                    f"⭐ Средняя оценка: {stats.get('average_rating', 5.0):.1f}/5.0\n\n"
-                    f"<b>За сегодня:</b>\n"
-                    f"• Заказов: {stats.get('today_jobs', 0)}\n"
-                    f"• Заработано: {format_price(stats.get('today_earnings', 0))}\n\n"
-                    f"<b>За месяц:</b>\n"
-                    f"• Заказов: {stats.get('month_jobs', 0)}\n"
-                    f"• Заработано: {format_price(stats.get('month_earnings', 0))}"
-                )
-                
-                await update.message.reply_text(message, parse_mode='HTML')
-            else:
-                await update.message.reply_text("❌ Не удалось загрузить статистику")
+            await update.message.reply_text(message, parse_mode='HTML')
+        else:
+            await update.message.reply_text("❌ Не удалось загрузить статистику")
     
     except Exception as e:
         await loading.delete()
         logger.error(f"Ошибка получения статистики: {e}")
         await update.message.reply_text("❌ Произошла ошибка")
 
+async def show_route(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Маршрут на сегодня: в каком порядке объезжать заказы"""
+    user = update.effective_user
+    
+    master = await get_master_info(user.id)
+    if not master:
+        await update.message.reply_text("❌ Ошибка: мастер не найден")
+        return
+    
+    plan = await get_route_plan(master['id'])
+    
+    if plan is None:
+        await update.message.reply_text("❌ Не удалось построить маршрут")
+        return
+    
+    if not plan['stops']:
+        await update.message.reply_text("🗺 На сегодня заказов с адресом нет")
+        return
+    
+    lines = [
+        f"🗺 <b>Маршрут на сегодня</b> ({html.escape(str(plan['distance_km']))} км, "
+        f"в пути ~{html.escape(str(plan['travel_minutes']))} мин)\n"
+    ]
+    for number, stop in enumerate(plan['stops'], start=1):
+        late = f" ⚠️ опоздание {html.escape(str(stop['late_minutes']))} мин" if stop['late_minutes'] else ""
+        lines.append(
+            f"{number}. <b>{html.escape(str(stop['start']))}</b> - заказ #{html.escape(str(stop['job_id']))}{late}\n"
+            f"   📍 {html.escape(str(stop['address'] or ''))}"
+        )
+    
+    if plan['unrouted']:
+        unrouted = ', '.join(f"#{html.escape(str(job_id))}" for job_id in plan['unrouted'])
+        lines.append(f"\nБез координат: {unrouted}")
+    
+    await update.message.reply_text("\n".join(lines), parse_mode='HTML')
+
 async def toggle_terminal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Включить/выключить терминал (приём заказов)"""
     user = update.effective_user
     
-    master = master_cache.get(user.id)
+    master = await get_master_info(user.id)
     if not master:
         await update.message.reply_text("❌ Ошибка: мастер не найден")
         return
@@ -373,31 +672,29 @@ async def toggle_terminal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     new_status = not current_status
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.patch(
-                f"{API_URL}/api/v1/masters/{master['id']}/terminal",
-                json={"terminal_active": new_status},
-                timeout=10.0
-            )
+        client = get_api_client()
+        response = await client.patch(
+            f"{API_URL}/api/v1/masters/{master['id']}/terminal",
+            json={"terminal_active": new_status}
+        )
+        
+        if response.status_code == 200:
+            master_cache.invalidate(user.id)
             
-            if response.status_code == 200:
-                master['terminal_active'] = new_status
-                master_cache[user.id] = master
-                
-                if new_status:
-                    message = (
-                        "✅ <b>Терминал включён!</b>\n\n"
-                        "Вы будете получать уведомления о новых заказах."
-                    )
-                else:
-                    message = (
-                        "⏸ <b>Терминал выключен</b>\n\n"
-                        "Вы не будете получать новые заказы до включения."
-                    )
-                
-                await update.message.reply_text(message, parse_mode='HTML')
+            if new_status:
+                message = (
+                    "✅ <b>Терминал включён!</b>\n\n"
+                    "Вы будете получать уведомления о новых заказах."
+                )
             else:
-                await update.message.reply_text("❌ Не удалось изменить статус терминала")
+                message = (
+                    "⏸ <b>Терминал выключен</b>\n\n"
+                    "Вы не будете получать новые заказы до включения."
+                )
+            
+            await update.message.reply_text(message, parse_mode='HTML')
+        else:
+            await update.message.reply_text("❌ Не удалось изменить статус терминала")
     
     except Exception as e:
         logger.error(f"Ошибка переключения терминала: {e}")
@@ -413,13 +710,25 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     user = update.effective_user
     
-    master = master_cache.get(user.id)
+    master = await get_master_info(user.id)
     if not master:
         await query.message.reply_text("❌ Ошибка: мастер не найден")
         return
     
+    # Действие с заказом меняет списки - страницы пользователя устарели
+    if data.startswith(("accept_", "start_", "complete_", "cancel_")):
+        job_pages.invalidate(user.id)
+    
     # Парсим действие
-    if data.startswith("accept_"):
+    if data.startswith("page_"):
+        _, kind, page = data.split("_")
+        await show_jobs_page(query, master, kind, int(page))
+    
+    elif data.startswith("view_"):
+        _, kind, page, job_id = data.split("_")
+        await show_job_view(query, master, kind, int(page), int(job_id))
+    
+    elif data.startswith("accept_"):
         job_id = int(data.split("_")[1])
         await accept_job(query, context, job_id, master['id'])
     
@@ -576,20 +885,19 @@ async def complete_job(query, context, job_id: int):
 async def cancel_job(query, context, job_id: int):
     """Отменить заказ"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.patch(
-                f"{API_URL}/api/v1/jobs/{job_id}/status",
-                json={"status": "cancelled"},
-                timeout=10.0
+        client = get_api_client()
+        response = await client.patch(
+            f"{API_URL}/api/v1/jobs/{job_id}/status",
+            json={"status": "cancelled"}
+        )
+        
+        if response.status_code == 200:
+            await query.edit_message_text(
+                f"{query.message.text}\n\n <b>Заказ отменён</b>",
+                parse_mode='HTML'
             )
-            
-            if response.status_code == 200:
-                await query.edit_message_text(
-                    f"{query.message.text}\n\n <b>Заказ отменён</b>",
-                    parse_mode='HTML'
-                )
-            else:
-                await query.message.reply_text("❌ Не удалось отменить заказ")
+        else:
+            await query.message.reply_text("❌ Не удалось отменить заказ")
     
     except Exception as e:
         logger.error(f"Ошибка отмены заказа: {e}")
@@ -660,7 +968,8 @@ async def handle_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         # Очищаем состояние
         del context.user_data['completing_job_id']
-        
+        job_pages.invalidate(update.effective_user.id)
+    
     except ValueError:
         await update.message.reply_text(
             "❌ Неверный формат цены!\n\n"
@@ -852,52 +1161,53 @@ async def reg_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{API_URL}/api/v1/masters/register",
-                json={
-                    "full_name": data['reg_name'],
-                    "phone": data['reg_phone'],
-                    "city": data['reg_city'],
-                    "specializations": specializations,
-                    "rating": 5.0
-                },
-                timeout=30.0
+        client = get_api_client()
+        response = await client.post(
+            f"{API_URL}/api/v1/masters/register",
+            json={
+                "full_name": data['reg_name'],
+                "phone": data['reg_phone'],
+                "city": data['reg_city'],
+                "specializations": specializations,
+                "rating": 5.0
+            },
+            timeout=30.0
+        )
+        
+        if response.status_code == 200:
+            result = response.json()
+            master_id = result.get('master_id')
+            
+            # Обновить Telegram ID мастера
+            await client.patch(
+                f"{API_URL}/api/v1/masters/{master_id}",
+                json={"telegram_id": user.id},  # Сохраняем Telegram ID
+                timeout=10.0
             )
+            master_cache.invalidate(user.id)  # Был закэширован как незарегистрированный
             
-            if response.status_code == 200:
-                result = response.json()
-                master_id = result.get('master_id')
-                
-                # Обновить Telegram ID мастера
-                await client.patch(
-                    f"{API_URL}/api/v1/masters/{master_id}",
-                    json={"telegram_id": user.id},  # Сохраняем Telegram ID
-                    timeout=10.0
-                )
-                
-                await update.message.reply_text(
-                    " <b>Регистрация завершена!</b>\n\n"
-                    f"✅ Ваш ID: {master_id}\n"
-                    f" {data['reg_name']}\n"
-                    f" {data['reg_city']}\n\n"
-                    "Теперь вы можете принимать заказы!\n"
-                    "Используйте /start чтобы открыть терминал.",
-                    parse_mode='HTML'
-                )
-                
-                # Очистить данные регистрации
-                context.user_data.clear()
-                
-                return ConversationHandler.END
+            await update.message.reply_text(
+                " <b>Регистрация завершена!</b>\n\n"
+                f"✅ Ваш ID: {master_id}\n"
+                f" {data['reg_name']}\n"
+                f" {data['reg_city']}\n\n"
+                "Теперь вы можете принимать заказы!\n"
+                "Используйте /start чтобы открыть терминал.",
+                parse_mode='HTML'
+            )
             
-            else:
-                await update.message.reply_text(
-                    f"❌ Ошибка регистрации: {response.status_code}\n"
-                    f"{response.text}\n\n"
-                    "Попробуйте ещё раз: /start"
-                )
-                return ConversationHandler.END
+            # Очистить данные регистрации
+            context.user_data.clear()
+            
+            return ConversationHandler.END
+        
+        else:
+            await update.message.reply_text(
+                f"❌ Ошибка регистрации: {response.status_code}\n"
+                f"{response.text}\n\n"
+                "Попробуйте ещё раз: /start"
+            )
+            return ConversationHandler.END
     
     except Exception as e:
         logger.error(f"Ошибка создания мастера: {e}")
@@ -918,14 +1228,18 @@ async def reg_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ==================== ЗАПУСК БОТА ====================
 
-def main():
-    """Запуск бота"""
-    if not TELEGRAM_BOT_TOKEN:
-        logger.error("❌ TELEGRAM_MASTER_BOT_TOKEN не установлен!")
-        return
-    
-    # Создать приложение
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+def build_application(builder: Optional[ApplicationBuilder] = None) -> Application:
+    """Приложение бота с обработчиками (polling в main, webhook - в bot_webhooks)"""
+    if builder is None:
+        builder = Application.builder().token(TELEGRAM_BOT_TOKEN)
+    # Состояние диалогов и user_data переживают перезапуск (bot_state.db)
+    application = (
+        builder
+        .persistence(SQLitePersistence(namespace="master"))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # ConversationHandler для регистрации
     registration_handler = ConversationHandler(
@@ -939,11 +1253,14 @@ def main():
             REG_SPECIALIZATIONS: [MessageHandler(filters.TEXT & ~filters.COMMAND, reg_get_specializations)],
             REG_CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, reg_confirm)],
         },
-        fallbacks=[CommandHandler('cancel', reg_cancel)]
+        fallbacks=[CommandHandler('cancel', reg_cancel)],
+        name="registration",
+        persistent=True
     )
     
     # Команды
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("route", show_route))
     
     # Регистрация
     application.add_handler(registration_handler)
@@ -953,10 +1270,99 @@ def main():
     
     # Текстовые сообщения
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
+
+def main():
+    """Запуск бота (polling)"""
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("❌ TELEGRAM_MASTER_BOT_TOKEN не установлен!")
+        return
+    
+    application = build_application()
     
     # Запуск бота
     logger.info(" Telegram бот для мастеров запущен!")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+async def _bench_api_client(requests: int = 300, masters: int = 20):
+    """Задержка API-хелперов обработчиков: новый клиент на запрос, общий клиент, кэш профилей"""
+    import json
+    import random
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    global API_URL
+    
+    class StubAPI(BaseHTTPRequestHandler):
+        """Локальная заглушка API с keep-alive"""
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+        
+        def do_GET(self):
+            telegram_id = int(self.path.rsplit("/", 1)[-1])
+            body = json.dumps({"id": telegram_id + 1, "full_name": "Мастер", "telegram_id": telegram_id}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, *args):
+            pass
+    
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    API_URL = f"http://127.0.0.1:{server.server_address[1]}"
+    
+    async def fresh_client_lookup(telegram_id: int):
+        # Как было: новое соединение на каждое нажатие кнопки
+        async with httpx.AsyncClient() as client:
+            response = await client.get(f"{API_URL}/api/v1/masters/by-telegram/{telegram_id}", timeout=10.0)
+            return response.json()
+    
+    def report(name: str, latencies: list):
+        latencies.sort()
+        print(f"✅ {name}: p50 {latencies[len(latencies) // 2]:.2f} мс, "
+              f"p95 {latencies[int(len(latencies) * 0.95)]:.2f} мс")
+    
+    # Нажатия кнопок: несколько активных мастеров, каждый жмёт много раз
+    rng = random.Random(5)
+    presses = [rng.randrange(masters) for _ in range(requests)]
+    
+    master_cache.ttl = 0  # Сначала без кэша - только транспорт
+    for name, lookup in (("новый клиент", fresh_client_lookup), ("общий клиент", get_master_info)):
+        latencies = []
+        for telegram_id in presses:
+            started = time.perf_counter()
+            master = await lookup(telegram_id)
+            latencies.append((time.perf_counter() - started) * 1000)
+            assert master["id"] == telegram_id + 1
+        report(name, latencies)
+    
+    master_cache.ttl = MASTER_CACHE_TTL
+    master_cache.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+    latencies = []
+    for number, telegram_id in enumerate(presses):
+        if number % 50 == 0:
+            master_cache.invalidate(telegram_id)  # Мастер переключил терминал
+        started = time.perf_counter()
+        master = await get_master_info(telegram_id)
+        latencies.append((time.perf_counter() - started) * 1000)
+        assert master["id"] == telegram_id + 1
+    report(f"общий клиент + кэш (hit ratio {master_cache.hit_ratio:.1%})", latencies)
+    
+    # Параллельные нажатия делят пул соединений
+    master_cache.ttl = 0
+    started = time.perf_counter()
+    await asyncio.gather(*(get_master_info(i) for i in range(requests)))
+    print(f"✅ {requests} одновременных запросов через общий клиент: {(time.perf_counter() - started) * 1000:.0f} мс")
+    
+    await post_shutdown(None)
+    server.shutdown()
+
 if __name__ == "__main__":
-    main()
+    if "--bench-api" in sys.argv:
+        asyncio.run(_bench_api_client())
+    else:
+        main()